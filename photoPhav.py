@@ -39,36 +39,5092 @@ photoPhav.py
 
 PhotoPhav (as in Photo Favorites) will create links to favorite images based on 'star'
 and/or color ratings. See main.docstring for additional information.
+
+It can also be imported, and a run made of its stages (PhavConfig, scan(),
+pair(), read_ratings(), select_favorites(), and apply_links()), e.g. in a long
+running process that keeps its metadata cache open. See PhavConfig. A whole
+run, as from the command line, is run() with a PhavConfig and RunOptions.
 """
 
 # imports
 
 # Standard library and system imports
-import traceback
 import os
+import stat
 from sys import exit as sys_exit
 
 # arg parser
 import argparse
 
-# path, file processing, and regular expressions
-from pathlib import Path
-import re
-import fnmatch
+# path, file processing, and regular expressions
+from pathlib import Path
+import re
+import fnmatch
+
+# type hints
+from typing import NamedTuple
+
+# compact file table
+from array import array
+
+# run statistics
+import time
+import heapq
+from bisect import bisect_left
+from contextlib import nullcontext
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    pass
+
+# xmp packet parsing (fast paths)
+import xml.etree.ElementTree as ET
+import struct
+
+# metadata cache
+import sqlite3
+
+# sync manifest
+import json
+
+# output modes (hardlink, reflink, copy)
+import errno
+
+# watch mode
+import select
+import signal
+
+# parallel metadata extraction
+import threading
+from collections import deque, OrderedDict
+from itertools import chain, islice
+
+# Slow to import modules are imported where they are first needed, so
+# startup (e.g. --help, or a run where everything is a cache hit) doesn't pay
+# for them:
+#   libxmp (loads and initializes Exempi)   load_file_to_dict()
+#   bpsPrettyPrint                          verbose file listing in main()
+#   concurrent.futures                      extract_records() with jobs or io_threads,
+#                                           LinkWriter copies with copy_threads
+#   fcntl                                   copy_file_data() with reflink
+#   ctypes                                  InotifyEvents
+#   hashlib                                 shard_hash() with --shard
+
+# Note: May need PYTHONPATH (set in ~/.profile?) to be set depending
+# on the location of the imported files
+
+# Sidecar naming conventions. 'stem' is foo.jpg -> foo.xmp, 'full' is
+# foo.jpg -> foo.jpg.xmp, and 'both' honors either one.
+SIDECAR_NAMING = ("stem", "full", "both")
+
+# File types (lower case suffixes) read for metadata unless --types says
+# otherwise: common image formats and camera raw formats. Sidecars (.xmp) are
+# always kept, so they can be paired with their images.
+DEFAULT_IMAGE_TYPES = frozenset(
+    # image formats
+    ".jpg .jpeg .jpe .tif .tiff .png .gif .webp .heic .heif .avif .jxl .psd .psb "
+    # camera raw formats
+    ".dng .nef .nrw .cr2 .cr3 .crw .arw .srf .sr2 .orf .rw2 .raf .pef .srw .x3f "
+    ".3fr .iiq .erf .mef .mos .mrw .kdc .dcr .rwl".split()
+)
+
+
+class SidecarIndex:
+    """Index of the xmp sidecar files in a directory, built once per
+    directory, so an image file can be resolved to its sidecar without
+    searching all the sidecars every time. Works on file names (no
+    directory), so no Path objects are made.
+
+    Sidecars are keyed by name less the '.xmp' suffix. The suffix match is
+    case-insensitive, so foo.xmp and foo.XMP are both found. The naming
+    argument selects the convention(s) honored by lookup():
+    'stem': foo.jpg uses foo.xmp
+    'full': foo.jpg uses foo.jpg.xmp
+    'both': either, with foo.jpg.xmp preferred since it names a single image.
+
+    When more than one sidecar could belong to an image (e.g. foo.xmp and
+    foo.XMP, or foo.xmp and foo.jpg.xmp with 'both'), the match is ambiguous.
+    The preferred candidate is still returned, chosen deterministically, and
+    the image and all its candidates are recorded in the ambiguous dict so
+    they can be reported."""
+
+    def __init__(self, xmp_names, naming: str = "both"):
+        if naming not in SIDECAR_NAMING:
+            raise ValueError(f"Unknown sidecar naming convention: {naming}")
+        self.naming = naming
+        self.ambiguous: dict[str, list[str]] = {}
+        self._index: dict[str, list[str]] = {}
+        for xmp_name in xmp_names:
+            # strip the '.xmp' suffix, whatever the case
+            self._index.setdefault(xmp_name[:-4], []).append(xmp_name)
+
+    def __len__(self):
+        return sum(len(names) for names in self._index.values())
+
+    def lookup(self, image_name: str):
+        """Return the sidecar name for the image name, or None if there isn't
+        one. Ambiguous matches are recorded in self.ambiguous."""
+        # Candidates in order of preference
+        candidates = []
+        if self.naming in ("full", "both"):
+            candidates.extend(sorted(self._index.get(image_name, [])))
+        stem = os.path.splitext(image_name)[0]
+        if self.naming in ("stem", "both") and stem != image_name:
+            candidates.extend(sorted(self._index.get(stem, [])))
+        if not candidates:
+            return None
+        if len(candidates) > 1:
+            self.ambiguous[image_name] = candidates
+        return candidates[0]
+
+
+# Kinds of metadata source. Metadata is either read from an xmp sidecar file
+# or is embedded in the image file, or comes from a darktable or digiKam
+# library database (--library).
+SOURCE_SIDECAR = "sidecar"
+SOURCE_EMBEDDED = "embedded"
+SOURCE_LIBRARY = "library"
+
+
+class XmpRecord(NamedTuple):
+    """The metadata photoPhav uses, as read from a single xmp source. pick is
+    PICK_PICKED, PICK_REJECTED, or PICK_NONE."""
+
+    rating: int
+    label: str
+    pick: int
+
+
+# Pick status values
+PICK_PICKED = 1
+PICK_NONE = 0
+PICK_REJECTED = -1
+
+# Namespaces of the xmp properties photoPhav reads
+NS_RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+NS_XMP = "http://ns.adobe.com/xap/1.0/"
+NS_XMP_DM = "http://ns.adobe.com/xmp/1.0/DynamicMedia/"
+NS_XMP_NOTE = "http://ns.adobe.com/xmp/note/"
+NS_DIGIKAM = "http://www.digikam.org/ns/1.0/"
+
+# The xmp properties that make up an XmpRecord, as {(namespace, property
+# name): field}. Every field is picked up in a single pass over the
+# properties. xmpDM:pick is the Adobe pick/reject flag (1 or -1), and
+# digiKam:PickLabel is digiKam's (1 rejected, 2 pending, 3 accepted).
+XMP_RECORD_PROPS = {
+    (NS_XMP, "Rating"): "rating",
+    (NS_XMP, "Label"): "label",
+    (NS_XMP_DM, "pick"): "pick",
+    (NS_DIGIKAM, "PickLabel"): "pick_label",
+}
+
+
+def make_xmp_record(values: dict):
+    """Given the raw (string) property values found, as {field: value} for
+    the fields in XMP_RECORD_PROPS, return an XmpRecord.
+
+    A missing or non-integer rating gives a rating of 0, and a missing label
+    gives an empty string. Without a pick flag, a rating of -1 (which is how
+    darktable and Lightroom mark a rejected image) counts as rejected."""
+    try:
+        rating = int((values.get("rating") or "0").strip())
+    except ValueError:
+        rating = 0
+    pick = PICK_NONE
+    try:
+        if values.get("pick"):
+            pick = max(PICK_REJECTED, min(PICK_PICKED, int(values["pick"].strip())))
+        elif values.get("pick_label"):
+            pick_label = int(values["pick_label"].strip())
+            pick = {1: PICK_REJECTED, 3: PICK_PICKED}.get(pick_label, PICK_NONE)
+        elif rating == -1:
+            pick = PICK_REJECTED
+    except ValueError:
+        pass
+    return XmpRecord(rating, values.get("label") or "", pick)
+
+
+class FileTable:
+    """Compact table of file names, for holding the files of a run (possibly
+    millions) in memory.
+
+    Each file is a row. The directory (as a path prefix) and suffix are
+    interned and stored as small integer ids, in array storage. Only the stem
+    of the file name is kept as a string. Paths are made again only when
+    asked for, e.g. at the point of linking."""
+
+    __slots__ = (
+        "_dirs",
+        "_dir_ids",
+        "_suffixes",
+        "_suffix_ids",
+        "dir_ids",
+        "stems",
+        "suffix_ids",
+    )
+
+    def __init__(self):
+        self._dirs = []  # directory prefix by id
+        self._dir_ids = {}
+        self._suffixes = []  # suffix by id
+        self._suffix_ids = {}
+        self.dir_ids = array("I")
+        self.stems = []
+        self.suffix_ids = array("H")
+
+    def __len__(self):
+        return len(self.stems)
+
+    @staticmethod
+    def _intern(value: str, values: list, ids: dict):
+        """Return the id of value, adding it if it is new."""
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(values)
+            values.append(value)
+        return value_id
+
+    def add(self, dir_prefix: str, name: str):
+        """Add a file, given as its directory prefix (as from scan_dir()) and
+        name. Return its row number."""
+        stem, suffix = os.path.splitext(name)
+        self.dir_ids.append(self._intern(dir_prefix, self._dirs, self._dir_ids))
+        self.stems.append(stem)
+        self.suffix_ids.append(self._intern(suffix, self._suffixes, self._suffix_ids))
+        return len(self.stems) - 1
+
+    def add_file(self, fname: str):
+        """Add a file given by its file name (as from pair_sidecars())."""
+        dir_prefix, sep, name = fname.rpartition("/")
+        return self.add(dir_prefix + sep, name)
+
+    def file_name(self, row: int):
+        """Return the file name of a row, as it was added."""
+        suffix = self._suffixes[self.suffix_ids[row]]
+        return self._dirs[self.dir_ids[row]] + self.stems[row] + suffix
+
+
+# Fast path for xmp embedded in JPEG files. The xmp packet is in an APP1
+# segment, which comes before the image data, so only the marker segments up to
+# the start of scan (SOS) need to be read.
+JPEG_SUFFIXES = {".jpg", ".jpeg", ".jpe", ".jfif"}
+XMP_APP1_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+XMP_EXT_APP1_HEADER = b"http://ns.adobe.com/xmp/extension/\x00"
+# XMP_RECORD_PROPS as ElementTree tags
+XMP_RECORD_TAGS = {f"{{{ns}}}{name}": field for (ns, name), field in XMP_RECORD_PROPS.items()}
+
+
+class XmpFastPathError(Exception):
+    """The xmp data can't be read by a fast path (packet absent, extended, or
+    malformed). Use Exempi instead."""
+
+
+def read_jpeg_xmp_packet(fname: str):
+    """Return the standard xmp packet embedded in a JPEG file as bytes.
+
+    Walk the JPEG marker segments from the start of the file, reading only
+    the segment headers (and the xmp APP1 segment), and stop at the start of
+    scan, so the image data is never read. Raise XmpFastPathError if the file
+    isn't a JPEG, has no xmp packet, has extended xmp, or is malformed."""
+    with open(fname, "rb") as jpeg:
+        if jpeg.read(2) != b"\xff\xd8":  # SOI
+            raise XmpFastPathError("Not a JPEG file")
+        packet = None
+        while True:
+            header = jpeg.read(2)
+            if len(header) < 2 or header[0] != 0xFF:
+                raise XmpFastPathError("Bad JPEG marker")
+            marker = header[1]
+            # Markers may be preceded by any number of 0xFF fill bytes
+            while marker == 0xFF:
+                marker_byte = jpeg.read(1)
+                if not marker_byte:
+                    raise XmpFastPathError("Bad JPEG marker")
+                marker = marker_byte[0]
+            if marker in (0xDA, 0xD9):  # SOS or EOI. No more metadata.
+                break
+            if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # no length
+                continue
+            length_bytes = jpeg.read(2)
+            if len(length_bytes) < 2:
+                raise XmpFastPathError("Truncated JPEG segment")
+            length = int.from_bytes(length_bytes, "big") - 2
+            if length < 0:
+                raise XmpFastPathError("Bad JPEG segment length")
+            if marker != 0xE1:  # not APP1, so skip it
+                jpeg.seek(length, os.SEEK_CUR)
+                continue
+            segment = jpeg.read(length)
+            if len(segment) < length:
+                raise XmpFastPathError("Truncated JPEG segment")
+            if segment.startswith(XMP_EXT_APP1_HEADER):
+                raise XmpFastPathError("Extended xmp")
+            if segment.startswith(XMP_APP1_HEADER) and packet is None:
+                packet = segment[len(XMP_APP1_HEADER) :]
+    if packet is None:
+        raise XmpFastPathError("No xmp packet")
+    return packet
+
+
+def parse_xmp_packet(packet: bytes):
+    """Parse a serialized xmp packet and return an XmpRecord, or None if the
+    packet has no properties at all (like file_to_dict() returning an empty
+    dict). Properties may be in attribute form (xmp:Rating="3" on
+    rdf:Description) or element form (<xmp:Rating>3</xmp:Rating>). Raise
+    XmpFastPathError if the packet can't be parsed, or refers to extended
+    xmp."""
+    try:
+        root = ET.fromstring(packet)
+    except ET.ParseError as err:
+        raise XmpFastPathError(f"Malformed xmp packet: {err}") from err
+    values = {}
+    has_props = False
+    rdf_about = f"{{{NS_RDF}}}about"
+    has_extended = f"{{{NS_XMP_NOTE}}}HasExtendedXMP"
+    for desc in root.iter(f"{{{NS_RDF}}}Description"):
+        # Properties in attribute form, then in element form
+        props = [(name, value) for name, value in desc.attrib.items() if name != rdf_about]
+        props.extend((child.tag, child.text) for child in desc)
+        for name, value in props:
+            has_props = True
+            if name == has_extended:
+                raise XmpFastPathError("Extended xmp")
+            field = XMP_RECORD_TAGS.get(name)
+            if field is not None:
+                values.setdefault(field, value or "")
+    if not has_props:
+        return None
+    return make_xmp_record(values)
+
+
+# Fast path for xmp embedded in TIFF based files, which most camera raw
+# formats are. The xmp packet is the value of tag 700 (XMLPacket) in an image
+# file directory (IFD), normally IFD0, so only the header, the directories,
+# and the packet itself are read, each with one pread(), however big the
+# file is. Olympus (ORF) and Panasonic (RW2) use their own magic numbers in an
+# otherwise standard TIFF header. CR3, RAF, and the like aren't TIFF, and are
+# read with Exempi.
+TIFF_SUFFIXES = frozenset(
+    ".tif .tiff .dng .nef .nrw .cr2 .arw .srf .sr2 .orf .rw2 .pef .srw .3fr .iiq .erf .mef "
+    ".mos .kdc .dcr .rwl".split()
+)
+# Byte order mark: (struct byte order, magic numbers)
+TIFF_BYTE_ORDERS = {b"II": ("<", (42, 0x4F52, 0x55)), b"MM": (">", (42, 0x4F52))}
+TIFF_TAG_XMP = 700
+# TIFF field types a packet can be stored as (BYTE, ASCII, UNDEFINED), all
+# one byte per value
+TIFF_BYTE_TYPES = (1, 2, 7)
+# Most IFDs in a chain, in case of a loop or a corrupt offset
+TIFF_MAX_IFDS = 16
+
+
+def read_tiff_xmp_packet(fname: str):
+    """Return the xmp packet embedded in a TIFF based file (TIFF, DNG, NEF,
+    CR2, ARW, etc.) as bytes.
+
+    Walk the IFD chain from the header, reading each directory whole, until
+    one has tag 700, then read just that byte range. Raise XmpFastPathError
+    if the file isn't TIFF based (or is BigTIFF), has no xmp packet, or is
+    malformed."""
+    fd = os.open(fname, os.O_RDONLY)
+    try:
+        header = os.pread(fd, 8, 0)
+        if len(header) < 8 or header[:2] not in TIFF_BYTE_ORDERS:
+            raise XmpFastPathError("Not a TIFF file")
+        order, magics = TIFF_BYTE_ORDERS[header[:2]]
+        magic, offset = struct.unpack(order + "HI", header[2:])
+        if magic not in magics:
+            raise XmpFastPathError("Not a TIFF file")
+        seen = set()
+        while offset and len(seen) < TIFF_MAX_IFDS:
+            if offset in seen:
+                raise XmpFastPathError("TIFF IFD loop")
+            seen.add(offset)
+            count_bytes = os.pread(fd, 2, offset)
+            if len(count_bytes) < 2:
+                raise XmpFastPathError("Truncated TIFF IFD")
+            (count,) = struct.unpack(order + "H", count_bytes)
+            # The entries (12 bytes each) and the offset of the next IFD
+            ifd = os.pread(fd, count * 12 + 4, offset + 2)
+            if len(ifd) < count * 12 + 4:
+                raise XmpFastPathError("Truncated TIFF IFD")
+            for entry in range(count):
+                tag, field_type, length = struct.unpack_from(order + "HHI", ifd, entry * 12)
+                if tag != TIFF_TAG_XMP:
+                    continue
+                if field_type not in TIFF_BYTE_TYPES:
+                    raise XmpFastPathError("Bad TIFF XMLPacket type")
+                if length <= 4:
+                    packet = ifd[entry * 12 + 8 : entry * 12 + 8 + length]
+                else:
+                    (value_offset,) = struct.unpack_from(order + "I", ifd, entry * 12 + 8)
+                    packet = os.pread(fd, length, value_offset)
+                    if len(packet) < length:
+                        raise XmpFastPathError("Truncated TIFF XMLPacket")
+                # Some writers pad the packet with NULs
+                return packet.rstrip(b"\x00")
+            (offset,) = struct.unpack_from(order + "I", ifd, count * 12)
+    finally:
+        os.close(fd)
+    raise XmpFastPathError("No xmp packet")
+
+
+# Fast path for xmp sidecars. Sidecars written by editors carry develop
+# settings, history, and masks (often hundreds of KB), but the properties
+# photoPhav reads are usually attributes of the first rdf:Description. The
+# sidecar is fed to an incremental parser a chunk at a time, and reading stops
+# once the fields needed are found (by default SIDECAR_DONE_FIELDS, all of
+# them, or those a filter uses, see filter_fields()), or at the end of the
+# rdf:Description elements. (digiKam:PickLabel only counts without
+# xmpDM:pick, so it isn't needed to stop.)
+SIDECAR_CHUNK = 16384
+SIDECAR_DONE_FIELDS = frozenset(("rating", "label", "pick"))
+XMP_ROOT_TAGS = ("{adobe:ns:meta/}xmpmeta", f"{{{NS_RDF}}}RDF")
+XML_NS_PREFIX = "{http://www.w3.org/XML/1998/namespace}"
+
+
+def read_xmp_sidecar(fname: str, fields=SIDECAR_DONE_FIELDS):
+    """Stream-parse an xmp sidecar file and return an XmpRecord, or None if it
+    has no properties at all (like file_to_dict() returning an empty dict).
+    Reading stops once the given fields (of XMP_RECORD_PROPS) are found, so
+    the others may be left at their defaults.
+
+    Only the top level properties (attributes and child elements of the
+    rdf:Description elements in rdf:RDF) are looked at, in attribute form
+    (xmp:Rating="3") or element form (<xmp:Rating>3</xmp:Rating>), and the
+    first value of a field wins, as with Exempi. Parsed elements are
+    cleared as they end, so memory stays small however big the sidecar is.
+
+    Raise XmpFastPathError if the structure isn't recognized (the root isn't
+    x:xmpmeta or rdf:RDF, a field isn't a simple value, extended xmp, or
+    malformed xml), so Exempi can read it instead."""
+    parser = ET.XMLPullParser(events=("start", "end"))
+    values = {}
+    has_props = False
+    # Tags of the open elements, and the depth of the open top level
+    # rdf:Description (None if there isn't one)
+    stack = []
+    desc_depth = None
+    desc_tag = f"{{{NS_RDF}}}Description"
+    has_extended = f"{{{NS_XMP_NOTE}}}HasExtendedXMP"
+    rdf_tag = XMP_ROOT_TAGS[1]
+    done = False
+    with open(fname, "rb") as xmp_file:
+        while not done and not fields <= values.keys():
+            chunk = xmp_file.read(SIDECAR_CHUNK)
+            try:
+                if chunk:
+                    parser.feed(chunk)
+                else:
+                    parser.close()
+                events = list(parser.read_events())
+            except ET.ParseError as err:
+                raise XmpFastPathError(f"Malformed xmp: {err}") from err
+            for event, elem in events:
+                if event == "start":
+                    if not stack and elem.tag not in XMP_ROOT_TAGS:
+                        raise XmpFastPathError(f"Unknown xmp root {elem.tag}")
+                    stack.append(elem.tag)
+                    if (
+                        elem.tag == desc_tag
+                        and desc_depth is None
+                        and stack[-2:-1] == [XMP_ROOT_TAGS[1]]
+                    ):
+                        desc_depth = len(stack)
+                        for name, value in elem.attrib.items():
+                            if name.startswith((f"{{{NS_RDF}}}", XML_NS_PREFIX)):
+                                continue
+                            has_props = True
+                            if name == has_extended:
+                                raise XmpFastPathError("Extended xmp")
+                            field = XMP_RECORD_TAGS.get(name)
+                            if field is not None:
+                                values.setdefault(field, value)
+                    continue
+                # end
+                if desc_depth is not None and len(stack) == desc_depth + 1:
+                    # A property element of the top level rdf:Description
+                    has_props = True
+                    if elem.tag == has_extended:
+                        raise XmpFastPathError("Extended xmp")
+                    field = XMP_RECORD_TAGS.get(elem.tag)
+                    if field is not None:
+                        if len(elem) or elem.attrib:
+                            raise XmpFastPathError(f"{elem.tag} is not a simple value")
+                        values.setdefault(field, elem.text or "")
+                elif len(stack) == desc_depth:
+                    desc_depth = None
+                elif elem.tag == rdf_tag and len(stack) <= 2:
+                    # The end of the top level rdf:Description elements
+                    done = True
+                    break
+                stack.pop()
+                elem.clear()
+            if not chunk:
+                break
+    if not has_props:
+        return None
+    return make_xmp_record(values)
+
+
+# libxmp's file_to_dict(), once loaded
+_file_to_dict = None
+
+
+def load_file_to_dict():
+    """Import libxmp, which loads Exempi, the first time it is needed, and
+    return its file_to_dict() function."""
+    global _file_to_dict
+    if _file_to_dict is None:
+        from libxmp.utils import file_to_dict  # pylint: disable=import-outside-toplevel
+
+        _file_to_dict = file_to_dict
+    return _file_to_dict
+
+
+def read_xmp_record(fname: str, fields=SIDECAR_DONE_FIELDS):
+    """Read the xmp data in a file (sidecar or image). Return an XmpRecord, or
+    None if the file has no xmp data or can't be read. A file with xmp data,
+    but no rating, gives a rating of 0. A sidecar is only read until it has
+    the given fields (see read_xmp_sidecar()).
+
+    JPEG and TIFF based (including most raw) files are read with fast paths
+    that only read the xmp packet, and sidecars with one that stops reading
+    once it has the fields. Anything else, or a file a fast path can't
+    handle, is read with Exempi."""
+    suffix = os.path.splitext(fname)[1].lower()
+    if suffix in JPEG_SUFFIXES:
+        try:
+            return parse_xmp_packet(read_jpeg_xmp_packet(fname))
+        except (XmpFastPathError, OSError):
+            pass
+    elif suffix in TIFF_SUFFIXES:
+        try:
+            return parse_xmp_packet(read_tiff_xmp_packet(fname))
+        except (XmpFastPathError, OSError):
+            pass
+    elif suffix == ".xmp":
+        try:
+            return read_xmp_sidecar(fname, fields)
+        except (XmpFastPathError, OSError):
+            pass
+    return read_xmp_exempi(fname)
+
+
+def read_xmp_exempi(fname: str):
+    """Read the xmp data in a file with Exempi. Same return value as
+    read_xmp_record(), which uses this when no fast path applies."""
+    # Not inside the try, so a missing libxmp or Exempi is reported
+    file_to_dict = load_file_to_dict()
+    try:
+        dict_xmp = file_to_dict(fname)
+    except Exception:
+        return None
+    return xmp_dict_record(dict_xmp)
+
+
+def xmp_dict_record(dict_xmp: dict):
+    """Return the XmpRecord for the xmp data as given by file_to_dict(), or
+    None if there is none."""
+    if not dict_xmp:
+        return None
+    # file_to_dict() gives {namespace: [(prefix:name, value, options), ...]}
+    values = {}
+    for ns, props in dict_xmp.items():
+        for name, value, _ in props:
+            field = XMP_RECORD_PROPS.get((ns, name.rpartition(":")[2]))
+            if field is not None:
+                values.setdefault(field, value)
+    return make_xmp_record(values)
+
+
+def read_xmp_uncached(fname: str, source: str):
+    """Reader with the same signature as MetadataCache.read(), for when there
+    is no cache. The source kind is not needed."""
+    return read_xmp_record(fname)
+
+
+def record_reader(fields=SIDECAR_DONE_FIELDS, cache=None):
+    """Return the read(fname, source) function for select_record(): the
+    cache's, which keeps whole records for later runs, or without a cache, one
+    that reads sidecars only until they have the given fields."""
+    if cache is not None:
+        return cache.read
+    if fields == SIDECAR_DONE_FIELDS:
+        return read_xmp_uncached
+    return lambda fname, source: read_xmp_record(fname, fields)
+
+
+# Which metadata source of an image with a sidecar is read first (--prefer).
+# The other is only read if the first has no xmp data.
+PREFER_SIDECAR = "sidecar"
+PREFER_EMBEDDED = "embedded"
+PREFER_NEWEST = "newest"
+PREFER_POLICIES = (PREFER_SIDECAR, PREFER_EMBEDDED, PREFER_NEWEST)
+
+
+def source_order(ifn: str, ifx, options, scan_stats=None):
+    """Return the metadata sources to try for an image file, in order, as
+    (file name, source) pairs. See select_record().
+
+    PREFER_NEWEST decides from the stat data alone: the sidecar comes first
+    unless the image was modified after it, and an empty sidecar is left
+    out, so only one file is parsed unless the first has no xmp data. The
+    stat data is scan_stats, the (image, sidecar) stat results taken during
+    the scan (see pair_sidecars()), and is only read here without them."""
+    if options.ignore_xmp:
+        ifx = None
+    if options.ignore_file:
+        return [(ifx, SOURCE_SIDECAR)] if ifx else []
+    if not ifx:
+        return [(ifn, SOURCE_EMBEDDED)]
+    sidecar_first = [(ifx, SOURCE_SIDECAR), (ifn, SOURCE_EMBEDDED)]
+    if options.prefer == PREFER_EMBEDDED:
+        return sidecar_first[::-1]
+    if options.prefer != PREFER_NEWEST:
+        return sidecar_first
+    if scan_stats is None:
+        try:
+            scan_stats = (os.stat(ifn), os.stat(ifx))
+        except OSError:
+            return sidecar_first
+    image_st, xmp_st = scan_stats
+    if xmp_st.st_size == 0:
+        return [(ifn, SOURCE_EMBEDDED)]
+    if image_st.st_mtime_ns > xmp_st.st_mtime_ns:
+        return sidecar_first[::-1]
+    return sidecar_first
+
+
+def select_record(ifn: str, ifx, options, read=read_xmp_uncached, stats=None, scan_stats=None):
+    """Choose which metadata source to use for an image file and read it.
+
+    ifn is the image file name, and ifx is the xmp sidecar file name, or None
+    if there isn't one. scan_stats are their stat results from the scan, if
+    any (see source_order()). options needs the prefer, ignore_file, and ignore_xmp
+    attributes (e.g. a SelectOptions). read(fname, source) reads one file and
+    returns an XmpRecord or None.
+
+    The source preferred by options.prefer (see source_order()) is read
+    first, and the other only if the first has no xmp data. Such second
+    reads are counted as fallback_reads in stats (a RunStats), if given.
+
+    Return (record, source), where source is SOURCE_SIDECAR or SOURCE_EMBEDDED
+    depending on where the record came from. Return (None, None) if no xmp
+    data was found."""
+    for attempt, (fname, source) in enumerate(source_order(ifn, ifx, options, scan_stats)):
+        if attempt and stats is not None:
+            stats.count("fallback_reads")
+        record = read(fname, source)
+        if record:
+            return record, source
+    return None, None
+
+
+# Filter expressions select the favorites from the metadata records, e.g.
+# 'Rating >= 4 or Label in {Red, Green}' or 'pick and not Label == Blue'.
+# Grammar, lowest precedence first. Keywords and field names are not case
+# sensitive:
+#   expr       := and_expr ('or' and_expr)*
+#   and_expr   := not_expr ('and' not_expr)*
+#   not_expr   := 'not' not_expr | '(' expr ')' | 'pick' | 'reject' | comparison
+#   comparison := field op value | field ['not'] 'in' '{' value (',' value)* '}'
+#   field      := 'Rating' | 'Label' | 'Pick'
+#   op         := '==' | '=' | '!=' | '<' | '<=' | '>' | '>='
+# Rating and Pick values are integers. Label values are names or quoted
+# strings, compared without regard to case, and Label only allows ==, !=, and
+# in.
+FILTER_FIELDS = ("rating", "label", "pick")
+# The xmp fields (of XMP_RECORD_PROPS) each filter field is made from. A
+# rating of -1 is a reject without a pick flag.
+FILTER_XMP_FIELDS = {"rating": ("rating",), "label": ("label",), "pick": ("pick", "rating")}
+FILTER_TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<num>[-+]?\d+)
+        |(?P<op>==|!=|<=|>=|[=<>(){},])
+        |(?P<word>[^\W\d][\w-]*)
+        |(?P<str>"[^"]*"|'[^']*')
+    )""",
+    re.VERBOSE,
+)
+FILTER_COMPARE = {
+    "==": lambda a, b: a == b,
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+class FilterExpressionError(ValueError):
+    """A filter expression can't be parsed."""
+
+
+class _FilterParser:
+    """Recursive descent parser for filter expressions. parse() returns a
+    predicate function taking an XmpRecord and returning a bool, built out of
+    closures, so evaluating it does no parsing or lookups by name."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = []  # (kind, value, position)
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = FILTER_TOKEN_RE.match(text, pos)
+            if match is None or match.end() == pos:
+                raise FilterExpressionError(
+                    f"Unexpected character at position {pos + 1} in '{self.text}'"
+                )
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "str":
+                value = value[1:-1]
+            self.tokens.append((kind, value, match.start(kind)))
+            pos = match.end()
+        self.index = 0
+        self.fields = set()  # of FILTER_FIELDS, the ones used
+
+    def _error(self, message: str):
+        """Raise a FilterExpressionError about the current token."""
+        if self.index < len(self.tokens):
+            _, value, pos = self.tokens[self.index]
+            where = f"'{value}' at position {pos + 1}"
+        else:
+            where = "the end"
+        raise FilterExpressionError(f"{message}, found {where} in '{self.text}'")
+
+    def _peek(self):
+        """Return the current (kind, value) token, or (None, None) at the end."""
+        if self.index < len(self.tokens):
+            return self.tokens[self.index][:2]
+        return None, None
+
+    def _peek_word(self):
+        """Return the current token, lower case, if it is a word, or None."""
+        kind, value = self._peek()
+        return value.lower() if kind == "word" else None
+
+    def _expect(self, op: str):
+        """Consume the operator or punctuation op."""
+        if self._peek() != ("op", op):
+            self._error(f"Expected '{op}'")
+        self.index += 1
+
+    def parse(self):
+        """Parse the whole expression and return the predicate."""
+        if not self.tokens:
+            raise FilterExpressionError("Empty filter expression")
+        predicate = self._or_expr()
+        if self.index < len(self.tokens):
+            self._error("Expected 'and', 'or', or the end")
+        return predicate
+
+    def _or_expr(self):
+        terms = [self._and_expr()]
+        while self._peek_word() == "or":
+            self.index += 1
+            terms.append(self._and_expr())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda record: any(term(record) for term in terms)
+
+    def _and_expr(self):
+        terms = [self._not_expr()]
+        while self._peek_word() == "and":
+            self.index += 1
+            terms.append(self._not_expr())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda record: all(term(record) for term in terms)
+
+    def _not_expr(self):
+        word = self._peek_word()
+        if word == "not":
+            self.index += 1
+            term = self._not_expr()
+            return lambda record: not term(record)
+        if self._peek() == ("op", "("):
+            self.index += 1
+            term = self._or_expr()
+            self._expect(")")
+            return term
+        if word in ("pick", "reject"):
+            # A bare flag, unless Pick is being compared
+            self.index += 1
+            kind, value = self._peek()
+            compared = kind == "op" and value in FILTER_COMPARE
+            if word == "pick" and (compared or self._peek_word() in ("in", "not")):
+                self.index -= 1
+            else:
+                self.fields.add("pick")
+                wanted = PICK_PICKED if word == "pick" else PICK_REJECTED
+                return lambda record: record.pick == wanted
+        return self._comparison()
+
+    def _value(self, field: str):
+        """Consume a value for field, and return it converted."""
+        kind, value = self._peek()
+        if field == "label":
+            if kind not in ("word", "str", "num"):
+                self._error("Expected a label")
+            self.index += 1
+            return value.casefold()
+        if kind != "num":
+            self._error(f"Expected a number for {field.capitalize()}")
+        self.index += 1
+        return int(value)
+
+    def _comparison(self):
+        field = self._peek_word()
+        if field not in FILTER_FIELDS:
+            self._error("Expected Rating, Label, Pick, pick, reject, 'not', or '('")
+        self.fields.add(field)
+        self.index += 1
+        negate = False
+        if self._peek_word() == "not":
+            negate = True
+            self.index += 1
+            if self._peek_word() != "in":
+                self._error("Expected 'in'")
+        if self._peek_word() == "in":
+            self.index += 1
+            self._expect("{")
+            values = {self._value(field)}
+            while self._peek() == ("op", ","):
+                self.index += 1
+                values.add(self._value(field))
+            self._expect("}")
+            values = frozenset(values)
+            if field == "label":
+                return lambda record: (record.label.casefold() in values) != negate
+            return lambda record: (getattr(record, field) in values) != negate
+        kind, op = self._peek()
+        if kind != "op" or op not in FILTER_COMPARE:
+            self._error("Expected a comparison operator or 'in'")
+        if field == "label" and op not in ("==", "=", "!="):
+            self._error("Label can only be compared with ==, !=, or in")
+        self.index += 1
+        compare = FILTER_COMPARE[op]
+        value = self._value(field)
+        if field == "label":
+            return lambda record: compare(record.label.casefold(), value)
+        return lambda record: compare(getattr(record, field), value)
+
+
+def compile_filter(text: str):
+    """Parse a filter expression once, and return a predicate function that
+    takes an XmpRecord and returns True if it matches. Raise
+    FilterExpressionError if the expression is not valid."""
+    return _FilterParser(text).parse()
+
+
+def filter_fields(expressions):
+    """Return the xmp fields (of XMP_RECORD_PROPS) the given filter
+    expressions use, as a frozenset for read_xmp_sidecar(). Raise
+    FilterExpressionError if an expression is not valid."""
+    fields = set()
+    for text in expressions:
+        parser = _FilterParser(text)
+        parser.parse()
+        for field in parser.fields:
+            fields.update(FILTER_XMP_FIELDS[field])
+    return frozenset(fields)
+
+
+class LinkRule(NamedTuple):
+    """A destination directory, and the filter expression that selects the
+    images linked into it."""
+
+    dest_dir: str
+    expression: str
+
+
+def parse_rule(text: str):
+    """Parse a rule given as DEST=EXPRESSION, e.g. '5-star=Rating == 5', and
+    return a LinkRule. The destination ends at the first '='. Raise
+    FilterExpressionError if the rule or its expression is not valid."""
+    dest_dir, sep, expression = text.partition("=")
+    if not sep or not dest_dir.strip() or not expression.strip():
+        raise FilterExpressionError(f"Rule '{text}' is not DEST=EXPRESSION")
+    rule = LinkRule(dest_dir.strip(), expression.strip())
+    compile_filter(rule.expression)
+    return rule
+
+
+def read_rules_file(fname: str):
+    """Read rules from a file, one DEST=EXPRESSION rule per line, and return
+    them as a list of LinkRule. Blank lines and lines starting with '#' are
+    ignored. Raise FilterExpressionError (naming the line) if a rule is not
+    valid, or OSError if the file can't be read."""
+    rules = []
+    with open(fname, encoding="utf-8") as rules_file:
+        for line_num, line in enumerate(rules_file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                rules.append(parse_rule(line))
+            except FilterExpressionError as err:
+                raise FilterExpressionError(f"{fname}, line {line_num}: {err}") from err
+    return rules
+
+
+def default_cache_path():
+    """Return the default metadata cache location, in the user cache dir."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "photoPhav", "metadata.sqlite3")
+
+
+class MetadataCache:
+    """Persistent (SQLite) cache of the metadata read from each file, so files
+    that have not changed since the last run are not parsed again.
+
+    Entries are keyed on the absolute file path, and are only valid if the
+    size, modification time (ns) and inode still match. Files without xmp data
+    get negative entries, so they are not parsed again either. The source
+    column records whether the file was read as a sidecar or as an image with
+    embedded data.
+
+    The hits, misses and stale counters show how well the cache is working.
+    Stale entries are counted as misses too."""
+
+    # Commit after this many new entries so an interrupted run keeps most of
+    # its work.
+    COMMIT_EVERY = 1000
+    # Bumped when the table changes. An older cache is emptied and rebuilt.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, db_path: str, deferred: bool = False):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._pending = 0
+        # In deferred mode (used by worker processes) the database is opened
+        # read-only, and new entries are collected in the deferred list to be
+        # stored by the process that owns the cache.
+        self.deferred = [] if deferred else None
+        if deferred:
+            self._conn = sqlite3.connect(
+                Path(os.path.abspath(db_path)).as_uri() + "?mode=ro", uri=True
+            )
+            return
+        parent = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(parent, exist_ok=True)
+        self._conn = sqlite3.connect(db_path)
+        # WAL lets readers (e.g. other runs) work while this run writes
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self._conn.execute("DROP TABLE IF EXISTS xmp_cache")
+            self._conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS xmp_cache (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                source TEXT NOT NULL,
+                has_xmp INTEGER NOT NULL,
+                rating INTEGER,
+                label TEXT,
+                pick INTEGER
+            )"""
+        )
+        self._conn.commit()
+
+    def lookup(self, fname: str, st: os.stat_result):
+        """Look up a file given its stat result. Return (hit, record), where
+        record is None for a negative entry (file has no xmp data)."""
+        row = self._conn.execute(
+            "SELECT size, mtime_ns, inode, has_xmp, rating, label, pick \
+FROM xmp_cache WHERE path = ?",
+            (os.path.abspath(fname),),
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        if row[0:3] != (st.st_size, st.st_mtime_ns, st.st_ino):
+            # The file has changed since it was cached
+            self.stale += 1
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        if not row[3]:
+            return True, None
+        return True, XmpRecord(*row[4:7])
+
+    def store(self, fname: str, st: os.stat_result, source: str, record):
+        """Add or replace the entry for a file. A record of None makes a
+        negative entry."""
+        if self.deferred is not None:
+            self.deferred.append((fname, st, source, record))
+            return
+        if record is None:
+            values = (0, None, None, None)
+        else:
+            values = (1,) + tuple(record)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO xmp_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                os.path.abspath(fname),
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_ino,
+                source,
+            )
+            + values,
+        )
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    def read(self, fname: str, source: str, reader=read_xmp_record):
+        """Return the record for a file from the cache if it is current, or
+        read it with reader() and cache the result. Same signature and return
+        value as read_xmp_uncached()."""
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        hit, record = self.lookup(fname, st)
+        if hit:
+            return record
+        record = reader(fname)
+        self.store(fname, st, source, record)
+        return record
+
+    def commit(self):
+        """Commit pending entries."""
+        if self.deferred is None:
+            self._conn.commit()
+            self._pending = 0
+
+    def prune(self):
+        """Remove entries for files that no longer exist or have changed.
+        Return the number of entries removed."""
+        stale_paths = []
+        for path, size, mtime_ns, inode in self._conn.execute(
+            "SELECT path, size, mtime_ns, inode FROM xmp_cache"
+        ).fetchall():
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale_paths.append((path,))
+                continue
+            if (size, mtime_ns, inode) != (st.st_size, st.st_mtime_ns, st.st_ino):
+                stale_paths.append((path,))
+        self._conn.executemany("DELETE FROM xmp_cache WHERE path = ?", stale_paths)
+        self._conn.commit()
+        return len(stale_paths)
+
+    def clear(self):
+        """Remove all entries. Return the number of entries removed."""
+        count = self._conn.execute("DELETE FROM xmp_cache").rowcount
+        self._conn.commit()
+        return count
+
+    def merge_counts(self, counts: tuple):
+        """Add (hits, misses, stale) counts, e.g. from a worker process."""
+        self.hits += counts[0]
+        self.misses += counts[1]
+        self.stale += counts[2]
+
+    def take_counts(self):
+        """Return the (hits, misses, stale) counts and reset them."""
+        counts = (self.hits, self.misses, self.stale)
+        self.hits = self.misses = self.stale = 0
+        return counts
+
+    def close(self):
+        """Commit any pending entries and close the database."""
+        if self.deferred is None:
+            self._conn.commit()
+        self._conn.close()
+
+
+# Photo manager library databases (--library). darktable keeps its ratings in
+# library.db: the rating is the low 3 bits of images.flags (6 is rejected in
+# old versions, and flag 8 is rejected in newer ones), and color labels are
+# rows of color_labels. digiKam keeps them in digikam4.db: the rating (-1 for
+# none) is in ImageInformation, and color and pick labels are tags with a
+# colorLabel or pickLabel property.
+DARKTABLE_LABELS = ("Red", "Yellow", "Green", "Blue", "Purple")
+DARKTABLE_RATING_MASK = 0x7
+DARKTABLE_RATING_REJECTED = 6
+DARKTABLE_FLAG_REJECTED = 0x8
+DIGIKAM_LABELS = (
+    "", "Red", "Orange", "Yellow", "Green", "Blue", "Magenta", "Gray", "Black", "White"
+)
+DIGIKAM_PICKS = {1: PICK_REJECTED, 3: PICK_PICKED}
+DARKTABLE_QUERY = """SELECT f.folder, i.filename, i.flags,
+    (SELECT MIN(c.color) FROM color_labels c WHERE c.imgid = i.id)
+    FROM images i JOIN film_rolls f ON i.film_id = f.id"""
+DIGIKAM_QUERY = """SELECT r.identifier, r.specificPath, a.relativePath, i.name, ii.rating,
+    (SELECT MIN(CAST(tp.value AS INTEGER)) FROM ImageTags it JOIN TagProperties tp
+        ON tp.tagid = it.tagid WHERE it.imageid = i.id AND tp.property = 'colorLabel'
+        AND tp.value != '0'),
+    (SELECT MAX(CAST(tp.value AS INTEGER)) FROM ImageTags it JOIN TagProperties tp
+        ON tp.tagid = it.tagid WHERE it.imageid = i.id AND tp.property = 'pickLabel')
+    FROM Images i JOIN Albums a ON i.album = a.id JOIN AlbumRoots r ON a.albumRoot = r.id
+    LEFT JOIN ImageInformation ii ON ii.imageid = i.id
+    WHERE i.status = 1"""
+
+
+class LibraryError(Exception):
+    """A library database can't be read."""
+
+
+class RatingsLibrary:
+    """The ratings, color labels, and pick status of the images under the
+    source directory, read from a darktable or digiKam library database with
+    one query, so those images need no xmp reads at all.
+
+    Records are keyed by the image path relative to the source directory
+    (resolved), and identical records are shared, so memory is a dict entry
+    per image. The library knowing an image is what counts: an image with no
+    rating or label in the library gets a record of rating 0 and no label,
+    rather than falling back to the files. lookup() returns None for images
+    the library doesn't know, which are read as usual."""
+
+    def __init__(self, db_path: str, src_dir: str):
+        self.db_path = db_path
+        self.src_prefix = source_prefix(src_dir)
+        self.hits = 0
+        self.misses = 0
+        self.records = {}
+        root = os.path.realpath(src_dir).rstrip("/") + "/"
+        try:
+            conn = sqlite3.connect(Path(os.path.abspath(db_path)).as_uri() + "?mode=ro", uri=True)
+        except sqlite3.Error as err:
+            raise LibraryError(f"Can't open {db_path}: {err}") from err
+        try:
+            tables = {
+                row[0].lower()
+                for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            }
+            if {"images", "film_rolls", "color_labels"} <= tables:
+                self.kind = "darktable"
+                rows = self._darktable_rows(conn)
+            elif {"images", "albums", "albumroots", "imageinformation"} <= tables:
+                self.kind = "digiKam"
+                rows = self._digikam_rows(conn)
+            else:
+                raise LibraryError(f"{db_path} is not a darktable or digiKam library")
+            shared = {}
+            for path, record in rows:
+                if path.startswith(root):
+                    self.records[path[len(root) :]] = shared.setdefault(record, record)
+        except sqlite3.Error as err:
+            raise LibraryError(f"Can't read {db_path}: {err}") from err
+        finally:
+            conn.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    @staticmethod
+    def _darktable_rows(conn):
+        """Generate (image path, XmpRecord) from a darktable library."""
+        for folder, name, flags, color in conn.execute(DARKTABLE_QUERY):
+            flags = flags or 0
+            rating = flags & DARKTABLE_RATING_MASK
+            pick = PICK_NONE
+            if rating == DARKTABLE_RATING_REJECTED or flags & DARKTABLE_FLAG_REJECTED:
+                # Written to xmp as a rating of -1
+                rating = -1
+                pick = PICK_REJECTED
+            label = ""
+            if color is not None and 0 <= color < len(DARKTABLE_LABELS):
+                label = DARKTABLE_LABELS[color]
+            yield folder.rstrip("/") + "/" + name, XmpRecord(min(rating, 5), label, pick)
+
+    @staticmethod
+    def _digikam_rows(conn):
+        """Generate (image path, XmpRecord) from a digiKam library. The album
+        root is the path in the identifier ('volumeid:?path=...') if there is
+        one, else its specific path, which is right for roots on the root
+        file system."""
+        # pylint: disable-next=import-outside-toplevel
+        from urllib.parse import parse_qs, urlsplit
+
+        roots = {}
+        for identifier, specific_path, rel_dir, name, rating, color, pick_label in conn.execute(
+            DIGIKAM_QUERY
+        ):
+            root = roots.get((identifier, specific_path))
+            if root is None:
+                query = parse_qs(urlsplit(identifier or "").query)
+                root = query["path"][0] if "path" in query else specific_path or ""
+                root = roots[(identifier, specific_path)] = root.rstrip("/")
+            label = ""
+            if color is not None and 0 <= color < len(DIGIKAM_LABELS):
+                label = DIGIKAM_LABELS[color]
+            record = XmpRecord(
+                max(rating or 0, 0), label, DIGIKAM_PICKS.get(pick_label, PICK_NONE)
+            )
+            yield root + (rel_dir or "/").rstrip("/") + "/" + name, record
+
+    def lookup(self, fname: str):
+        """Return the record for a file from scan_dir(), or None if the library
+        doesn't know it."""
+        record = self.records.get(fname[len(self.src_prefix) :])
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+
+# Ratings catalog. A catalog lists every file of a run with its metadata, so
+# other tools can use the ratings without reading any xmp, and favorites can
+# be (re)built from it with --from_catalog.
+CATALOG_VERSION = 1
+# Catalog files with these suffixes are written as SQLite databases. Anything
+# else is JSON lines.
+CATALOG_SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+class CatalogError(Exception):
+    """A catalog can't be read."""
+
+
+class CatalogWriter:
+    """Writes a ratings catalog of the files of a run, a row at a time, as
+    they are read.
+
+    Each row has the file path relative to the source directory, the rating,
+    label, and pick status (all None if the file has no xmp data), the source
+    of the metadata (SOURCE_SIDECAR or SOURCE_EMBEDDED, or None), and the
+    modification time of the image in ns. The absolute source directory is
+    recorded once, in a JSON header line or the catalog_info table, along
+    with the Shard (e.g. '2/4' and 'dir') for a sharded run.
+
+    The catalog is written to a temporary file, which replaces the catalog
+    when it is closed, so an interrupted run leaves the previous catalog in
+    place."""
+
+    def __init__(self, path: str, src_dir: str, shard=None):
+        self.path = path
+        self.rows = 0
+        self._src_prefix = source_prefix(src_dir)
+        self._tmp_path = path + ".tmp"
+        self._sqlite = path.lower().endswith(CATALOG_SQLITE_SUFFIXES)
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+        info = {"version": CATALOG_VERSION, "source_dir": os.path.realpath(src_dir)}
+        if shard is not None:
+            info["shard"] = shard.label
+            info["shard_by"] = shard.by
+        if self._sqlite:
+            self._file = None
+            self._conn = sqlite3.connect(self._tmp_path)
+            self._conn.execute("CREATE TABLE catalog_info (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.executemany("INSERT INTO catalog_info VALUES (?, ?)", info.items())
+            self._conn.execute(
+                """CREATE TABLE files (
+                    path TEXT PRIMARY KEY,
+                    rating INTEGER,
+                    label TEXT,
+                    pick INTEGER,
+                    source TEXT,
+                    mtime_ns INTEGER
+                )"""
+            )
+        else:
+            self._conn = None
+            # pylint: disable-next=consider-using-with
+            self._file = open(self._tmp_path, "w", encoding="utf-8")
+            self._file.write(json.dumps({"photoPhav_catalog": info}) + "\n")
+
+    def add(self, fname: str, record, source, mtime_ns):
+        """Add the row for a file (as from scan_dir()), its metadata record
+        (None if it has no xmp data) and source, and its modification time in
+        ns (see image_mtime_ns())."""
+        rating = label = pick = None
+        if record is not None:
+            rating, label, pick = record
+        rel_path = fname[len(self._src_prefix) :]
+        if self._conn is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (rel_path, rating, label, pick, source, mtime_ns),
+            )
+        else:
+            self._file.write(
+                json.dumps(
+                    {
+                        "path": rel_path,
+                        "rating": rating,
+                        "label": label,
+                        "pick": pick,
+                        "source": source,
+                        "mtime_ns": mtime_ns,
+                    }
+                )
+                + "\n"
+            )
+        self.rows += 1
+
+    def close(self):
+        """Finish the catalog, and put it in place."""
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+        else:
+            self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+
+def read_catalog(path: str):
+    """Open a ratings catalog written by CatalogWriter, JSON lines or SQLite
+    (told apart by the file header, not the name). Return (source_dir, shard,
+    rows), where shard is the Shard of a sharded run (or None), and rows
+    generates (relative path, XmpRecord or None, source) for each file,
+    reading the catalog as it goes. Raise CatalogError if the file is not a
+    catalog photoPhav can read, or OSError if it can't be opened."""
+    with open(path, "rb") as cfile:
+        is_sqlite = cfile.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    if is_sqlite:
+        return _read_catalog_sqlite(path)
+    return _read_catalog_jsonl(path)
+
+
+def merge_catalogs(paths: list):
+    """Open catalogs with read_catalog(), one, or those of all the shards of
+    a sharded run, to use them as one. Return (source_dir, rows), with the
+    rows of each catalog in turn. Raise CatalogError if several catalogs are
+    not from the same source directory, or are not a complete set of
+    shards."""
+    catalogs = [read_catalog(path) for path in paths]
+    source_dir = catalogs[0][0]
+    if len(catalogs) > 1:
+        shards = {}
+        for path, (catalog_source, shard, _) in zip(paths, catalogs):
+            if catalog_source != source_dir:
+                raise CatalogError(
+                    f"{path} is from {catalog_source}, not {source_dir}. Only catalogs \
+of the same source can be merged."
+                )
+            if shard is None:
+                raise CatalogError(f"{path} is not from a sharded (--shard) run.")
+            first = next(iter(shards.values()), shard)
+            if (shard.count, shard.by) != (first.count, first.by):
+                raise CatalogError(f"{path} is from a different sharding than {paths[0]}.")
+            if shard.index in shards:
+                raise CatalogError(f"Shard {shard.label} is given more than once.")
+            shards[shard.index] = shard
+        missing = [
+            Shard(index, first.count).label for index in range(first.count) if index not in shards
+        ]
+        if missing:
+            raise CatalogError(f"The catalogs of shard(s) {', '.join(missing)} are missing.")
+    return source_dir, chain.from_iterable(rows for _, _, rows in catalogs)
+
+
+def _check_catalog_info(path: str, info):
+    """Return the source directory and Shard (or None) from the catalog info,
+    or raise CatalogError."""
+    if not isinstance(info, dict) or str(info.get("version")) != str(CATALOG_VERSION):
+        raise CatalogError(f"{path} is not a photoPhav catalog (version {CATALOG_VERSION})")
+    shard = None
+    if info.get("shard"):
+        try:
+            shard = parse_shard(info["shard"], info.get("shard_by") or "dir")
+        except ValueError as err:
+            raise CatalogError(f"{path} has a bad shard: {err}") from err
+    return info["source_dir"], shard
+
+
+def _read_catalog_jsonl(path: str):
+    cfile = open(path, encoding="utf-8")  # pylint: disable=consider-using-with
+    try:
+        header = json.loads(cfile.readline() or "null")
+        source_dir, shard = _check_catalog_info(path, (header or {}).get("photoPhav_catalog"))
+    except (ValueError, AttributeError, KeyError) as err:
+        cfile.close()
+        raise CatalogError(f"{path} is not a photoPhav catalog: {err}") from err
+    except CatalogError:
+        cfile.close()
+        raise
+
+    def rows():
+        with cfile:
+            for line_num, line in enumerate(cfile, 2):
+                try:
+                    row = json.loads(line)
+                    rating = row["rating"]
+                    record = None
+                    if rating is not None:
+                        record = XmpRecord(rating, row["label"] or "", row["pick"] or PICK_NONE)
+                    yield row["path"], record, row["source"]
+                except (ValueError, KeyError, TypeError) as err:
+                    raise CatalogError(f"{path} line {line_num}: bad catalog row") from err
+
+    return source_dir, shard, rows()
+
+
+def _read_catalog_sqlite(path: str):
+    conn = sqlite3.connect(Path(os.path.abspath(path)).as_uri() + "?mode=ro", uri=True)
+    try:
+        info = dict(conn.execute("SELECT key, value FROM catalog_info").fetchall())
+        source_dir, shard = _check_catalog_info(path, info)
+    except (sqlite3.Error, KeyError) as err:
+        conn.close()
+        raise CatalogError(f"{path} is not a photoPhav catalog: {err}") from err
+    except CatalogError:
+        conn.close()
+        raise
+
+    def rows():
+        try:
+            for rel_path, rating, label, pick, source in conn.execute(
+                "SELECT path, rating, label, pick, source FROM files ORDER BY path"
+            ):
+                record = None
+                if rating is not None:
+                    record = XmpRecord(rating, label or "", pick or PICK_NONE)
+                yield rel_path, record, source
+        finally:
+            conn.close()
+
+    return source_dir, shard, rows()
+
+
+def read_io_bytes():
+    """Return the bytes this process has read so far (rchar from
+    /proc/self/io), or None where that is not available."""
+    try:
+        with open("/proc/self/io", encoding="ascii") as io_file:
+            for line in io_file:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def children_cpu_time():
+    """Return the CPU seconds used so far by this process's finished child
+    processes, or None where that is not available."""
+    try:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    except (NameError, OSError):
+        return None
+    return children.ru_utime + children.ru_stime
+
+
+class RunStats:
+    """Timing and counters for a run, for the --stats and --stats_json options.
+
+    Wall and CPU time are charged to one phase at a time. Stages are wrapped
+    with timed_iter(), and the time spent getting each item from a stage is
+    charged to that stage's phase, less the time charged to the stages it
+    pulls from, so the phases of a streaming pipeline add up to the total.
+
+    Metadata reads are timed one by one with timed_read(), giving a latency
+    histogram per source (sidecar or embedded) and the slowest files. Worker
+    processes keep their own RunStats, and their read stats are merged in
+    with merge_reads(). The statistics of the shards of a sharded run can be
+    added to the report with add_shard().
+
+    Nothing here is used unless stats are asked for, so there is no cost
+    otherwise."""
+
+    # Upper bounds of the read latency histogram buckets, in ms. The last
+    # bucket is everything slower.
+    LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, top_n: int = 10):
+        self.top_n = top_n
+        self.counters = {}
+        self.phase_wall = {}
+        self.phase_cpu = {}
+        self.reads = {}  # source -> [count, total seconds, histogram]
+        self.slowest = []  # heap of (seconds, file name, source)
+        self.bytes_read = 0
+        self._io_start = read_io_bytes()
+        self._phase = "other"
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._wall_mark = self._wall_start
+        self._cpu_mark = self._cpu_start
+        self.wall_total = 0.0
+        self.cpu_total = 0.0
+        # The number of worker processes. Their CPU time is reported, as the
+        # child CPU time since the start, only when there is more than one.
+        self.jobs = 1
+        self._children_cpu_start = children_cpu_time()
+        # The Shard label (e.g. '2/4') of a sharded run, and the stats of
+        # the shards added with add_shard()
+        self.shard = None
+        self.shards = []
+
+    def count(self, name: str, amount: int = 1):
+        """Add to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def switch(self, phase: str):
+        """Charge the time since the last switch to the current phase, and
+        make phase the current one. Return the previous phase."""
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        previous = self._phase
+        self.phase_wall[previous] = self.phase_wall.get(previous, 0.0) + wall - self._wall_mark
+        self.phase_cpu[previous] = self.phase_cpu.get(previous, 0.0) + cpu - self._cpu_mark
+        self._wall_mark = wall
+        self._cpu_mark = cpu
+        self._phase = phase
+        return previous
+
+    def timed_iter(self, phase: str, iterable):
+        """Generate the items of iterable, charging the time to get each one
+        to phase."""
+        iterator = iter(iterable)
+        while True:
+            previous = self.switch(phase)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.switch(previous)
+            yield item
+
+    def timed_read(self, read):
+        """Wrap a read(fname, source) function so each call is timed."""
+
+        def read_timed(fname: str, source: str):
+            start = time.perf_counter()
+            record = read(fname, source)
+            self.record_read(fname, source, time.perf_counter() - start)
+            return record
+
+        return read_timed
+
+    def record_read(self, fname: str, source: str, seconds: float):
+        """Record the time one metadata read took."""
+        entry = self.reads.get(source)
+        if entry is None:
+            entry = self.reads[source] = [0, 0.0, [0] * (len(self.LATENCY_BUCKETS_MS) + 1)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2][bisect_left(self.LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+        if len(self.slowest) < self.top_n:
+            heapq.heappush(self.slowest, (seconds, fname, source))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, fname, source))
+
+    def take_reads(self):
+        """Return the read stats (bytes read, and counters such as
+        fallback_reads) so far as a picklable tuple, and reset them. Used by
+        worker processes."""
+        io_now = read_io_bytes()
+        io_read = 0
+        if io_now is not None and self._io_start is not None:
+            io_read = io_now - self._io_start
+        self._io_start = io_now
+        reads = (self.reads, self.slowest, io_read, self.counters)
+        self.reads = {}
+        self.slowest = []
+        self.counters = {}
+        return reads
+
+    def merge_reads(self, reads: tuple):
+        """Add read stats from take_reads(), e.g. from a worker process."""
+        worker_reads, worker_slowest, io_read, counters = reads
+        for source, (count, seconds, histogram) in worker_reads.items():
+            entry = self.reads.get(source)
+            if entry is None:
+                entry = self.reads[source] = [0, 0.0, [0] * len(histogram)]
+            entry[0] += count
+            entry[1] += seconds
+            entry[2] = [a + b for a, b in zip(entry[2], histogram)]
+        for item in worker_slowest:
+            if len(self.slowest) < self.top_n:
+                heapq.heappush(self.slowest, item)
+            elif item[0] > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+        self.bytes_read += io_read
+        for name, amount in counters.items():
+            self.count(name, amount)
+
+    def finish(self):
+        """Charge the remaining time and take the totals. Call once, at the
+        end of the run."""
+        self.switch("other")
+        self.wall_total = time.perf_counter() - self._wall_start
+        self.cpu_total = time.process_time() - self._cpu_start
+        io_now = read_io_bytes()
+        if io_now is not None and self._io_start is not None:
+            self.bytes_read += io_now - self._io_start
+        self._io_start = io_now
+
+    def add_shard(self, shard_stats: dict):
+        """Add the stats of a shard's run, as written by --stats_json, to the
+        report."""
+        self.shards.append(shard_stats)
+
+    def _shards_dict(self):
+        """Return the shard runs, their summed counters, and the balance
+        (images in the largest shard over the mean)."""
+        runs = [
+            {
+                "shard": shard.get("shard"),
+                "wall_seconds": shard.get("wall_seconds", 0.0),
+                "cpu_seconds": shard.get("cpu_seconds", 0.0),
+                "counters": shard.get("counters", {}),
+            }
+            for shard in sorted(self.shards, key=lambda shard: shard_sort_key(shard.get("shard")))
+        ]
+        counters = {}
+        for shard_run in runs:
+            for name, value in shard_run["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+        images = [shard_run["counters"].get("images", 0) for shard_run in runs]
+        mean = sum(images) / len(images)
+        return {
+            "runs": runs,
+            "counters": dict(sorted(counters.items())),
+            "wall_seconds_max": max(shard_run["wall_seconds"] for shard_run in runs),
+            "balance": max(images) / mean if mean else 1.0,
+        }
+
+    # Phases in pipeline order, for display. Others go at the end.
+    PHASES = ("discovery", "filter", "pairing", "extraction", "catalog", "linking", "sync")
+
+    def _phase_order(self, phase: str):
+        return self.PHASES.index(phase) if phase in self.PHASES else len(self.PHASES)
+
+    def as_dict(self):
+        """Return the stats as a dict, ready for JSON."""
+        buckets = [f"<={ms}ms" for ms in self.LATENCY_BUCKETS_MS] + [
+            f">{self.LATENCY_BUCKETS_MS[-1]}ms"
+        ]
+        stats = {
+            "wall_seconds": self.wall_total,
+            "cpu_seconds": self.cpu_total,
+            "phases": {
+                phase: {
+                    "wall_seconds": self.phase_wall[phase],
+                    "cpu_seconds": self.phase_cpu[phase],
+                }
+                for phase in sorted(self.phase_wall, key=self._phase_order)
+            },
+            "counters": dict(sorted(self.counters.items())),
+            "bytes_read": self.bytes_read,
+            "reads": {
+                source: {
+                    "count": count,
+                    "mean_ms": seconds * 1000 / count if count else 0.0,
+                    "histogram": dict(zip(buckets, histogram)),
+                }
+                for source, (count, seconds, histogram) in self.reads.items()
+            },
+            "slowest": [
+                {"file": fname, "source": source, "ms": seconds * 1000}
+                for seconds, fname, source in sorted(self.slowest, reverse=True)
+            ],
+        }
+        children_cpu = children_cpu_time()
+        if self.jobs > 1 and children_cpu is not None:
+            stats["worker_cpu_seconds"] = children_cpu - self._children_cpu_start
+        if self.shard is not None:
+            stats["shard"] = self.shard
+        if self.shards:
+            stats["shards"] = self._shards_dict()
+        return stats
+
+    def print_summary(self):
+        """Print the stats as a summary table."""
+        stats = self.as_dict()
+        print("\nRun statistics:")
+        print(f"  {'phase':<12}{'wall s':>10}{'cpu s':>10}")
+        for phase, times in stats["phases"].items():
+            print(f"  {phase:<12}{times['wall_seconds']:>10.3f}{times['cpu_seconds']:>10.3f}")
+        print(f"  {'total':<12}{stats['wall_seconds']:>10.3f}{stats['cpu_seconds']:>10.3f}")
+        if "worker_cpu_seconds" in stats:
+            print(f"  Worker process cpu: {stats['worker_cpu_seconds']:.3f} s")
+        print("\n  Counts:")
+        for name, value in stats["counters"].items():
+            print(f"    {name:<20}{value:>10}")
+        print(f"    {'bytes_read':<20}{stats['bytes_read']:>10}")
+        for source, reads in stats["reads"].items():
+            print(f"\n  {source} reads: {reads['count']}, mean {reads['mean_ms']:.3f} ms")
+            for bucket, count in reads["histogram"].items():
+                if count:
+                    print(f"    {bucket:>10}{count:>10}")
+        if stats["slowest"]:
+            print(f"\n  Slowest {len(stats['slowest'])} reads:")
+            for item in stats["slowest"]:
+                print(f"    {item['ms']:>10.3f} ms  {item['source']:<9} {item['file']}")
+        shards = stats.get("shards")
+        if shards:
+            print(f"\n  Shards ({len(shards['runs'])}):")
+            print(f"    {'shard':<10}{'wall s':>10}{'cpu s':>10}{'images':>10}{'favorites':>10}")
+            for shard_run in shards["runs"]:
+                counters = shard_run["counters"]
+                print(
+                    f"    {shard_run['shard'] or '?':<10}{shard_run['wall_seconds']:>10.3f}\
+{shard_run['cpu_seconds']:>10.3f}{counters.get('images', 0):>10}{counters.get('favorites', 0):>10}"
+                )
+            counters = shards["counters"]
+            print(
+                f"    {'all':<10}{shards['wall_seconds_max']:>10.3f}{'':>10}\
+{counters.get('images', 0):>10}{counters.get('favorites', 0):>10}"
+            )
+            print(f"    Balance (largest shard / mean images): {shards['balance']:.2f}")
+
+
+class StatsPhase:
+    """Reusable context manager that charges the time spent in its block to
+    a RunStats phase."""
+
+    def __init__(self, stats: RunStats, phase: str):
+        self._stats = stats
+        self._phase = phase
+        self._previous = None
+
+    def __enter__(self):
+        self._previous = self._stats.switch(self._phase)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stats.switch(self._previous)
+
+
+class SelectOptions(NamedTuple):
+    """The options select_record() needs. Small and picklable, so it can be
+    handed to worker processes instead of all the parsed arguments. prefer is
+    one of PREFER_POLICIES, and fields the xmp fields sidecars are read
+    for (see read_xmp_sidecar())."""
+
+    prefer: str = PREFER_SIDECAR
+    ignore_file: bool = False
+    ignore_xmp: bool = False
+    fields: frozenset = SIDECAR_DONE_FIELDS
+
+
+def image_mtime_ns(ifn: str, scan_stats=None):
+    """Return an image's modification time in ns, for the catalog, from its
+    scan_stats (see pair_sidecars()) if there are any, or None if it can't be
+    stat'd."""
+    if scan_stats is not None:
+        return scan_stats[0].st_mtime_ns
+    try:
+        return os.stat(ifn).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _ExtractWorker:
+    """Metadata extraction state for a worker process or thread: the options,
+    a read-only (deferred) view of the cache, and read stats, set up once per
+    worker rather than once per task."""
+
+    def __init__(
+        self,
+        options: SelectOptions,
+        cache_path,
+        collect_stats=False,
+        count_io=True,
+        top_n=10,
+        mtimes=False,
+    ):
+        self.options = options
+        self.mtimes = mtimes
+        self.cache = None
+        if cache_path:
+            self.cache = MetadataCache(cache_path, deferred=True)
+        # top_n is that of the parent's RunStats, so the slowest reads it
+        # merges are not cut short
+        self.stats = RunStats(top_n) if collect_stats else None
+        # Threads share the process's I/O counters, which the parent counts
+        # itself, so only worker processes count their bytes read.
+        self.count_io = count_io
+
+    def extract(self, tasks: list[tuple]):
+        """Extract the metadata for a chunk of (ifn, ifx, scan_stats) tasks.
+
+        Return (results, cache_entries, cache_counts, read_stats). results
+        holds a compact (ifn, record fields, source) tuple per task, in task
+        order, with record fields and source None if no xmp data was found,
+        and the image's mtime_ns added with mtimes.
+        cache_entries are the new cache entries for the parent to store.
+        read_stats is None unless stats are being collected."""
+        read = record_reader(self.options.fields, self.cache)
+        if self.stats is not None:
+            read = self.stats.timed_read(read)
+        results = []
+        for ifn, ifx, scan_stats in tasks:
+            record, source = select_record(
+                ifn, ifx, self.options, read, self.stats, scan_stats
+            )
+            result = (ifn, tuple(record), source) if record else (ifn, None, None)
+            if self.mtimes:
+                result += (image_mtime_ns(ifn, scan_stats),)
+            results.append(result)
+        read_stats = None
+        if self.stats is not None:
+            read_stats = self.stats.take_reads()
+            if not self.count_io:
+                read_stats = read_stats[:2] + (0,) + read_stats[3:]
+        if self.cache is None:
+            return results, [], (0, 0, 0), read_stats
+        entries = self.cache.deferred
+        self.cache.deferred = []
+        return results, entries, self.cache.take_counts(), read_stats
+
+
+# Worker process state, set up once per worker by _init_worker()
+_worker = None
+
+
+def _init_worker(
+    options: SelectOptions, cache_path, collect_stats=False, top_n=10, mtimes=False
+):
+    """Process pool initializer. Set up the worker's extraction state."""
+    global _worker
+    _worker = _ExtractWorker(options, cache_path, collect_stats, top_n=top_n, mtimes=mtimes)
+
+
+def _extract_chunk(tasks: list[tuple]):
+    """Process pool task. Extract the metadata for a chunk of tasks,
+    and return what _ExtractWorker.extract() returns."""
+    return _worker.extract(tasks)
+
+
+# Number of tasks handed to a worker process at a time
+EXTRACT_CHUNK_SIZE = 64
+# Number of tasks handed to an I/O thread at a time. Small, so the reads in
+# flight are spread over all the threads.
+IO_CHUNK_SIZE = 4
+
+
+def extract_records(
+    tasks,
+    options: SelectOptions,
+    jobs=1,
+    cache=None,
+    stats=None,
+    io_threads=0,
+    library=None,
+    mtimes=False,
+):
+    """Extract the metadata for an iterable of (ifn, ifx, scan_stats) tasks
+    from pair_sidecars(), where ifn is an image file name, ifx is its xmp
+    sidecar file name (or None), and scan_stats their stat results (or None).
+
+    Generate (ifn, record, source) in task order, as select_record() would
+    return them. With jobs > 1, the tasks are handed out in chunks to a pool
+    of worker processes, and any new cache entries they make are stored by
+    this process. The order of the results does not depend on jobs.
+
+    With io_threads > 0 (which takes precedence over jobs), the tasks are
+    handed out in small chunks to a pool of that many threads instead, so up
+    to io_threads stat/open/read calls are in flight at once. This is for
+    file systems with high latency per call (e.g. NFS or SMB), where the
+    time goes to waiting rather than parsing. The results are still in task
+    order.
+
+    Tasks are consumed as they are needed, with only a few chunks per worker
+    in flight, so a task generator (e.g. from a directory scan) is never
+    materialized all at once.
+
+    If a library (a RatingsLibrary) is given, images it knows are not read,
+    and their records from the library are generated in their place, with a
+    source of SOURCE_LIBRARY. Only the other images go to the workers.
+
+    With mtimes, each result also has the image's modification time, as
+    (ifn, record, source, mtime_ns) (see image_mtime_ns()). The workers take
+    it, from the scan's stat data where there is some.
+
+    If stats (a RunStats) is given, each metadata read is timed."""
+    if jobs <= 1 and io_threads <= 0:
+        read = record_reader(options.fields, cache)
+        if stats is not None:
+            read = stats.timed_read(read)
+        for ifn, ifx, scan_stats in tasks:
+            mtime = (image_mtime_ns(ifn, scan_stats),) if mtimes else ()
+            if library is not None:
+                record = library.lookup(ifn)
+                if record is not None:
+                    yield (ifn, record, SOURCE_LIBRARY) + mtime
+                    continue
+            record, source = select_record(ifn, ifx, options, read, stats, scan_stats)
+            yield (ifn, record, source) + mtime
+        return
+
+    # pylint: disable-next=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    cache_path = cache.db_path if cache is not None else None
+    top_n = stats.top_n if stats is not None else 0
+    # Make sure the workers see everything cached so far
+    if cache is not None:
+        cache.commit()
+    if io_threads > 0:
+        # Each thread gets its own extraction state, since SQLite
+        # connections can't be shared between threads.
+        thread_state = threading.local()
+
+        def extract_in_thread(chunk):
+            worker = getattr(thread_state, "worker", None)
+            if worker is None:
+                worker = _ExtractWorker(
+                    options,
+                    cache_path,
+                    stats is not None,
+                    count_io=False,
+                    top_n=top_n,
+                    mtimes=mtimes,
+                )
+                thread_state.worker = worker
+            return worker.extract(chunk)
+
+        workers = io_threads
+        chunk_size = IO_CHUNK_SIZE
+        extract_chunk = extract_in_thread
+        pool = ThreadPoolExecutor(max_workers=io_threads)
+    else:
+        workers = jobs
+        chunk_size = EXTRACT_CHUNK_SIZE
+        extract_chunk = _extract_chunk
+        pool = ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(options, cache_path, stats is not None, top_n, mtimes),
+        )
+    with pool:
+        # (chunk, library records, future) for the chunks in flight, oldest
+        # first, so the results come out in task order. Two chunks per worker
+        # keeps them all busy. Only the images the library doesn't know are
+        # handed to a worker, and the future is None if there are none.
+        in_flight = deque()
+        task_iter = iter(tasks)
+        while True:
+            while len(in_flight) < workers * 2:
+                chunk = list(islice(task_iter, chunk_size))
+                if not chunk:
+                    break
+                known = None
+                if library is not None:
+                    known = [(task, library.lookup(task[0])) for task in chunk]
+                    chunk = [task for task, record in known if record is None]
+                future = pool.submit(extract_chunk, chunk) if chunk else None
+                in_flight.append((known, future))
+            if not in_flight:
+                break
+            known, future = in_flight.popleft()
+            if future is None:
+                results, entries, counts, read_stats = [], [], (0, 0, 0), None
+            else:
+                results, entries, counts, read_stats = future.result()
+            if known is not None:
+                results = _merge_known(known, results, mtimes)
+            if stats is not None and read_stats is not None:
+                stats.merge_reads(read_stats)
+            if cache is not None:
+                for entry in entries:
+                    cache.store(*entry)
+                cache.merge_counts(counts)
+            for ifn, fields, source, *mtime in results:
+                if fields is None:
+                    yield (ifn, None, None, *mtime)
+                elif source == SOURCE_LIBRARY:
+                    yield (ifn, fields, source, *mtime)
+                else:
+                    yield (ifn, XmpRecord(*fields), source, *mtime)
+
+
+def _merge_known(known: list, results: list, mtimes=False):
+    """Given (task, library record) for a chunk of tasks (record None where the
+    library doesn't know the image) and the worker results for the unknown
+    ones, in order, generate the results for the whole chunk, in order, with
+    the image mtimes of the known ones taken here. Raise RuntimeError if the
+    worker didn't return one result per unknown image."""
+    unknown = sum(record is None for _, record in known)
+    if len(results) != unknown:
+        raise RuntimeError(
+            f"Worker returned {len(results)} results for {unknown} images not in the library"
+        )
+    index = 0
+    for (ifn, _, scan_stats), record in known:
+        if record is None:
+            yield results[index]
+            index += 1
+        elif mtimes:
+            yield ifn, record, SOURCE_LIBRARY, image_mtime_ns(ifn, scan_stats)
+        else:
+            yield ifn, record, SOURCE_LIBRARY
+
+
+def source_prefix(src_dir: str):
+    """Return the source directory as a posix path prefix ending in '/', in
+    the same form pathlib would give, or '' for the working directory. File
+    names from scan_dir() all start with this prefix."""
+    root = Path(src_dir).as_posix()
+    return "" if root == "." else root.rstrip("/") + "/"
+
+
+def dir_excluded(rel_dir: str, exclude_dirs):
+    """Return True if a source sub-directory, given by its path relative to
+    the source, matches one of the exclude_dirs glob patterns by name or by
+    relative path."""
+    name = rel_dir.rpartition("/")[2]
+    return any(
+        fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(rel_dir, pattern)
+        for pattern in exclude_dirs
+    )
+
+
+# --shard splits the source tree into count slices, one per host, by a stable
+# hash of the top level directory ('dir') or of the relative path ('path').
+SHARD_BY = ("dir", "path")
+
+
+def shard_hash(key: str):
+    """Return a stable 64 bit hash of a path relative to the source, the same
+    on every host and Python version (unlike hash())."""
+    from hashlib import blake2b  # pylint: disable=import-outside-toplevel
+
+    digest = blake2b(key.encode("utf-8", "surrogateescape"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+class Shard(NamedTuple):
+    """One of count slices of the source tree, so a run can be spread over
+    several hosts. Files are assigned by the hash of their top level
+    directory (by 'dir'), so whole trees go to one shard and the others are
+    never walked, or of their path relative to the source (by 'path'), which
+    balances better when there are only a few top level directories. Files
+    directly in the source are always assigned by path. The assignment only
+    depends on the key, so adding files or directories never moves others to
+    another shard."""
+
+    index: int  # 0 based
+    count: int
+    by: str = "dir"
+
+    @property
+    def label(self):
+        """The shard as given to --shard, e.g. '2/4'."""
+        return f"{self.index + 1}/{self.count}"
+
+    def owns(self, rel_path: str):
+        """Return True if the file (or, by 'dir', the top level directory)
+        with this path relative to the source is in the shard."""
+        if self.by == "dir":
+            rel_path = rel_path.partition("/")[0]
+        return shard_hash(rel_path) % self.count == self.index
+
+
+def shard_sort_key(label):
+    """Sort key for shard labels ('2/4'), in shard order. Missing or bad
+    labels go last."""
+    try:
+        index, _, count = label.partition("/")
+        return (int(count), int(index))
+    except (AttributeError, ValueError):
+        return (float("inf"), 0)
+
+
+def parse_shard(text: str, by: str = "dir"):
+    """Return the Shard for a --shard value, i/N with i from 1 to N. Raise
+    ValueError if it isn't one."""
+    index, sep, count = text.partition("/")
+    if not sep:
+        raise ValueError(f"{text} is not i/N")
+    index = int(index)
+    count = int(count)
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"{text}: i must be from 1 to N")
+    return Shard(index - 1, count, by)
+
+
+def parse_types(values):
+    """Return the file types (lower case suffixes, with the dot) from the
+    --types option values, each a comma separated list of extensions, e.g.
+    ['jpg,nef', '.DNG']. 'default' adds the DEFAULT_IMAGE_TYPES. Return None
+    if 'all' is given, meaning every file type. Raise ValueError if there are
+    no types."""
+    types = set()
+    for value in values:
+        for ext in value.split(","):
+            ext = ext.strip().lower()
+            if ext == "all":
+                return None
+            if ext == "default":
+                types.update(DEFAULT_IMAGE_TYPES)
+            elif ext:
+                types.add(ext if ext.startswith(".") else "." + ext)
+    if not types:
+        raise ValueError("No file types given")
+    return frozenset(types)
+
+
+def filter_names(
+    dir_prefix: str, file_names, root_len: int, pattern=None, types=None, shard=None
+):
+    """Return the file names of a directory (as from scan_dir()) that are
+    worth reading: the ones whose suffix is in types (lower case, e.g. '.jpg')
+    and whose path relative to the source matches the compiled pattern and
+    is in the Shard. root_len is the length of the source prefix (see
+    source_prefix()), which is cut from dir_prefix for the pattern match.
+    Sidecars (.xmp) are always kept, so they can be paired. types, pattern, or
+    shard None skips that check. If file_names is a dict of {name: entry}
+    (see scan_dir()), so is the result.
+
+    The suffix check comes first, since it is a set lookup, and it keeps
+    files that aren't images (text, pdf, video, catalogs, ...) from ever being
+    opened for metadata."""
+    rel_prefix = dir_prefix[root_len:]
+    matched = []
+    for name in file_names:
+        suffix = os.path.splitext(name)[1].lower()
+        if suffix == ".xmp":
+            matched.append(name)
+        elif (
+            (types is None or suffix in types)
+            and (pattern is None or pattern.match(rel_prefix + name))
+            and (shard is None or shard.owns(rel_prefix + name))
+        ):
+            matched.append(name)
+    if isinstance(file_names, dict):
+        return {name: file_names[name] for name in matched}
+    return matched
+
+
+def scan_dir(
+    src_dir: str,
+    recursive=False,
+    exclude_dirs=(),
+    prune_dirs=(),
+    start="",
+    shard=None,
+    entries=False,
+):
+    """Walk the source directory with os.scandir() and generate
+    (dir_prefix, file_names) for each directory, one directory at a time.
+
+    dir_prefix is the directory as a posix path string, ending in '/', in the
+    same form pathlib would give (e.g. 'sample/sub1/', or '' for '.'), so
+    dir_prefix + name is the file path. file_names is a sorted list of the
+    regular files (or links to them) in the directory. With entries, it is a
+    dict of {name: os.DirEntry} in name order instead, so the files can be
+    stat'd through their entries, only as needed (see pair_sidecars()).
+
+    Only the directory entries' cached type information is used, so there is
+    no stat per file. With recursive, sub-directories are walked in sorted
+    order, depth first, but symbolic links to directories are not followed.
+    Directories whose name or path relative to src_dir match one of the
+    exclude_dirs glob patterns are skipped, as are the directories (given as
+    real paths) in prune_dirs, e.g. the destination directory. With a Shard by
+    'dir', the top level directories of other shards are skipped too.
+
+    start is a sub-directory, relative to src_dir, to start the walk from,
+    e.g. to rescan part of the tree. The names and exclusions are still
+    relative to src_dir."""
+    root_prefix = source_prefix(src_dir)
+    real_root = os.path.realpath(src_dir)
+    if start:
+        root_prefix += start + "/"
+        real_root = os.path.join(real_root, start)
+        start += "/"
+    # (dir_prefix, relative dir, real path) for the directories to walk.
+    # Real paths of sub directories are built from the parent's, which holds
+    # as long as directory links are not followed.
+    pending = [(root_prefix, start, real_root)]
+    while pending:
+        dir_prefix, rel_dir, real_dir = pending.pop()
+        file_entries = []
+        sub_dirs = []
+        try:
+            with os.scandir(dir_prefix or ".") as dir_entries:
+                for entry in dir_entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.name)
+                        elif entry.is_file():
+                            file_entries.append(entry)
+                    except OSError:
+                        continue
+        except OSError:
+            # Unreadable (or vanished) directory. Skip it.
+            continue
+        if entries:
+            file_entries.sort(key=lambda entry: entry.name)
+            yield dir_prefix, {entry.name: entry for entry in file_entries}
+        else:
+            yield dir_prefix, sorted(entry.name for entry in file_entries)
+        if not recursive:
+            continue
+        # Push in reverse so the sub directories are popped in sorted order
+        for name in sorted(sub_dirs, reverse=True):
+            sub_rel = rel_dir + name
+            sub_real = os.path.join(real_dir, name)
+            if sub_real in prune_dirs or dir_excluded(sub_rel, exclude_dirs):
+                continue
+            if shard is not None and shard.by == "dir" and not rel_dir and not shard.owns(name):
+                continue
+            pending.append((dir_prefix + name + "/", sub_rel + "/", sub_real))
+
+
+def pair_sidecars(batches, naming="both", ignore_xmp=False, ambiguous=None):
+    """Pair the image files with their xmp sidecars, one directory at a time.
+
+    batches generates (dir_prefix, file_names) per directory, e.g. from
+    scan_dir() with any name filtering applied. Generate an (ifn, ifx,
+    scan_stats) task per image file, where ifx is the sidecar file name or
+    None. Sidecars are never tasks themselves. With ignore_xmp, no sidecars
+    are paired.
+
+    When file_names holds the directory entries (scan_dir() with entries),
+    scan_stats is the (image, sidecar) stat results of a paired image, taken
+    through the entries, for source_order(). Otherwise it is None.
+
+    Images with more than one candidate sidecar are added to the ambiguous
+    dict (image file name -> candidate sidecar file names), if one is given."""
+    for dir_prefix, file_names in batches:
+        images = []
+        sidecars = []
+        for name in file_names:
+            if name[-4:].lower() == ".xmp":
+                sidecars.append(name)
+            else:
+                images.append(name)
+        if ignore_xmp or not sidecars:
+            for name in images:
+                yield dir_prefix + name, None, None
+            continue
+        sidecar_index = SidecarIndex(sidecars, naming)
+        for name in images:
+            xmp_name = sidecar_index.lookup(name)
+            if not xmp_name:
+                yield dir_prefix + name, None, None
+                continue
+            scan_stats = None
+            if isinstance(file_names, dict):
+                try:
+                    scan_stats = (file_names[name].stat(), file_names[xmp_name].stat())
+                except OSError:
+                    pass
+            yield dir_prefix + name, dir_prefix + xmp_name, scan_stats
+        if ambiguous is not None:
+            for name, candidates in sidecar_index.ambiguous.items():
+                ambiguous[dir_prefix + name] = [dir_prefix + xmp_name for xmp_name in candidates]
+
+
+# Output modes. The symbolic link modes make links to the images. The file
+# modes put a file in the destination that shares (hardlink), clones
+# (reflink), or copies the image data, so the destination works without the
+# source, e.g. on another host or a USB drive.
+LINK_MODES = ("symlink", "relsymlink", "hardlink", "reflink", "copy")
+FILE_MODES = ("hardlink", "reflink", "copy")
+# Linux ioctl to clone all of a file's extents (btrfs, xfs, etc.)
+FICLONE = 0x40049409
+# Largest number of bytes handed to one copy_file_range() or sendfile() call
+COPY_CHUNK = 1 << 30
+# errno values meaning a zero-copy call can't be used for this pair of files,
+# so the next way of copying should be tried
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def copy_file_data(src_fd: int, dst_fd: int, size: int, reflink=False):
+    """Copy size bytes from the file open as src_fd to the (empty) file open as
+    dst_fd, from their current positions, using the cheapest way that works:
+    with reflink, a FICLONE clone that shares the data blocks; then
+    os.copy_file_range() and os.sendfile(), which copy in the kernel; and
+    last, reads and writes. Return the name of the way used."""
+    if reflink:
+        try:
+            import fcntl  # pylint: disable=import-outside-toplevel
+
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return "reflink"
+        except (ImportError, OSError):
+            pass
+    copied = 0
+    for name in ("copy_file_range", "sendfile"):
+        if not hasattr(os, name):
+            continue
+        try:
+            while copied < size:
+                count = min(COPY_CHUNK, size - copied)
+                if name == "copy_file_range":
+                    count = os.copy_file_range(src_fd, dst_fd, count)
+                else:
+                    count = os.sendfile(dst_fd, src_fd, None, count)
+                if not count:
+                    break
+                copied += count
+            return name
+        except OSError as err:
+            # Only fall back if nothing was copied yet, so the file positions
+            # haven't moved.
+            if copied or err.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+    while True:
+        data = os.read(src_fd, 1 << 20)
+        if not data:
+            return "read"
+        while data:
+            data = data[os.write(dst_fd, data) :]
+
+
+def copy_file(src_path: str, dst_fd: int, src_st: os.stat_result, reflink=False):
+    """Copy (or with reflink, clone if possible) the source file into the new
+    destination file open as dst_fd, then give it the source's permissions,
+    owner and group (if allowed), and access and modification times, and
+    close it. The modification time is set last, so a copy is only current
+    (same size and time as the source) once it is complete."""
+    try:
+        src_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            copy_file_data(src_fd, dst_fd, src_st.st_size, reflink)
+        finally:
+            os.close(src_fd)
+        os.fchmod(dst_fd, stat.S_IMODE(src_st.st_mode))
+        try:
+            os.fchown(dst_fd, src_st.st_uid, src_st.st_gid)
+        except PermissionError:
+            # Only root can give files away. Keep the owner as is.
+            pass
+        os.utime(dst_fd, ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+    finally:
+        os.close(dst_fd)
+
+
+class LinkWriter:
+    """Makes (and removes) the links in the destination directory.
+
+    The source and destination directories are resolved once, and links are
+    named by their path relative to the destination, which is the image's path
+    relative to the source. Links are made relative to open directory file
+    descriptors (dir_fd), so the destination path is not looked up again for
+    every link. The most recently used directory fds are kept open, and
+    directories already created or verified are remembered, so each
+    destination directory is checked or created once.
+
+    Created directories get the owner, group, and permissions of the source
+    directory, which is stat'd once.
+
+    mode is one of LINK_MODES. With 'symlink', links hold the absolute
+    (resolved) path of the image. With 'relsymlink', they hold a path relative
+    to the link's directory, so the destination tree still works if the
+    source and destination are moved (or mounted elsewhere) together.
+
+    The FILE_MODES put a regular file in the destination instead: a hard link
+    ('hardlink', or a copy if the destination is on another file system), a
+    clone sharing the data blocks ('reflink', or a copy if the file system
+    can't clone), or a copy ('copy'). See copy_file(). A file with the same
+    size and modification time as the image is current and is left alone. An
+    out of date file is always replaced, a symbolic link only with replace.
+    With copy_threads, up to that many copies run at once in threads, and
+    link() returns once the copy is started. flush() waits for them, and
+    returns the ones that failed."""
+
+    # Number of destination directory fds to keep open
+    MAX_OPEN_DIRS = 64
+
+    def __init__(
+        self,
+        src_dir: str,
+        dest_dir: str,
+        mode: str = "symlink",
+        verbose=False,
+        quiet=False,
+        copy_threads=0,
+    ):
+        if mode not in LINK_MODES:
+            raise ValueError(f"Unknown output mode: {mode}")
+        self.src_root = os.path.realpath(src_dir)
+        self.dest_root = os.path.realpath(dest_dir)
+        self.src_prefix = source_prefix(src_dir)
+        self.mode = mode
+        self.relative = mode == "relsymlink"
+        self.verbose = verbose
+        self.quiet = quiet
+        self.copy_threads = copy_threads
+        # counters
+        self.linked = 0
+        self.existing = 0
+        self.removed = 0
+        self.errors = 0
+        self.dirs_created = 0
+        self.copied = 0
+        self._src_stat = None  # stat of the source directory, once needed
+        self._root_fd = None
+        self._dir_fds = OrderedDict()  # rel dir -> fd, least recently used first
+        self._known_dirs = set()  # rel dirs known to exist
+        self._copy_pool = None  # thread pool, once a copy is made with copy_threads
+        self._copies = deque()  # (rel path, future) of the copies in flight
+        self._failed = []  # rel paths of the copies that failed since the last flush
+        self._warned_exdev = False
+
+    def rel_path(self, fname: str):
+        """Return the path of a file from scan_dir(), relative to the source."""
+        return fname[len(self.src_prefix) :]
+
+    def link_target(self, rel_path: str):
+        """Return the target (contents) of the link for the file with the
+        given path relative to the source. In the FILE_MODES, it is the mode
+        and the image path, e.g. 'copy:/photos/foo.jpg', which is what the
+        sync manifest records, so a change of mode is a change of target."""
+        target = self.src_root + "/" + rel_path
+        if self.mode in FILE_MODES:
+            return f"{self.mode}:{target}"
+        if self.relative:
+            link_dir = os.path.dirname(self.dest_root + "/" + rel_path)
+            return os.path.relpath(target, link_dir)
+        return target
+
+    def _error(self, message: str):
+        self.errors += 1
+        if not self.quiet:
+            print("ERROR: " + message)
+
+    def _copy_ogp(self, fd: int):
+        """Copy the owner, group, and permissions of the source directory to
+        the directory open as fd."""
+        if self._src_stat is None:
+            self._src_stat = os.stat(self.src_root)
+        os.fchown(fd, self._src_stat.st_uid, self._src_stat.st_gid)
+        os.fchmod(fd, stat.S_IMODE(self._src_stat.st_mode))
+
+    def _open_dir(self, name: str, parent_fd, create: bool, display: str):
+        """Open (and with create, make if needed) a directory. Return the fd,
+        or None if it does not exist and create is False. display is the
+        directory path to use in messages."""
+        try:
+            return os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=parent_fd)
+        except FileNotFoundError:
+            if not create:
+                return None
+        if self.verbose:
+            print(f"Directory {display} does not exist. Creating it.")
+        os.mkdir(name, dir_fd=parent_fd)
+        self.dirs_created += 1
+        fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=parent_fd)
+        try:
+            self._copy_ogp(fd)
+        except OSError as err:
+            self._error(f"Could not set the owner or permissions of {display}: {err}")
+        return fd
+
+    def _dir_fd(self, rel_dir: str, create=True):
+        """Return an open fd for a destination directory, given relative to
+        the destination, creating it (and its parents) if needed and create is
+        True. Return None if it does not exist and create is False."""
+        if self._root_fd is None:
+            self._root_fd = self._open_dir(self.dest_root, None, create, self.dest_root)
+            if self._root_fd is None:
+                return None
+        if not rel_dir:
+            return self._root_fd
+        fd = self._dir_fds.get(rel_dir)
+        if fd is not None:
+            self._dir_fds.move_to_end(rel_dir)
+            return fd
+        if rel_dir in self._known_dirs:
+            # Exists, but the fd was closed. Reopen it from the root.
+            fd = os.open(rel_dir, os.O_RDONLY | os.O_DIRECTORY, dir_fd=self._root_fd)
+        else:
+            parent_rel, _, name = rel_dir.rpartition("/")
+            parent_fd = self._dir_fd(parent_rel, create)
+            if parent_fd is None:
+                return None
+            fd = self._open_dir(name, parent_fd, create, f"{self.dest_root}/{rel_dir}")
+            if fd is None:
+                return None
+            self._known_dirs.add(rel_dir)
+        self._dir_fds[rel_dir] = fd
+        if len(self._dir_fds) > self.MAX_OPEN_DIRS:
+            _, old_fd = self._dir_fds.popitem(last=False)
+            os.close(old_fd)
+        return fd
+
+    def read_link(self, rel_path: str):
+        """Return the target of an existing link, or None if there is no link
+        (or the path is not a link)."""
+        rel_dir, _, name = rel_path.rpartition("/")
+        try:
+            dir_fd = self._dir_fd(rel_dir, create=False)
+            if dir_fd is None:
+                return None
+            return os.readlink(name, dir_fd=dir_fd)
+        except OSError:
+            return None
+
+    def dir_exists(self, rel_dir: str):
+        """Return True if a destination directory, given relative to the
+        destination, exists. Nothing is created."""
+        try:
+            return self._dir_fd(rel_dir, create=False) is not None
+        except OSError:
+            return False
+
+    def make_dir(self, rel_dir: str):
+        """Make a destination directory (and its parents), given relative to
+        the destination, if it does not exist. Return True if it exists."""
+        try:
+            self._dir_fd(rel_dir)
+        except OSError as err:
+            self._error(f"Could not create directory {self.dest_root}/{rel_dir}: {err}")
+            return False
+        return True
+
+    def in_place(self, rel_path: str):
+        """Return True if the link (or in the FILE_MODES, the file) for the
+        file with the given path relative to the source is already as link()
+        would leave it. Nothing is changed."""
+        if self.mode not in FILE_MODES:
+            # readlink() fails on anything that isn't a link, so no stat is
+            # needed
+            return self.read_link(rel_path) == self.link_target(rel_path)
+        rel_dir, _, name = rel_path.rpartition("/")
+        try:
+            dir_fd = self._dir_fd(rel_dir, create=False)
+            if dir_fd is None:
+                return False
+            st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            src_st = os.stat(self.src_root + "/" + rel_path)
+            return stat.S_ISREG(st.st_mode) and (st.st_size, st.st_mtime_ns) == (
+                src_st.st_size,
+                src_st.st_mtime_ns,
+            )
+        except OSError:
+            return False
+
+    def is_current(self, rel_path: str, recorded_target):
+        """Return True if a link recorded (e.g. in the sync manifest) with
+        recorded_target needs nothing done: the target is the same, and in the
+        FILE_MODES, the file still has the image's size and modification time,
+        since the target doesn't change when the image does."""
+        if recorded_target != self.link_target(rel_path):
+            return False
+        return self.mode not in FILE_MODES or self.in_place(rel_path)
+
+    def link(self, rel_path: str, replace=False):
+        """Make the link for the file with the given path relative to the
+        source. A link that already exists with the same target is left
+        alone. With replace, an existing link with a different target is
+        replaced. Return True if the link is in place (or its copy is
+        started).
+
+        In the FILE_MODES, a file is put in place instead. See the class
+        description."""
+        rel_dir, _, name = rel_path.rpartition("/")
+        if self.mode in FILE_MODES:
+            return self._place_file(rel_path, rel_dir, name, replace)
+        target = self.link_target(rel_path)
+        try:
+            dir_fd = self._dir_fd(rel_dir)
+            try:
+                os.symlink(target, name, dir_fd=dir_fd)
+            except FileExistsError:
+                if not stat.S_ISLNK(os.stat(name, dir_fd=dir_fd, follow_symlinks=False).st_mode):
+                    self._error(f"{self.dest_root}/{rel_path} exists and is not a link.")
+                    return False
+                if os.readlink(name, dir_fd=dir_fd) == target:
+                    self.existing += 1
+                    return True
+                if not replace:
+                    self._error(f"Link {self.dest_root}/{rel_path} exists with a different target.")
+                    return False
+                os.unlink(name, dir_fd=dir_fd)
+                os.symlink(target, name, dir_fd=dir_fd)
+        except OSError as err:
+            self._error(f"Could not create link {self.dest_root}/{rel_path}: {err}")
+            return False
+        self.linked += 1
+        return True
+
+    def _place_file(self, rel_path: str, rel_dir: str, name: str, replace: bool):
+        """Put a hard link, clone, or copy of the file with the given path
+        relative to the source in place. Return True if it is in place (or its
+        copy is started)."""
+        src_path = self.src_root + "/" + rel_path
+        try:
+            src_st = os.stat(src_path)
+            dir_fd = self._dir_fd(rel_dir)
+            try:
+                st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                st = None
+            if st is not None:
+                if stat.S_ISREG(st.st_mode):
+                    if (st.st_size, st.st_mtime_ns) == (src_st.st_size, src_st.st_mtime_ns):
+                        self.existing += 1
+                        return True
+                elif not stat.S_ISLNK(st.st_mode):
+                    self._error(f"{self.dest_root}/{rel_path} exists and is not a file or link.")
+                    return False
+                elif not replace:
+                    self._error(f"Link {self.dest_root}/{rel_path} exists with a different target.")
+                    return False
+                os.unlink(name, dir_fd=dir_fd)
+            if self.mode == "hardlink":
+                try:
+                    os.link(src_path, name, dst_dir_fd=dir_fd)
+                    self.linked += 1
+                    return True
+                except OSError as err:
+                    if err.errno != errno.EXDEV:
+                        raise
+                    if not self._warned_exdev and not self.quiet:
+                        print(
+                            f"WARNING: Can't hard link across file systems to \
+{self.dest_root}. Copying instead."
+                        )
+                    self._warned_exdev = True
+            dst_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600, dir_fd=dir_fd)
+        except OSError as err:
+            self._error(f"Could not create {self.dest_root}/{rel_path}: {err}")
+            return False
+        self.linked += 1
+        self.copied += 1
+        reflink = self.mode == "reflink"
+        if self.copy_threads <= 0:
+            try:
+                copy_file(src_path, dst_fd, src_st, reflink)
+            except OSError as err:
+                self._copy_failed(rel_path, err)
+                return False
+            return True
+        if self._copy_pool is None:
+            # pylint: disable-next=import-outside-toplevel
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._copy_pool = ThreadPoolExecutor(max_workers=self.copy_threads)
+        # Bound the copies in flight (and so the open files)
+        while len(self._copies) >= self.copy_threads * 2:
+            self._finish_copy()
+        future = self._copy_pool.submit(copy_file, src_path, dst_fd, src_st, reflink)
+        self._copies.append((rel_path, future))
+        return True
+
+    def _copy_failed(self, rel_path: str, err: OSError):
+        """Count a failed copy, and remove what there is of it."""
+        self.linked -= 1
+        self.copied -= 1
+        self._failed.append(rel_path)
+        self._error(f"Could not copy to {self.dest_root}/{rel_path}: {err}")
+        try:
+            os.unlink(self.dest_root + "/" + rel_path)
+        except OSError:
+            pass
+
+    def _finish_copy(self):
+        """Wait for the oldest copy in flight."""
+        rel_path, future = self._copies.popleft()
+        try:
+            future.result()
+        except OSError as err:
+            self._copy_failed(rel_path, err)
+
+    def flush(self):
+        """Wait for the copies in flight. Return the paths (relative to the
+        destination) of the copies that failed since the last flush, which are
+        not in place even though link() returned True."""
+        while self._copies:
+            self._finish_copy()
+        failed = self._failed
+        self._failed = []
+        return failed
+
+    def remove_link(self, rel_path: str):
+        """Remove a link, given its path relative to the destination, and any
+        directories left empty (except the destination itself). Only links
+        (and in the FILE_MODES, regular files) are removed. Return True if
+        the link is gone."""
+        rel_dir, _, name = rel_path.rpartition("/")
+        try:
+            dir_fd = self._dir_fd(rel_dir, create=False)
+            if dir_fd is None:
+                return True
+            try:
+                st = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                return True
+            if not stat.S_ISLNK(st.st_mode) and not (
+                self.mode in FILE_MODES and stat.S_ISREG(st.st_mode)
+            ):
+                self._error(f"{self.dest_root}/{rel_path} is not a link. Not removing it.")
+                return False
+            os.unlink(name, dir_fd=dir_fd)
+        except OSError as err:
+            self._error(f"Could not remove link {self.dest_root}/{rel_path}: {err}")
+            return False
+        self.removed += 1
+        # Remove directories left empty, deepest first
+        while rel_dir:
+            fd = self._dir_fds.pop(rel_dir, None)
+            if fd is not None:
+                os.close(fd)
+            parent_rel, _, name = rel_dir.rpartition("/")
+            parent_fd = self._dir_fd(parent_rel, create=False)
+            try:
+                os.rmdir(name, dir_fd=parent_fd)
+            except OSError:
+                break
+            self._known_dirs.discard(rel_dir)
+            rel_dir = parent_rel
+        return True
+
+    def close(self):
+        """Wait for any copies, and close the open directory fds."""
+        self.flush()
+        if self._copy_pool is not None:
+            self._copy_pool.shutdown()
+            self._copy_pool = None
+        for fd in self._dir_fds.values():
+            os.close(fd)
+        self._dir_fds.clear()
+        if self._root_fd is not None:
+            os.close(self._root_fd)
+            self._root_fd = None
+
+
+# Sync mode keeps a manifest of the links it made in the destination directory,
+# so the next run can work out what changed without reading every link.
+MANIFEST_STEM = ".photoPhav_manifest"
+MANIFEST_NAME = MANIFEST_STEM + ".json"
+MANIFEST_VERSION = 1
+# A sharded run keeps a manifest of its own links, named by the shard
+SHARD_MANIFEST_RE = re.compile(re.escape(MANIFEST_STEM) + r"\.shard-(\d+)-of-(\d+)\.json")
+
+
+def manifest_name(shard=None):
+    """Return the name of the manifest of a run, or of a Shard's run."""
+    if shard is None:
+        return MANIFEST_NAME
+    return f"{MANIFEST_STEM}.shard-{shard.index + 1}-of-{shard.count}.json"
+
+
+def read_link_manifest(dest_dir: str, name: str = MANIFEST_NAME):
+    """Return the links recorded in the destination's manifest as a dict of
+    {link path relative to dest_dir: link target}, or None if there is no
+    usable manifest."""
+    try:
+        with open(os.path.join(dest_dir, name), encoding="utf-8") as mfile:
+            manifest = json.load(mfile)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != MANIFEST_VERSION:
+        return None
+    links = manifest.get("links")
+    return links if isinstance(links, dict) else None
+
+
+def write_link_manifest(dest_dir: str, links: dict, name: str = MANIFEST_NAME):
+    """Write the manifest of {relative link path: link target} to the
+    destination directory. The manifest is replaced atomically, so an
+    interrupted write leaves the previous one in place."""
+    os.makedirs(dest_dir, exist_ok=True)
+    manifest_path = os.path.join(dest_dir, name)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as mfile:
+        json.dump({"version": MANIFEST_VERSION, "links": links}, mfile, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def scan_links(dest_dir: str, files=False):
+    """Return the symbolic links in the destination directory tree as a dict of
+    {link path relative to dest_dir: link target}. Used when there is no
+    manifest, since it has to read every link. With files (for the
+    FILE_MODES), regular files other than the manifest are included too, with
+    a target of None."""
+    links = {}
+    if not os.path.isdir(dest_dir):
+        return links
+    for dir_path, _, file_names in os.walk(dest_dir):
+        rel_dir = os.path.relpath(dir_path, dest_dir)
+        for name in file_names:
+            full_path = os.path.join(dir_path, name)
+            rel_path = name if rel_dir == "." else Path(rel_dir, name).as_posix()
+            if os.path.islink(full_path):
+                links[rel_path] = os.readlink(full_path)
+            elif files and not rel_path.startswith(MANIFEST_STEM) and os.path.isfile(full_path):
+                links[rel_path] = None
+    return links
+
+
+def shard_manifests(dest_dir: str):
+    """Return the paths of the shard manifests in the destination directory,
+    as {shard count: {shard number (1 based): path}}."""
+    manifests = {}
+    try:
+        with os.scandir(dest_dir) as entries:
+            for entry in entries:
+                match = SHARD_MANIFEST_RE.fullmatch(entry.name)
+                if match:
+                    number, count = int(match[1]), int(match[2])
+                    manifests.setdefault(count, {})[number] = entry.path
+    except OSError:
+        pass
+    return manifests
+
+
+def read_shard_manifests(dest_dir: str):
+    """Return the links recorded in a complete set of shard manifests (one
+    for each shard of the same count) in the destination, merged as from
+    read_link_manifest(), or None if there isn't exactly one complete set."""
+    complete = [
+        paths for count, paths in shard_manifests(dest_dir).items() if len(paths) == count
+    ]
+    if len(complete) != 1:
+        return None
+    links = {}
+    for path in complete[0].values():
+        shard_links = read_link_manifest(dest_dir, os.path.basename(path))
+        if shard_links is None:
+            return None
+        links.update(shard_links)
+    return links
+
+
+def remove_shard_manifests(dest_dir: str):
+    """Remove the shard manifests in the destination, once a run of the whole
+    source has written the main manifest."""
+    for paths in shard_manifests(dest_dir).values():
+        for path in paths.values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def read_run_manifest(dest_dir: str, shard=None, files=False):
+    """Return the existing links of a sync run (or of a Shard's sync run) in
+    the destination as {relative link path: target}, and whether they came
+    from a manifest. A run of the whole source without a manifest of its own
+    merges a complete set of shard manifests. Failing that, the links are
+    read from the destination (see scan_links()), only the shard's for a
+    shard."""
+    links = read_link_manifest(dest_dir, manifest_name(shard))
+    if links is None and shard is None:
+        links = read_shard_manifests(dest_dir)
+    if links is not None:
+        return links, True
+    links = scan_links(dest_dir, files)
+    if shard is not None:
+        links = {path: target for path, target in links.items() if shard.owns(path)}
+    return links, False
+
+
+def write_run_manifest(dest_dir: str, links: dict, shard=None):
+    """Write the manifest of a sync run (or of a Shard's sync run). The
+    manifest of a run of the whole source replaces the shard manifests, and
+    a shard's run makes the whole source manifest out of date, so it is
+    removed."""
+    write_link_manifest(dest_dir, links, manifest_name(shard))
+    if shard is None:
+        remove_shard_manifests(dest_dir)
+        return
+    try:
+        os.remove(os.path.join(dest_dir, MANIFEST_NAME))
+    except OSError:
+        pass
+
+
+def diff_links(desired: dict, existing: dict):
+    """Compare the desired links with the existing links, both given as
+    {relative link path: link target}. Return sorted lists of (adds, removes,
+    retargets), where adds and retargets are relative link paths to (re)link to
+    desired[path], and removes are relative link paths to remove."""
+    adds = sorted(path for path in desired if path not in existing)
+    removes = sorted(path for path in existing if path not in desired)
+    retargets = sorted(
+        path for path in desired if path in existing and existing[path] != desired[path]
+    )
+    return adds, removes, retargets
+
+
+# A plan (--plan) lists the operations a run would do in the destination(s),
+# without doing them, as JSON lines: a header line, then one operation per
+# line. --apply does them, keeping a journal next to the plan so an
+# interrupted apply continues where it stopped.
+PLAN_VERSION = 1
+JOURNAL_SUFFIX = ".journal"
+# Record progress in the journal (and fsync it) after this many operations.
+# Operations are safe to redo, so at most this many are redone on resume.
+JOURNAL_EVERY = 256
+
+
+class PlanError(Exception):
+    """A plan can't be read or applied."""
+
+
+class PlanFile:
+    """Writes a plan. The header records the source directory, the output
+    mode, whether the plan syncs, the destinations, and the Shard (if any),
+    which picks the manifest a sync plan updates. Each operation names
+    its destination by index:
+    {"op": "mkdir", "dest": 0, "path": "2024/trip"}
+    {"op": "link", "dest": 0, "path": "2024/trip/a.jpg", "target": ..., "replace": false}
+    {"op": "remove", "dest": 0, "path": "2023/b.jpg"}
+    A mkdir path of '' is the destination itself. path '-' writes to standard
+    output."""
+
+    def __init__(
+        self, path: str, src_dir: str, mode: str, sync: bool, dest_roots: list, shard=None
+    ):
+        self.path = path
+        self.counts = {"mkdir": 0, "link": 0, "remove": 0}
+        self._file = None
+        if path != "-":
+            self._file = open(path, "w", encoding="utf-8")  # pylint: disable=consider-using-with
+        header = {
+            "version": PLAN_VERSION,
+            "source_dir": os.path.realpath(src_dir),
+            "mode": mode,
+            "sync": sync,
+            "dests": dest_roots,
+        }
+        if shard is not None:
+            header["shard"] = shard.label
+            header["shard_by"] = shard.by
+        self._write(json.dumps({"photoPhav_plan": header}))
+
+    def _write(self, line: str):
+        if self._file is None:
+            print(line)
+        else:
+            self._file.write(line + "\n")
+
+    def add(self, op: str, dest: int, path: str, **fields):
+        """Add an operation."""
+        self.counts[op] += 1
+        self._write(json.dumps(dict(op=op, dest=dest, path=path, **fields)))
+
+    def close(self):
+        """Finish the plan."""
+        if self._file is not None:
+            self._file.close()
+
+
+class LinkPlanner:
+    """Stands in for a LinkWriter when planning (--plan), adding operations to
+    a PlanFile instead of doing them. The destination is only read: links (or
+    files) already in place are left out of the plan, and directories that
+    don't exist get a mkdir operation (parents first) before the first link
+    in them.
+
+    Has the parts of the LinkWriter interface used to make and sync links,
+    so it can be used in its place."""
+
+    def __init__(self, writer: LinkWriter, plan: PlanFile, index: int):
+        self.writer = writer
+        self.plan = plan
+        self.index = index
+        self.dest_root = writer.dest_root
+        self.mode = writer.mode
+        self.rel_path = writer.rel_path
+        self.link_target = writer.link_target
+        self.is_current = writer.is_current
+        # counters, of the planned operations
+        self.linked = 0
+        self.existing = 0
+        self.removed = 0
+        self.errors = 0
+        self.dirs_created = 0
+        self.copied = 0
+        self._planned_dirs = set()
+
+    def _plan_dir(self, rel_dir: str):
+        """Plan making a directory (and its parents, up to and including the
+        destination itself, '') if it doesn't exist."""
+        if rel_dir in self._planned_dirs:
+            return
+        self._planned_dirs.add(rel_dir)
+        if self.writer.dir_exists(rel_dir):
+            return
+        if rel_dir:
+            self._plan_dir(rel_dir.rpartition("/")[0])
+        self.plan.add("mkdir", self.index, rel_dir)
+        self.dirs_created += 1
+
+    def link(self, rel_path: str, replace=False):
+        """Plan the link for the file with the given path relative to the
+        source, unless it is already in place."""
+        if self.writer.in_place(rel_path):
+            self.existing += 1
+            return True
+        self._plan_dir(rel_path.rpartition("/")[0])
+        self.plan.add(
+            "link", self.index, rel_path, target=self.link_target(rel_path), replace=replace
+        )
+        self.linked += 1
+        return True
+
+    def remove_link(self, rel_path: str):
+        """Plan removing a link."""
+        self.plan.add("remove", self.index, rel_path)
+        self.removed += 1
+        return True
+
+    def flush(self):
+        """Nothing is in flight. Same as LinkWriter.flush()."""
+        return []
+
+    def close(self):
+        """Close the writer used to read the destination."""
+        self.writer.close()
+
+
+def read_plan(path: str):
+    """Open a plan written by PlanFile. Return (header, ops), where ops
+    generates (op number, operation dict) from 0, reading the plan as it goes.
+    Raise PlanError if it is not a plan photoPhav can apply, or OSError if it
+    can't be opened."""
+    pfile = open(path, encoding="utf-8")  # pylint: disable=consider-using-with
+    try:
+        header = json.loads(pfile.readline() or "null")
+        header = header["photoPhav_plan"]
+        if header.get("version") != PLAN_VERSION or header.get("mode") not in LINK_MODES:
+            raise PlanError(f"{path} is not a photoPhav plan (version {PLAN_VERSION})")
+        if header.get("shard"):
+            parse_shard(header["shard"], header.get("shard_by") or "dir")
+    except (ValueError, TypeError, KeyError, AttributeError) as err:
+        pfile.close()
+        raise PlanError(f"{path} is not a photoPhav plan: {err}") from err
+    except PlanError:
+        pfile.close()
+        raise
+
+    def ops():
+        with pfile:
+            for op_num, line in enumerate(pfile):
+                try:
+                    yield op_num, json.loads(line)
+                except ValueError as err:
+                    raise PlanError(f"{path} line {op_num + 2}: bad operation") from err
+
+    return header, ops()
+
+
+class PlanJournal:
+    """The progress journal of applying a plan, kept next to it (plan path +
+    JOURNAL_SUFFIX) as JSON lines, and fsync'd after every write so it
+    survives a crash. The first line identifies the plan (size and
+    modification time), so a journal is never used with a changed plan. Then
+    {"done": N} lines record that the first N operations are done, {"failed":
+    [dest, path]} lines record operations that failed, and {"complete": true}
+    ends it."""
+
+    def __init__(self, plan_path: str):
+        self.path = plan_path + JOURNAL_SUFFIX
+        st = os.stat(plan_path)
+        self.plan_id = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        self.done = 0
+        self.failed = set()
+        self.complete = False
+        try:
+            with open(self.path, encoding="utf-8") as jfile:
+                lines = [json.loads(line) for line in jfile if line.endswith("\n")]
+        except FileNotFoundError:
+            lines = None
+        except ValueError as err:
+            raise PlanError(f"Bad journal {self.path}: {err}") from err
+        if lines:
+            if lines[0].get("plan") != self.plan_id:
+                raise PlanError(
+                    f"The journal {self.path} is for a different plan. Remove it to apply \
+the plan from the start."
+                )
+            for entry in lines[1:]:
+                if "done" in entry:
+                    self.done = max(self.done, entry["done"])
+                elif "failed" in entry:
+                    self.failed.add(tuple(entry["failed"]))
+                elif entry.get("complete"):
+                    self.complete = True
+        # pylint: disable-next=consider-using-with
+        self._file = open(self.path, "a", encoding="utf-8")
+        if not lines:
+            self._write({"plan": self.plan_id})
+
+    def _write(self, entry: dict):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record_done(self, count: int, failed=()):
+        """Record that the first count operations are done, and those of them
+        that failed, as (dest, path)."""
+        for item in failed:
+            if item not in self.failed:
+                self.failed.add(item)
+                self._write({"failed": list(item)})
+        self.done = count
+        self._write({"done": count})
+
+    def record_complete(self):
+        """Record that the whole plan is done."""
+        self.complete = True
+        self._write({"complete": True})
+
+    def close(self):
+        """Close the journal."""
+        self._file.close()
+
+
+def apply_plan(plan_path: str, copy_threads=0, verbose=False, quiet=False):
+    """Do the operations of a plan written by PlanFile, continuing from its
+    journal if an earlier apply was interrupted. For a sync plan, write each
+    destination's manifest at the end, leaving out operations that failed.
+    Return the LinkWriters used (closed), for their counters, or None if the
+    journal says the plan was already applied. Raise PlanError (or OSError)
+    if the plan or journal can't be used."""
+    header, ops = read_plan(plan_path)
+    journal = PlanJournal(plan_path)
+    try:
+        if journal.complete:
+            return None
+        writers = [
+            LinkWriter(
+                header["source_dir"],
+                dest_root,
+                mode=header["mode"],
+                verbose=verbose,
+                quiet=quiet,
+                copy_threads=copy_threads,
+            )
+            for dest_root in header["dests"]
+        ]
+        if journal.done and verbose:
+            print(f"Resuming {plan_path} after {journal.done} operations.")
+        # (dest, path) of the failed operations since the last journal entry
+        failed = []
+        done = 0
+        for op_num, op in ops:
+            done = op_num + 1
+            if op_num < journal.done:
+                continue
+            writer = writers[op["dest"]]
+            rel_path = op["path"]
+            if op["op"] == "mkdir":
+                success = writer.make_dir(rel_path)
+            elif op["op"] == "link":
+                success = writer.link(rel_path, replace=op.get("replace", False))
+                if success and verbose:
+                    print(f"Linked {writer.dest_root}/{rel_path}")
+            elif op["op"] == "remove":
+                success = writer.remove_link(rel_path)
+                if success and verbose:
+                    print(f"Removed link {writer.dest_root}/{rel_path}")
+            else:
+                raise PlanError(f"{plan_path}: unknown operation {op['op']}")
+            if not success:
+                failed.append((op["dest"], rel_path))
+            if done % JOURNAL_EVERY == 0:
+                for index, writer in enumerate(writers):
+                    failed.extend((index, rel_path) for rel_path in writer.flush())
+                journal.record_done(done, failed)
+                failed = []
+        for index, writer in enumerate(writers):
+            failed.extend((index, rel_path) for rel_path in writer.flush())
+        journal.record_done(done, failed)
+        if header["sync"]:
+            _apply_plan_manifests(plan_path, header, writers, journal.failed)
+        for writer in writers:
+            writer.close()
+        journal.record_complete()
+    finally:
+        journal.close()
+    return writers
+
+
+def _apply_plan_manifests(plan_path: str, header: dict, writers: list, failed: set):
+    """Write the manifest of each destination of an applied sync plan: the
+    manifest from before the plan (not yet replaced, even when resuming) with
+    the plan's link and remove operations that didn't fail. A destination
+    without a manifest is read instead (see read_run_manifest())."""
+    shard = None
+    if header.get("shard"):
+        shard = parse_shard(header["shard"], header.get("shard_by") or "dir")
+    manifests = [
+        read_run_manifest(writer.dest_root, shard, files=writer.mode in FILE_MODES)
+        for writer in writers
+    ]
+    _, ops = read_plan(plan_path)
+    for _, op in ops:
+        links, update = manifests[op["dest"]]
+        if not update or (op["dest"], op["path"]) in failed:
+            continue
+        if op["op"] == "link":
+            links[op["path"]] = op["target"]
+        elif op["op"] == "remove":
+            links.pop(op["path"], None)
+    for writer, (links, _) in zip(writers, manifests):
+        write_run_manifest(writer.dest_root, links, shard)
+
+
+class WatchChanges:
+    """Changes under the source directory, as directories relative to the
+    source ('' for the source itself). dirty_dirs need their files
+    re-evaluated, new_trees are directories (and everything below them) that
+    appeared, and gone_trees are directories (and everything below them) that
+    disappeared. full_rescan means events were lost and everything needs to be
+    re-evaluated."""
+
+    def __init__(self):
+        self.dirty_dirs = set()
+        self.new_trees = set()
+        self.gone_trees = set()
+        self.full_rescan = False
+
+    def __bool__(self):
+        return bool(self.dirty_dirs or self.new_trees or self.gone_trees or self.full_rescan)
+
+    def merge(self, other):
+        """Add the changes in other to these."""
+        self.dirty_dirs |= other.dirty_dirs
+        self.new_trees |= other.new_trees
+        self.gone_trees |= other.gone_trees
+        self.full_rescan = self.full_rescan or other.full_rescan
+
+
+# inotify event flags, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+# Events of interest. Files that are written are reported when closed, so
+# a file written in several parts is one event.
+INOTIFY_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+
+class InotifyEvents:
+    """Change events for the source directory tree from Linux inotify, called
+    through ctypes (no extra packages needed). Each watched directory gets its
+    own watch, so watch() has to be called for every directory, including
+    new ones. Raise OSError if inotify is not available."""
+
+    def __init__(self, src_dir: str):
+        self.src_prefix = source_prefix(src_dir)
+        import ctypes  # pylint: disable=import-outside-toplevel
+        import ctypes.util  # pylint: disable=import-outside-toplevel
+
+        self._get_errno = ctypes.get_errno
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("inotify is not available: no C library found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err_num = self._get_errno()
+            raise OSError(err_num, "inotify_init1: " + os.strerror(err_num))
+        self._wd_dirs = {}  # watch descriptor -> rel dir
+        self._dir_wds = {}  # rel dir -> watch descriptor
+
+    def watch(self, rel_dir: str):
+        """Watch a directory, given relative to the source."""
+        if rel_dir in self._dir_wds:
+            return
+        path = os.fsencode(self.src_prefix + rel_dir if rel_dir else self.src_prefix or ".")
+        wd = self._libc.inotify_add_watch(self._fd, path, INOTIFY_MASK)
+        if wd < 0:
+            # Probably gone already, or out of watches
+            err_num = self._get_errno()
+            raise OSError(err_num, f"inotify_add_watch {os.fsdecode(path)}: {os.strerror(err_num)}")
+        self._wd_dirs[wd] = rel_dir
+        self._dir_wds[rel_dir] = wd
+
+    def unwatch_tree(self, rel_dir: str):
+        """Stop watching a directory and everything below it."""
+        prefix = rel_dir + "/"
+        watched_dirs = [
+            d for d in self._dir_wds if not rel_dir or d == rel_dir or d.startswith(prefix)
+        ]
+        for watched in watched_dirs:
+            wd = self._dir_wds.pop(watched)
+            self._wd_dirs.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def wait(self, timeout: float):
+        """Wait up to timeout seconds for events, and return them as
+        WatchChanges (empty if there were none)."""
+        changes = WatchChanges()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changes
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = struct.unpack_from("iIII", buf, offset)
+                name = os.fsdecode(buf[offset + 16 : offset + 16 + length].rstrip(b"\0"))
+                offset += 16 + length
+                self._add_event(changes, wd, mask, name)
+        return changes
+
+    def _add_event(self, changes: WatchChanges, wd: int, mask: int, name: str):
+        """Translate one inotify event into changes."""
+        if mask & IN_Q_OVERFLOW:
+            changes.full_rescan = True
+            return
+        rel_dir = self._wd_dirs.get(wd)
+        if rel_dir is None:
+            return
+        if mask & IN_IGNORED:
+            # The watch was removed (directory gone)
+            self._wd_dirs.pop(wd, None)
+            if self._dir_wds.get(rel_dir) == wd:
+                del self._dir_wds[rel_dir]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Reported to the parent directory as well
+            return
+        if mask & IN_ISDIR:
+            child = rel_dir + "/" + name if rel_dir else name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                changes.new_trees.add(child)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                changes.gone_trees.add(child)
+            return
+        changes.dirty_dirs.add(rel_dir)
+
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
+
+
+class PollEvents:
+    """Change events for the source directory tree found by polling, for
+    when inotify is not available (or not wanted, e.g. on network file
+    systems, where inotify does not see changes made by other hosts). The
+    whole tree is walked every interval seconds, and the files' sizes and
+    modification times are compared with the previous walk."""
+
+    def __init__(self, src_dir: str, interval: float, recursive, exclude_dirs, prune_dirs):
+        self.src_dir = src_dir
+        self.src_prefix = source_prefix(src_dir)
+        self.interval = interval
+        self.recursive = recursive
+        self.exclude_dirs = exclude_dirs
+        self.prune_dirs = prune_dirs
+        self._next_poll = time.monotonic() + interval
+        self._snapshot = self._take_snapshot()
+
+    def _take_snapshot(self):
+        """Return {rel dir: {name: (size, mtime_ns)}} for the tree."""
+        snapshot = {}
+        for dir_prefix, file_names in scan_dir(
+            self.src_dir, self.recursive, self.exclude_dirs, self.prune_dirs
+        ):
+            files = {}
+            for name in file_names:
+                try:
+                    st = os.stat(dir_prefix + name)
+                except OSError:
+                    continue
+                files[name] = (st.st_size, st.st_mtime_ns)
+            snapshot[dir_prefix[len(self.src_prefix) :].rstrip("/")] = files
+        return snapshot
+
+    def watch(self, rel_dir: str):
+        """Nothing to do. Every poll walks the whole tree."""
+
+    def unwatch_tree(self, rel_dir: str):
+        """Nothing to do. Every poll walks the whole tree."""
+
+    def wait(self, timeout: float):
+        """Wait up to timeout seconds for the next poll, and return the
+        changes it finds as WatchChanges (empty if there were none)."""
+        changes = WatchChanges()
+        delay = self._next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return changes
+        time.sleep(max(0.0, delay))
+        self._next_poll = time.monotonic() + self.interval
+        snapshot = self._take_snapshot()
+        for rel_dir, files in snapshot.items():
+            if self._snapshot.get(rel_dir) != files:
+                changes.dirty_dirs.add(rel_dir)
+        changes.gone_trees = set(self._snapshot) - set(snapshot)
+        self._snapshot = snapshot
+        return changes
+
+    def close(self):
+        """Nothing to close."""
+
+
+class FavoritesWatcher:
+    """Keeps the destination up to date as images and sidecars under the
+    source change, after an initial pass has made the destination match.
+
+    Changes come from an event source (InotifyEvents or PollEvents). They are
+    collected until there have been none for debounce seconds (editors
+    rewrite a sidecar several times per edit), or for at most max_delay
+    seconds, and then only the affected directories are re-evaluated.
+    There may be several destinations, each with its own LinkWriter in
+    writers. evaluate(batches) returns a list with the desired links
+    {relative link path: target} for each writer, for the (dir_prefix,
+    file_names) batches given, and the difference from the current links (see
+    set_links()) is applied with the writer. The manifests (the Shard's, for a
+    sharded run) are rewritten after each set of changes. With entries, the
+    batches hold the directory entries (see scan_dir()).
+
+    Call watch_tree() before the initial pass, so changes made during the
+    pass are not missed.
+
+    run() returns when stop() is called, e.g. from a signal handler."""
+
+    def __init__(
+        self,
+        src_dir: str,
+        events,
+        writers: list,
+        evaluate,
+        recursive=False,
+        exclude_dirs=(),
+        prune_dirs=(),
+        debounce=2.0,
+        verbose=False,
+        quiet=False,
+        shard=None,
+        entries=False,
+    ):
+        self.src_dir = src_dir
+        self.src_prefix = source_prefix(src_dir)
+        self.events = events
+        self.writers = writers
+        self.evaluate = evaluate
+        self.recursive = recursive
+        self.exclude_dirs = exclude_dirs
+        self.prune_dirs = prune_dirs
+        self.debounce = debounce
+        self.max_delay = max(debounce * 10, 30.0)
+        self.verbose = verbose
+        self.quiet = quiet
+        self.shard = shard
+        self.entries = entries
+        self._stop = False
+        # Current links for each writer, by directory:
+        # [{rel dir: {rel link path: target}}, ...]
+        self._links = [{} for _ in writers]
+
+    def set_links(self, links: list):
+        """Set the current links of each writer, as {relative link path:
+        target}, e.g. after the initial pass."""
+        self._links = []
+        for writer_links in links:
+            by_dir = {}
+            for rel_path, target in writer_links.items():
+                by_dir.setdefault(rel_path.rpartition("/")[0], {})[rel_path] = target
+            self._links.append(by_dir)
+
+    def links(self, index: int):
+        """Return the current links of writer index as {relative link path:
+        target}."""
+        return {
+            rel_path: target
+            for dir_links in self._links[index].values()
+            for rel_path, target in dir_links.items()
+        }
+
+    def stop(self):
+        """Ask run() to apply any pending changes and return."""
+        self._stop = True
+
+    def watch_tree(self, rel_dir: str = ""):
+        """Watch a directory and (if recursive) its sub-directories."""
+        for dir_prefix, _ in scan_dir(
+            self.src_dir,
+            self.recursive,
+            self.exclude_dirs,
+            self.prune_dirs,
+            start=rel_dir,
+        ):
+            try:
+                self.events.watch(dir_prefix[len(self.src_prefix) :].rstrip("/"))
+            except OSError as err:
+                if not self.quiet:
+                    print(f"WARNING: Can't watch {dir_prefix}: {err}")
+
+    def run(self):
+        """Wait for changes and apply them, until stop() is called."""
+        pending = WatchChanges()
+        first = last = None
+        while not self._stop:
+            changes = self.events.wait(1.0)
+            now = time.monotonic()
+            if changes:
+                pending.merge(changes)
+                last = now
+                if first is None:
+                    first = now
+            if pending and (now - last >= self.debounce or now - first >= self.max_delay):
+                self.apply(pending)
+                pending = WatchChanges()
+                first = last = None
+        if pending:
+            self.apply(pending)
+
+    def _in_scope(self, rel_dir: str):
+        """Return True if a directory is one photoPhav looks at."""
+        if not rel_dir:
+            return True
+        if not self.recursive:
+            return False
+        real_dir = os.path.join(os.path.realpath(self.src_dir), rel_dir)
+        # Check every level, since a parent may be excluded too
+        parts = rel_dir.split("/")
+        for depth in range(1, len(parts) + 1):
+            if dir_excluded("/".join(parts[:depth]), self.exclude_dirs):
+                return False
+        return real_dir not in self.prune_dirs and not any(
+            real_dir.startswith(pruned + "/") for pruned in self.prune_dirs
+        )
+
+    def apply(self, changes: WatchChanges):
+        """Re-evaluate the changed directories and update the links."""
+        if changes.full_rescan:
+            # Re-evaluate the whole tree, as if it had just appeared
+            if self.verbose:
+                print("\nEvents were lost. Re-evaluating everything.")
+            changes = WatchChanges()
+            changes.new_trees.add("")
+        # Directories (and below) that went away, or were moved away. If one
+        # came back, it is handled with the new ones.
+        for rel_dir in sorted(changes.gone_trees - changes.new_trees):
+            self.events.unwatch_tree(rel_dir)
+            self._reconcile([{} for _ in self.writers], self._tree_dirs(rel_dir))
+        # Directories (and below) that appeared, or were moved in
+        for rel_dir in sorted(changes.new_trees):
+            if not self._in_scope(rel_dir) or not os.path.isdir(self._src_path(rel_dir)):
+                continue
+            self.watch_tree(rel_dir)
+            batches = list(
+                scan_dir(
+                    self.src_dir,
+                    self.recursive,
+                    self.exclude_dirs,
+                    self.prune_dirs,
+                    start=rel_dir,
+                    entries=self.entries,
+                )
+            )
+            scanned = {prefix[len(self.src_prefix) :].rstrip("/") for prefix, _ in batches}
+            self._reconcile(self.evaluate(batches), scanned | self._tree_dirs(rel_dir))
+        # Directories whose files changed
+        for rel_dir in sorted(changes.dirty_dirs):
+            if any(
+                not tree or rel_dir == tree or rel_dir.startswith(tree + "/")
+                for tree in changes.new_trees
+            ):
+                continue  # already done
+            if not self._in_scope(rel_dir):
+                continue
+            batches = list(
+                scan_dir(
+                    self.src_dir,
+                    False,
+                    self.exclude_dirs,
+                    self.prune_dirs,
+                    start=rel_dir,
+                    entries=self.entries,
+                )
+            )
+            if batches:
+                self._reconcile(self.evaluate(batches), {rel_dir})
+            else:
+                self._reconcile([{} for _ in self.writers], {rel_dir})
+        for index, writer in enumerate(self.writers):
+            write_run_manifest(writer.dest_root, self.links(index), self.shard)
+            writer.close()
+
+    def _src_path(self, rel_dir: str):
+        """Return the path of a directory relative to the source."""
+        return self.src_prefix + rel_dir if rel_dir else self.src_prefix or "."
+
+    def _tree_dirs(self, rel_dir: str):
+        """Return the directories with links (for any writer) at or below
+        rel_dir."""
+        dirs = set()
+        prefix = rel_dir + "/"
+        for by_dir in self._links:
+            dirs.update(d for d in by_dir if not rel_dir or d == rel_dir or d.startswith(prefix))
+        return dirs
+
+    def _reconcile(self, desired: list, rel_dirs: set):
+        """Make the links in rel_dirs match desired, for each writer."""
+        for writer, writer_desired, by_dir in zip(self.writers, desired, self._links):
+            existing = {}
+            for rel_dir in rel_dirs:
+                existing.update(by_dir.get(rel_dir, {}))
+            adds, removes, retargets = diff_links(writer_desired, existing)
+            if writer.mode in FILE_MODES:
+                # Files of images changed since they were put in place
+                retargets += [
+                    rel_path
+                    for rel_path, target in writer_desired.items()
+                    if existing.get(rel_path) == target and not writer.is_current(rel_path, target)
+                ]
+            for rel_path in removes:
+                if writer.remove_link(rel_path):
+                    self._drop(by_dir, rel_path)
+                    if self.verbose:
+                        print(f"Removed link {writer.dest_root}/{rel_path}")
+            for rel_path in retargets + adds:
+                if writer.link(rel_path, replace=True):
+                    rel_dir = rel_path.rpartition("/")[0]
+                    by_dir.setdefault(rel_dir, {})[rel_path] = writer_desired[rel_path]
+                    if self.verbose:
+                        print(f"Linked {writer.dest_root}/{rel_path}")
+            for rel_path in writer.flush():
+                self._drop(by_dir, rel_path)
+
+    @staticmethod
+    def _drop(by_dir: dict, rel_path: str):
+        """Forget a link."""
+        rel_dir = rel_path.rpartition("/")[0]
+        dir_links = by_dir.get(rel_dir)
+        if dir_links is not None:
+            dir_links.pop(rel_path, None)
+            if not dir_links:
+                del by_dir[rel_dir]
+
+
+# The run as composable stages, for use as a library as well as by main():
+#
+#   config = PhavConfig(source_dir="/photos", recursive=True)
+#   filters = [compile_filter("Rating >= 3")]
+#   writers = make_writers(config, ["/photos/favorites"])
+#   tasks = pair(scan(config, prune_dirs={writers[0].dest_root}), config)
+#   results = read_ratings(tasks, config, cache)
+#   apply_links(select_favorites(results, filters), writers)
+#   for writer in writers:
+#       writer.close()
+#
+# Each stage is a generator that consumes the one before it, a directory (or
+# file) at a time. A long running process can keep a MetadataCache (and
+# Exempi) loaded, and run the stages for one folder after another with
+# scan(start=...). To keep the destinations up to date afterward, start
+# watching before the pass, and sync:
+#
+#   watcher = start_watch(config, writers, filters, cache)
+#   links = apply_links(select_favorites(results, filters), writers, sync=True)
+#   run_watch(watcher, links)  # until watcher.stop()
+class PhavConfig(NamedTuple):
+    """The options of a run that the stages need, with the command line
+    defaults. pattern is a compiled regular expression matched against the
+    path relative to the source (None for every file), types the file
+    suffixes read (None for every file), and shard a Shard (or None). fields
+    are the xmp fields sidecars are read for, e.g. filter_fields() of the
+    filters when no cache or catalog needs whole records."""
+
+    source_dir: str = "."
+    recursive: bool = False
+    exclude_dirs: tuple = ()
+    pattern: "re.Pattern | None" = None
+    types: "frozenset | None" = DEFAULT_IMAGE_TYPES
+    shard: "Shard | None" = None
+    sidecar_naming: str = "both"
+    prefer: str = PREFER_SIDECAR
+    ignore_file: bool = False
+    ignore_xmp: bool = False
+    fields: frozenset = SIDECAR_DONE_FIELDS
+    jobs: int = 1
+    io_threads: int = 0
+    mode: str = "symlink"
+    copy_threads: int = 4
+    verbose: bool = False
+    quiet: bool = False
+
+    @property
+    def select_options(self):
+        """The SelectOptions for read_ratings()."""
+        return SelectOptions(self.prefer, self.ignore_file, self.ignore_xmp, self.fields)
+
+    @property
+    def scan_entries(self):
+        """True if the scan keeps the directory entries, for the stat data
+        --prefer newest decides on (see pair_sidecars())."""
+        return self.prefer == PREFER_NEWEST and not self.ignore_xmp
+
+
+def scan(config: PhavConfig, prune_dirs=(), start="", stats=None):
+    """Walk the source (see scan_dir()), and generate (dir_prefix,
+    file_names) for each directory, with the names filtered by file type,
+    pattern, and shard (see filter_names()). prune_dirs are real paths never
+    walked, e.g. the destinations. start is a sub-directory (relative to the
+    source) to walk instead of the whole source. With verbose, the files of
+    each directory are listed. stats (a RunStats) gets the discovery and
+    filter phases and file counts."""
+    batches = scan_dir(
+        config.source_dir,
+        config.recursive,
+        config.exclude_dirs,
+        prune_dirs,
+        start=start,
+        shard=config.shard,
+        entries=config.scan_entries,
+    )
+    if stats:
+        batches = stats.timed_iter("discovery", batches)
+    batches = filter_batches(batches, config, stats)
+    if stats:
+        batches = stats.timed_iter("filter", batches)
+    return batches
+
+
+def filter_batches(batches, config: PhavConfig, stats=None):
+    """Apply the config's file type, pattern, and shard filters to the files
+    of each (dir_prefix, file_names) batch, e.g. from scan_dir()."""
+    if config.verbose:
+        from bpsPrettyPrint import listPrettyPrint1Col  # pylint: disable=import-outside-toplevel
+    root_len = len(source_prefix(config.source_dir))
+    for dir_prefix, file_names in batches:
+        matched = filter_names(
+            dir_prefix, file_names, root_len, config.pattern, config.types, config.shard
+        )
+        if config.verbose and matched:
+            print(f"\nThe following files will be processed in '{dir_prefix or './'}':")
+            listPrettyPrint1Col(list(matched))
+        if stats:
+            stats.count("files_scanned", len(file_names))
+            stats.count("files_matched", len(matched))
+        yield dir_prefix, matched
+
+
+def pair(batches, config: PhavConfig, ambiguous=None, stats=None):
+    """pair_sidecars() with the config's sidecar options: generate an (ifn,
+    ifx, scan_stats) task for each image of the batches from scan(). stats
+    gets the pairing phase and image counts."""
+    tasks = pair_sidecars(batches, config.sidecar_naming, config.ignore_xmp, ambiguous)
+    if stats:
+        tasks = _count_tasks(stats.timed_iter("pairing", tasks), stats)
+    return tasks
+
+
+def _count_tasks(tasks, stats: RunStats):
+    """Count the images, and the images paired with a sidecar."""
+    for task in tasks:
+        stats.count("images")
+        if task[1]:
+            stats.count("images_with_sidecar")
+        yield task
+
+
+def read_ratings(
+    tasks, config: PhavConfig, cache=None, stats=None, library=None, mtimes=False
+):
+    """Read the metadata of each (ifn, ifx, scan_stats) task from pair(), and generate
+    (ifn, XmpRecord or None, source), in task order (see extract_records()),
+    with the config's jobs or io_threads. With mtimes, the image mtime_ns is
+    added to each, for write_catalogs(). stats gets the extraction phase and
+    the read latencies."""
+    results = extract_records(
+        tasks,
+        config.select_options,
+        config.jobs,
+        cache,
+        stats,
+        config.io_threads,
+        library,
+        mtimes,
+    )
+    if stats:
+        results = stats.timed_iter("extraction", results)
+    return results
+
+
+def write_catalogs(results, catalogs: list, stats=None):
+    """Add each (ifn, record, source, mtime_ns) result (from read_ratings()
+    with mtimes) to the CatalogWriters, and pass on (ifn, record, source).
+    stats gets the catalog phase."""
+
+    def add_rows():
+        for ifn, record, source, mtime_ns in results:
+            for catalog in catalogs:
+                catalog.add(ifn, record, source, mtime_ns)
+            yield ifn, record, source
+
+    if stats:
+        return stats.timed_iter("catalog", add_rows())
+    return add_rows()
+
+
+def select_favorites(results, filters: list, stats=None):
+    """Generate (ifn, record, source, indexes) for each result (from
+    read_ratings() or a catalog) that is a favorite, where indexes are those
+    of the filters (compiled with compile_filter(), one per destination) the
+    record passes. stats gets the favorite counts."""
+    for ifn, record, source in results:
+        indexes = []
+        if record is not None:
+            indexes = [index for index, matches in enumerate(filters) if matches(record)]
+        if indexes:
+            if stats:
+                stats.count("favorites")
+            yield ifn, record, source, indexes
+        elif stats:
+            stats.count("not_favorites" if record else "no_xmp")
+
+
+def make_writers(config: PhavConfig, dest_dirs: list):
+    """Return a LinkWriter for each destination, with the config's output
+    mode and options."""
+    return [
+        LinkWriter(
+            config.source_dir,
+            dest_dir,
+            mode=config.mode,
+            verbose=config.verbose,
+            quiet=config.quiet,
+            copy_threads=config.copy_threads,
+        )
+        for dest_dir in dest_dirs
+    ]
+
+
+def apply_links(favorites, writers: list, sync=False, shard=None, stats=None, verbose=False):
+    """Link each favorite from select_favorites() with the writer of each
+    destination it is a favorite in. Return the links in place in each
+    destination, as {relative link path: target}, with sync, or empty dicts
+    otherwise.
+
+    With sync, the favorites are only collected, in a compact FileTable, and
+    each destination is then made to match them (see sync_links()), or the
+    Shard's part of it for a sharded run. The writers may be LinkPlanners, in
+    which case no manifest is written. stats gets the linking and sync
+    phases."""
+    linking = nullcontext()
+    if stats:
+        linking = StatsPhase(stats, "linking")
+    table = FileTable()
+    desired_rows = [array("I") for _ in writers]
+    for ifn, _, _, indexes in favorites:
+        with linking:
+            if sync:
+                row = table.add_file(ifn)
+                for index in indexes:
+                    desired_rows[index].append(row)
+            else:
+                for index in indexes:
+                    writers[index].link(writers[index].rel_path(ifn))
+    if not sync:
+        return [{} for _ in writers]
+    with StatsPhase(stats, "sync") if stats else nullcontext():
+        return [
+            sync_links(
+                (writer.rel_path(table.file_name(row)) for row in rows),
+                writer,
+                shard,
+                write_manifest=not isinstance(writer, LinkPlanner),
+                verbose=verbose,
+            )
+            for rows, writer in zip(desired_rows, writers)
+        ]
+
+
+def sync_links(rel_paths, writer, shard=None, write_manifest=True, verbose=False):
+    """Given the desired links as an iterable of link paths relative to the
+    destination, add, remove, and retarget links in the destination so it
+    matches. The existing links are taken from the manifest written by the
+    previous sync, or read from the destination if there isn't one (see
+    read_run_manifest()). Only symbolic links (and in the FILE_MODES, regular
+    files) are ever removed or replaced, and in a sharded run, only the
+    Shard's. Write the new manifest (unless write_manifest is False), and
+    return it as {relative link path: target}.
+
+    The desired links are compared with the existing ones as they are
+    generated, rather than collected first, to keep memory down for large
+    libraries."""
+    dest_dir = writer.dest_root
+    existing, from_manifest = read_run_manifest(dest_dir, shard, files=writer.mode in FILE_MODES)
+    if verbose and not from_manifest:
+        print(f"\nNo sync manifest found in {dest_dir}. Read the existing links.")
+    # The existing links not (yet) desired. Whatever is left at the end is
+    # removed.
+    unwanted = set(existing)
+    # The new manifest only records what is actually in place, so a failure
+    # is retried by the next sync. Built in place of existing.
+    current = existing
+    added = retargeted = total = 0
+    for rel_path in rel_paths:
+        total += 1
+        unwanted.discard(rel_path)
+        target = writer.link_target(rel_path)
+        old_target = current.get(rel_path)
+        if writer.is_current(rel_path, old_target):
+            continue
+        if writer.link(rel_path, replace=True):
+            current[rel_path] = target
+            if old_target is None:
+                added += 1
+            else:
+                retargeted += 1
+            if verbose:
+                print(f"Linked {dest_dir}/{rel_path}")
+    # Copies that failed are not in place
+    for rel_path in writer.flush():
+        current.pop(rel_path, None)
+    for rel_path in sorted(unwanted):
+        if writer.remove_link(rel_path):
+            del current[rel_path]
+            if verbose:
+                print(f"Removed link {dest_dir}/{rel_path}")
+    if write_manifest:
+        write_run_manifest(dest_dir, current, shard)
+    if verbose:
+        print(
+            f"\nSync {dest_dir}: {added} added, {len(unwanted)} removed, \
+{retargeted} retargeted, {total} links in total."
+        )
+    return current
+
+
+def favorite_rules(
+    rules: list, dest_dir: str, star_rating=None, ignore_star=False, color_labels=(), text=None
+):
+    """Return the LinkRules of a run, out of the rules given (if any), or
+    else dest_dir, and the star rating, color label, and filter expression
+    options. The star rating and color labels (each a comma separated list)
+    each make an image a favorite. A filter expression (or rules) replaces
+    the default star rating of 1, and narrows any explicit star rating or
+    labels. Return an empty list if nothing can be a favorite."""
+    labels = []
+    for label_list in color_labels:
+        labels.extend(label.strip() for label in label_list.split(",") if label.strip())
+    criteria = []
+    if not ignore_star and (star_rating is not None or not (text or rules)):
+        criteria.append(f"Rating >= {star_rating or 1}")
+    if labels:
+        quoted = ", ".join('"' + label.replace('"', "") + '"' for label in labels)
+        criteria.append("Label in {" + quoted + "}")
+    filter_expr = " or ".join(criteria)
+    if text:
+        filter_expr = f"({filter_expr}) and ({text})" if filter_expr else text
+    if rules:
+        if not filter_expr:
+            return list(rules)
+        return [
+            LinkRule(rule.dest_dir, f"({rule.expression}) and ({filter_expr})") for rule in rules
+        ]
+    if filter_expr:
+        return [LinkRule(dest_dir, filter_expr)]
+    return []
+
+
+def catalog_results(rows, source_dir: str, stats=None):
+    """Generate (ifn, record, source) for the (relative path, record, source)
+    rows of a catalog (see merge_catalogs()), as read_ratings() would for a
+    scan of source_dir. Nothing is scanned or read. stats gets the catalog
+    phase."""
+    src_prefix = source_prefix(source_dir)
+    results = ((src_prefix + rel_path, record, source) for rel_path, record, source in rows)
+    if stats:
+        return stats.timed_iter("catalog", results)
+    return results
+
+
+def evaluate_links(batches, config: PhavConfig, writers: list, filters: list, cache=None):
+    """Return the desired links {relative link path: target} of each writer
+    for the (dir_prefix, file_names) batches given, e.g. from scan_dir() for
+    the directories that changed. Used by start_watch()."""
+    tasks = pair(filter_batches(batches, config), config)
+    desired = [{} for _ in writers]
+    for ifn, _, _, indexes in select_favorites(read_ratings(tasks, config, cache), filters):
+        for index in indexes:
+            writer = writers[index]
+            rel_path = writer.rel_path(ifn)
+            desired[index][rel_path] = writer.link_target(rel_path)
+    if cache is not None:
+        cache.commit()
+    return desired
+
+
+def start_watch(
+    config: PhavConfig,
+    writers: list,
+    filters: list,
+    cache=None,
+    prune_dirs=(),
+    poll=False,
+    poll_interval=10.0,
+    debounce=2.0,
+):
+    """Start watching the source for changes, and return the
+    FavoritesWatcher, for run_watch() once the initial pass is done. Changes
+    are found with inotify, or if poll is given or inotify isn't available,
+    by polling every poll_interval seconds. Changed directories are
+    evaluated (see evaluate_links()) in this process, since there are
+    usually only a few. prune_dirs are real paths never watched, e.g. the
+    destinations."""
+    watch_config = config._replace(jobs=1, verbose=False)
+    events = None
+    if not poll:
+        try:
+            events = InotifyEvents(config.source_dir)
+        except OSError as err:
+            if not config.quiet:
+                print(f"WARNING: Can't use inotify ({err}). Polling for changes instead.")
+    if events is None:
+        events = PollEvents(
+            config.source_dir, poll_interval, config.recursive, config.exclude_dirs, prune_dirs
+        )
+    watcher = FavoritesWatcher(
+        config.source_dir,
+        events,
+        writers,
+        lambda batches: evaluate_links(batches, watch_config, writers, filters, cache),
+        recursive=config.recursive,
+        exclude_dirs=config.exclude_dirs,
+        prune_dirs=prune_dirs,
+        debounce=debounce,
+        verbose=config.verbose,
+        quiet=config.quiet,
+        shard=config.shard,
+        entries=config.scan_entries,
+    )
+    watcher.watch_tree()
+    return watcher
+
+
+def run_watch(watcher: FavoritesWatcher, links: list):
+    """Keep the destinations up to date, given the links from the initial
+    pass (see apply_links()), until watcher.stop() is called, e.g. from a
+    signal handler."""
+    watcher.set_links(links)
+    watcher.run()
+    watcher.events.close()
+
+
+def count_run_stats(stats: RunStats, writers: list, ambiguous=(), cache=None, library=None):
+    """Add the writers', cache's, and library's counts to the run stats, and
+    finish them, once the run is done."""
+    for writer in writers:
+        stats.count("links_made", writer.linked)
+        stats.count("links_existing", writer.existing)
+        stats.count("links_removed", writer.removed)
+        stats.count("link_errors", writer.errors)
+        stats.count("dirs_created", writer.dirs_created)
+        stats.count("files_copied", writer.copied)
+    stats.count("sidecars_ambiguous", len(ambiguous))
+    reads = sum(entry[0] for entry in stats.reads.values())
+    stats.count("metadata_reads", reads)
+    if cache is not None:
+        stats.count("cache_hits", cache.hits)
+        stats.count("cache_misses", cache.misses)
+        stats.count("cache_stale", cache.stale)
+        stats.count("files_parsed", cache.misses)
+    else:
+        stats.count("files_parsed", reads)
+    if library is not None:
+        stats.count("library_hits", library.hits)
+        stats.count("library_misses", library.misses)
+    stats.finish()
+
+
+def report_stats(stats: RunStats, show=True, json_path=None):
+    """Print the run stats summary if show, and write them as JSON to
+    json_path ('-' for standard output) if given."""
+    if show:
+        stats.print_summary()
+    if json_path == "-":
+        print(json.dumps(stats.as_dict(), indent=2))
+    elif json_path:
+        with open(json_path, "w", encoding="utf-8") as sfile:
+            json.dump(stats.as_dict(), sfile, indent=2)
+
+
+def report_ambiguous(ambiguous: dict):
+    """Print the images that had more than one candidate sidecar (see
+    pair()), with their candidates. The first one listed is the one used."""
+    if not ambiguous:
+        return
+    print(
+        f"\nWARNING: {len(ambiguous)} image file(s) had more \
+than one xmp sidecar file. The first sidecar listed was used:"
+    )
+    for image_path in sorted(ambiguous):
+        print(f"  {image_path}:")
+        for xmp_path in ambiguous[image_path]:
+            print(f"    {xmp_path}")
+
+
+def build_parser():
+    """Return the command line argument parser, with main's docstring as the
+    help text."""
+    # Description string will show up in help.
+    DESC_STR = main.__doc__
+    # Create an epilogue string to further describe the input file
+    # The epilogue will show up at the bottom of the help
+    EPL_STR = ""
+
+    # **** argument parsing
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=DESC_STR,
+        epilog=EPL_STR,
+    )
+    # define the arguments
+    # star rating
+    sr_group = parser.add_mutually_exclusive_group(required=False)
+    sr_group.add_argument(
+        "-S",
+        "--star_rating",
+        default=None,
+        type=int,
+        choices=range(1, 6),  # 1-5
+        metavar="rating",
+        help="Star rating. Values equal or greater are considered Favorites \
+and a link will be created. Default value is 1, so any stared image is a favorite. \
+Mutually exclusive with the -s/--ignore_star rating.",
+    )
+    sr_group.add_argument(
+        "-s",
+        "--ignore_star",
+        action="store_true",
+        help="Ignore star ratings \
+if set. Mutually exclusive with the -S/--star_rating option.",
+    )
+    # color label
+    cl_group = parser.add_mutually_exclusive_group(required=False)
+    cl_group.add_argument(
+        "-C",
+        "--color_label",
+        action="append",
+        metavar="label",
+        help="Color label, e.g. Red. Images with this label are considered \
+Favorites and a link will be created. May be given more than once, or as a \
+comma separated list. Mutually exclusive with the -c/--ignore_color option.",
+    )
+    cl_group.add_argument(
+        "-c",
+        "--ignore_color",
+        action="store_true",
+        help="Color label will be ignored if this option is given. This is the \
+default unless -C/--color_label is given. Mutually exclusive with the \
+-C/-color_label option.",
+    )
+    # filter expression
+    parser.add_argument(
+        "--filter",
+        metavar="expression",
+        help="Favorites filter expression, e.g. 'Rating >= 4 or Label in {Red, \
+Green}'. Fields: Rating, Label, Pick. Flags: pick, reject. Combine with and, or, \
+not, and parentheses.",
+    )
+    # source dir
+    parser.add_argument(
+        "-I",
+        "--source_dir",
+        default=".",
+        metavar="path",
+        help="Source directory. Look in this directory for image files. Omit \
+the option or specify '.' to use the working directory.",
+    )
+    # destination dir
+    parser.add_argument(
+        "-d",
+        "-D",
+        "--destination_dir",
+        default="favorites",
+        metavar="path",
+        help="Destination directory.  Create the links in this directory. \
+If this option is not provided, a 'favorites' sub directory in the working \
+directory will first be created if it does not exist, and will used for the \
+destination path.",
+    )
+    # recourse thru the source directory
+    parser.add_argument(
+        "-r",
+        "-R",
+        "--recursive",
+        action="store_true",
+        help="Search for image files recursively, starting at the source directory.",
+    )
+    # xmp options
+    fx_pattern = parser.add_mutually_exclusive_group(required=False)
+    fx_pattern.add_argument(
+        "-F",
+        "--file_priority",
+        action="store_true",
+        help="Give priority to information embedded in the image file. Without \
+this option, priority is given to a xmp 'sidecar' file if one exists, and the \
+embedded xmp data would only be used if the xmp sidecar file does not exist or \
+can't be read or for some reason isn't usable. Mutually exclusive with \
+-f/--ignore_file option.",
+    )
+    parser.add_argument(
+        "--prefer",
+        choices=PREFER_POLICIES,
+        help="Metadata source to read first for an image with a sidecar: the \
+sidecar, the image file (embedded), or whichever was modified last (newest). The \
+other is read only if the first has no xmp data. Default: sidecar.",
+    )
+    fx_pattern.add_argument(
+        "-f",
+        "--ignore_file",
+        action="store_true",
+        help="Ignore xmp data embedded in the image file, even if it exists. \
+Mutually exclulsive with -F/--file_priority option.",
+    )
+    parser.add_argument(
+        "-x",
+        "--ignore_xmp",
+        action="store_true",
+        help="Ignore xmp files even if they are present.",
+    )
+    # metadata cache
+    parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=default_cache_path(),
+        metavar="path",
+        help="Use a persistent metadata cache so files that have not changed \
+since the last run are not parsed again. If path is omitted, the default \
+location is used: " + default_cache_path(),
+    )
+    # plan and apply
+    plan_group = parser.add_mutually_exclusive_group(required=False)
+    plan_group.add_argument(
+        "--plan",
+        metavar="file",
+        help="Write a plan of the destination changes to file ('-' for standard \
+output) instead of making them. Mutually exclusive with --apply and --watch.",
+    )
+    plan_group.add_argument(
+        "--apply",
+        metavar="file",
+        help="Make the changes in a plan written by --plan, resuming an \
+interrupted apply from its journal, and exit.",
+    )
+    # ratings catalog
+    catalog_group = parser.add_mutually_exclusive_group(required=False)
+    catalog_group.add_argument(
+        "--catalog",
+        action="append",
+        metavar="file",
+        help="Write a catalog of every file's rating, label, pick, metadata \
+source, and modification time. SQLite for .db, .sqlite, or .sqlite3 files, \
+JSON lines otherwise. May be given more than once.",
+    )
+    catalog_group.add_argument(
+        "--from_catalog",
+        action="append",
+        metavar="file",
+        help="Make the links from a catalog written by --catalog, without \
+reading any images. Give it once per shard to merge the catalogs of a sharded \
+run. Mutually exclusive with --catalog, --shard, and --watch.",
+    )
+    # split the source over several hosts
+    parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        help="Process only shard i (1 to N) of the source, split N ways by a \
+stable hash, e.g. on one of N hosts.",
+    )
+    parser.add_argument(
+        "--shard_by",
+        default="dir",
+        choices=SHARD_BY,
+        help="Assign files to shards by their top level directory (dir) or \
+their relative path (path). Default: dir.",
+    )
+    parser.add_argument(
+        "--merge_stats",
+        action="append",
+        metavar="file",
+        help="Add the --stats_json statistics of a shard's run to the run \
+statistics, when merging shards. May be given more than once.",
+    )
+    cache_cmd = parser.add_mutually_exclusive_group(required=False)
+    cache_cmd.add_argument(
+        "--cache_prune",
+        action="store_true",
+        help="Remove cache entries for files that no longer exist or have \
+changed, and exit. Uses the default cache location unless --cache path is given.",
+    )
+    cache_cmd.add_argument(
+        "--cache_clear",
+        action="store_true",
+        help="Remove all cache entries, and exit. Uses the default cache \
+location unless --cache path is given.",
+    )
+    # reconcile the destination instead of only adding links
+    parser.add_argument(
+        "--sync",
+        action="store_true",
+        help="Make the destination match the current favorites: add new links, \
+remove links to images that are no longer favorites, and retarget changed links. \
+A manifest of the links is kept in the destination directory for the next run.",
+    )
+    # keep the destination up to date
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="After the initial sync, keep running and update the destination \
+as images and sidecars change. Implies --sync. Stop with Ctrl-C.",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="With --watch, find changes by walking the source periodically \
+instead of using inotify, e.g. for network file systems.",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        default=10.0,
+        type=float,
+        metavar="seconds",
+        help="With --watch --poll, the time between walks of the source. Default: 10.",
+    )
+    parser.add_argument(
+        "--debounce",
+        default=2.0,
+        type=float,
+        metavar="seconds",
+        help="With --watch, apply changes once there have been none for this \
+long. Default: 2.",
+    )
+    # several destinations from one scan
+    parser.add_argument(
+        "--rule",
+        action="append",
+        metavar="dest=expression",
+        help="Link images matching the filter expression into dest. May be \
+given more than once, to fill several destinations from one scan. Replaces \
+-d/--destination_dir.",
+    )
+    parser.add_argument(
+        "--rules",
+        metavar="file",
+        help="Read dest=expression rules from a file, one per line.",
+    )
+    # link style
+    parser.add_argument(
+        "--relative_links",
+        action="store_true",
+        help="Make symbolic links with paths relative to the link, so the \
+destination still works if the source and destination are moved together. \
+Same as --mode relsymlink.",
+    )
+    # output mode
+    parser.add_argument(
+        "--mode",
+        choices=LINK_MODES,
+        help="What to put in the destination: symbolic links (symlink, \
+relsymlink), hard links (hardlink), clones sharing the image data (reflink), or \
+copies (copy). Default: symlink.",
+    )
+    parser.add_argument(
+        "--copy_threads",
+        default=4,
+        type=int,
+        metavar="N",
+        help="Number of copies made at once with --mode hardlink (across file \
+systems), reflink, or copy. Default: 4.",
+    )
+    # skip source sub-directories
+    parser.add_argument(
+        "--exclude_dir",
+        action="append",
+        metavar="pattern",
+        help="Do not search source sub-directories whose name or path relative \
+to the source directory matches this glob pattern. May be given more than once.",
+    )
+    parser.add_argument(
+        "--sidecar_naming",
+        default="both",
+        choices=SIDECAR_NAMING,
+        help="Sidecar naming convention(s) to honor. 'stem': foo.jpg uses \
+foo.xmp. 'full': foo.jpg uses foo.jpg.xmp. 'both': either, preferring foo.jpg.xmp \
+if both exist. Default: both.",
+    )
+    # ratings from a photo manager library
+    parser.add_argument(
+        "--library",
+        metavar="file",
+        help="darktable (library.db) or digiKam (digikam4.db) library database \
+to take ratings and labels from. Images it doesn't know are read as usual.",
+    )
+    # parallel metadata extraction
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        metavar="N",
+        help="Number of worker processes used to read metadata. 0 uses one \
+per CPU. Default: 1 (no worker processes).",
+    )
+    parser.add_argument(
+        "--io_threads",
+        default=0,
+        type=int,
+        metavar="N",
+        help="Number of threads used to read metadata, for high-latency \
+(network) file systems. Default: 0 (no threads). Mutually exclusive with -j/--jobs.",
+    )
+    # file types to read
+    parser.add_argument(
+        "--types",
+        action="append",
+        metavar="extensions",
+        help="Comma separated file extensions to read metadata from, e.g. jpg,nef. \
+'default' is common image and raw formats, 'all' is every file. May be given more \
+than once. Default: default.",
+    )
+    # Mutually exclusive pattern group
+    og_pattern = parser.add_mutually_exclusive_group(required=False)
+    og_pattern.add_argument(
+        "-g",
+        "--globp",
+        metavar="pattern",
+        help="Glob style pattern. Mutually exclusive with -e/--regexp option.",
+    )
+    og_pattern.add_argument(
+        "-e",
+        "--regexp",
+        metavar="pattern",
+        help="Regular expression style pattern. Mutually exclusive with -g/--globp option.",
+    )
+    # ignore case if file name otherwise matches the glob or regex pattern
+    parser.add_argument(
+        "-i",
+        "--ignore_case",
+        action="store_true",
+        help="Ignore case if file name otherwise matches the glob or regex pattern. \
+Ignored if neither -g/--globp or -e/--regexp options are specified.",
+    )
+    # run statistics
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Show a summary of the time spent in each phase, counts of files \
+scanned, parsed, linked, etc., and metadata read latency at the end of the run.",
+    )
+    parser.add_argument(
+        "--stats_json",
+        metavar="file",
+        help="Write the run statistics as JSON to file ('-' for standard output).",
+    )
+    parser.add_argument(
+        "--stats_top",
+        default=10,
+        type=int,
+        metavar="N",
+        help="Number of slowest metadata reads to list in the statistics. Default: 10.",
+    )
+    # Mutually exclusive output messaging group
+    og_output = parser.add_mutually_exclusive_group(required=False)
+    # verbose output
+    og_output.add_argument(
+        "-v", "--verbose", action="store_true", help="Verbose output"
+    )
+    # quiet output
+    og_output.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Suppress all output, including errors and warnings.",
+    )
+    # show only errors and warnings
+    og_output.add_argument(
+        "-w",
+        "--show_ew",
+        action="store_true",
+        help="Show only errors and warnings.",
+    )
+    return parser
+
+
+def config_from_args(args):
+    """Check the parsed command line arguments that set how the source is
+    read and the links are made, and return them as a PhavConfig. Print an
+    error (unless quiet) and exit on a bad or conflicting option."""
+    # check for --ignore_file and --ignore_xmp. If both options are present
+    # there is no action. Warn (if not quiet) and quit. These are not treated
+    # as mutually exclusive, becuase --file_priority and --ignore_file are already
+    # in a mutually exclusive group, so I don't think --ignore_file and
+    # --ignore_xmp can be in a different mutually exclusive group. Furthermore
+    # note that --file_priority and --ignore_xmp is valid, so --ignore_xmp can't
+    # be added to the exiting file mutually exclusive group.
+    # Check for the case manually.
+    if args.ignore_file and args.ignore_xmp:
+        if not args.quiet:
+            print(
+                "\nWARNING: -f/--ignore_file and -x/--ignore_xmp options are both \
+selected. This will result in no action as there is no data to act on, and is \
+probably not what was intended."
+            )
+        sys_exit(2)
+
+    jobs = args.jobs
+    if jobs < 0:
+        if not args.quiet:
+            print("ERROR: -j/--jobs must be 0 or more.")
+        sys_exit(2)
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if args.io_threads < 0 or (args.io_threads and jobs > 1):
+        if not args.quiet:
+            print("ERROR: --io_threads must be 0 or more, and can't be used with -j/--jobs.")
+        sys_exit(2)
+
+    # Output mode. --relative_links is the same as --mode relsymlink.
+    mode = args.mode
+    if mode is None:
+        mode = "relsymlink" if args.relative_links else "symlink"
+    elif args.relative_links and mode != "relsymlink":
+        if not args.quiet:
+            print("ERROR: --relative_links can't be used with --mode " + mode + ".")
+        sys_exit(2)
+    if args.copy_threads < 0:
+        if not args.quiet:
+            print("ERROR: --copy_threads must be 0 or more.")
+        sys_exit(2)
+
+    # Metadata source preference. -F/--file_priority is the same as --prefer
+    # embedded.
+    prefer = args.prefer
+    if prefer is None:
+        prefer = PREFER_EMBEDDED if args.file_priority else PREFER_SIDECAR
+    elif args.file_priority and prefer != PREFER_EMBEDDED:
+        if not args.quiet:
+            print("ERROR: -F/--file_priority can't be used with --prefer " + prefer + ".")
+        sys_exit(2)
+
+    # The slice of the source this run processes, if sharded
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard, args.shard_by)
+        except ValueError as err:
+            if not args.quiet:
+                print(f"ERROR: Bad --shard option: {err}.")
+            sys_exit(2)
+        if args.from_catalog:
+            if not args.quiet:
+                print("ERROR: --shard can't be used with --from_catalog.")
+            sys_exit(2)
+
+    # Search the source directory for files based on recursive, glob, and regex
+    # options. Since the case-insensitive globp or regexp options will use regex,
+    # simplify the pattern matching by listing all files and then using
+    # regex to match patterns, converting glopb option to a regex if necessary.
+
+    # Start out with no pattern (all files). Then limit based on options.
+    # Convert globp option to a regex
+    re_pattern = None
+    if args.globp:
+        re_pattern = fnmatch.translate(args.globp)
+    if args.regexp:
+        re_pattern = args.regexp
+    if re_pattern is not None and args.ignore_case:
+        # prepend (?i) to regex pattern to ignore case
+        re_pattern = r"(?i)" + re_pattern
+
+    # At this point, any file name filtering will be done with regex. Glob
+    # patterns were converted to regex above. Compile it once, which also
+    # catches a bad pattern before any work is done.
+    re_compiled = None
+    try:
+        if re_pattern is not None:
+            re_compiled = re.compile(re_pattern)
+    except re.error as err:
+        if not args.quiet:
+            print("ERROR: Regular Expression Error. Bad escape?")
+            print(err)
+            sys_exit("Exiting.")
+        else:
+            sys_exit(1)
+
+    if args.verbose and (args.globp or args.regexp):
+        if args.globp:
+            print("\nSource files will be filtered with the '" + args.globp + "' glob pattern.")
+        else:
+            print("\nSource files will be filtered with the '" + args.regexp + "' regex pattern.")
+        if args.ignore_case:
+            print("Note the i-/--ignore_case option is in effect, so file name")
+            print("case will ignored when considering a match.")
+
+    # The file types to read. Anything else is skipped by its suffix alone,
+    # before any metadata is read.
+    try:
+        file_types = parse_types(args.types or ["default"])
+    except ValueError as err:
+        if not args.quiet:
+            print(f"ERROR: Bad --types option: {err}.")
+            sys_exit("Exiting.")
+        else:
+            sys_exit(1)
+    if args.verbose:
+        if file_types is None:
+            print("\nAll file types will be read.")
+        else:
+            print(f"\nThe following file types will be read: {' '.join(sorted(file_types))}")
+
+    return PhavConfig(
+        source_dir=args.source_dir,
+        recursive=args.recursive,
+        exclude_dirs=tuple(args.exclude_dir or ()),
+        pattern=re_compiled,
+        types=file_types,
+        shard=shard,
+        sidecar_naming=args.sidecar_naming,
+        prefer=prefer,
+        ignore_file=args.ignore_file,
+        ignore_xmp=args.ignore_xmp,
+        jobs=jobs,
+        io_threads=args.io_threads,
+        mode=mode,
+        copy_threads=args.copy_threads,
+        verbose=args.verbose,
+        quiet=args.quiet,
+    )
+
+
+class RunOptions(NamedTuple):
+    """What a run() does with a PhavConfig: the LinkRules of the favorites,
+    keeping the destinations in sync (and watching the source), the metadata
+    cache, library, catalogs, and plan used, and the statistics and messages
+    shown. See main's docstring for the options."""
+
+    rules: list
+    sync: bool = False
+    watch: bool = False
+    poll: bool = False
+    poll_interval: float = 10.0
+    debounce: float = 2.0
+    cache: "str | None" = None
+    cache_prune: bool = False
+    cache_clear: bool = False
+    library: "str | None" = None
+    plan: "str | None" = None
+    apply: "str | None" = None
+    catalog: tuple = ()
+    from_catalog: tuple = ()
+    stats: bool = False
+    stats_json: "str | None" = None
+    stats_top: int = 10
+    merge_stats: tuple = ()
+    show_ew: bool = False
+
+
+def options_from_args(args):
+    """Check the parsed command line arguments that set what is linked where
+    and what else a run does, and return them as RunOptions. Print an error
+    (unless quiet) and exit on a bad or conflicting option."""
+    if args.plan and args.watch:
+        if not args.quiet:
+            print("ERROR: --plan can't be used with --watch.")
+        sys_exit(2)
+
+    if args.from_catalog and args.watch:
+        if not args.quiet:
+            print("ERROR: --from_catalog can't be used with --watch.")
+        sys_exit(2)
+
+    if args.poll_interval <= 0 or args.debounce < 0:
+        if not args.quiet:
+            print("ERROR: --poll_interval must be more than 0, and --debounce 0 or more.")
+        sys_exit(2)
+
+    # Read the rules, if any. Each rule is a destination and the filter
+    # expression for the images linked there.
+    rules = []
+    try:
+        if args.rules:
+            rules.extend(read_rules_file(args.rules))
+        for rule_text in args.rule or ():
+            rules.append(parse_rule(rule_text))
+    except (FilterExpressionError, OSError) as err:
+        if not args.quiet:
+            print("ERROR: Bad --rule or --rules.")
+            print(err)
+            sys_exit("Exiting.")
+        else:
+            sys_exit(1)
+
+    # Build the favorites filter out of the star rating, color label, and
+    # filter expression options
+    rules = favorite_rules(
+        rules,
+        args.destination_dir,
+        args.star_rating,
+        args.ignore_star,
+        args.color_label or (),
+        args.filter,
+    )
+    if not rules:
+        if not args.quiet:
+            print(
+                "\nWARNING: -s/--ignore_star is selected without -C/--color_label \
+or --filter. This will result in no action as nothing can be a favorite, and is \
+probably not what was intended."
+            )
+        sys_exit(2)
+    dest_roots = [os.path.realpath(rule.dest_dir) for rule in rules]
+    if len(set(dest_roots)) < len(dest_roots):
+        if not args.quiet:
+            print("ERROR: More than one rule has the same destination.")
+        sys_exit(2)
+
+    return RunOptions(
+        rules=rules,
+        # Watching keeps the destination in sync
+        sync=args.sync or args.watch,
+        watch=args.watch,
+        poll=args.poll,
+        poll_interval=args.poll_interval,
+        debounce=args.debounce,
+        cache=args.cache,
+        cache_prune=args.cache_prune,
+        cache_clear=args.cache_clear,
+        library=args.library,
+        plan=args.plan,
+        apply=args.apply,
+        catalog=tuple(args.catalog or ()),
+        from_catalog=tuple(args.from_catalog or ()),
+        # Merged shard statistics are shown unless they are written as JSON
+        stats=args.stats or bool(args.merge_stats and not args.stats_json),
+        stats_json=args.stats_json,
+        stats_top=args.stats_top,
+        merge_stats=tuple(args.merge_stats or ()),
+        show_ew=args.show_ew,
+    )
+
+
+def run(config: PhavConfig, options: RunOptions):
+    """Make a run of photoPhav, as main() does for the command line: link
+    the favorites of the source (or a catalog) by the options' rules, or plan
+    it, or apply a plan, or maintain the metadata cache, and report on it.
+    Return the exit status. Print an error (unless quiet) and exit if a file
+    the run needs can't be read or written."""
+    quiet = config.quiet
+    verbose = config.verbose
+
+    # Compile the filters once
+    try:
+        favorite_filters = [compile_filter(rule.expression) for rule in options.rules]
+    except FilterExpressionError as err:
+        if not quiet:
+            print("ERROR: Bad --filter expression.")
+            print(err)
+            sys_exit("Exiting.")
+        else:
+            sys_exit(1)
+
+    # Collect run statistics only if asked for
+    stats = None
+    if options.stats or options.stats_json:
+        stats = RunStats(options.stats_top)
+        stats.jobs = config.jobs
+        if config.shard is not None:
+            stats.shard = config.shard.label
+        for path in options.merge_stats:
+            try:
+                with open(path, encoding="utf-8") as sfile:
+                    shard_stats = json.load(sfile)
+                if not isinstance(shard_stats, dict):
+                    raise ValueError("not run statistics")
+            except (OSError, ValueError) as err:
+                if not quiet:
+                    print(f"ERROR: Could not read the statistics {path}.")
+                    print(err)
+                    sys_exit("Exiting.")
+                else:
+                    sys_exit(1)
+            stats.add_shard(shard_stats)
+
+    # Cache maintenance commands. Do the maintenance and leave.
+    if options.cache_prune or options.cache_clear:
+        cache = MetadataCache(options.cache or default_cache_path())
+        if options.cache_prune:
+            count = cache.prune()
+        else:
+            count = cache.clear()
+        cache.close()
+        if not quiet and not options.show_ew:
+            print(f"Removed {count} entries from the metadata cache {cache.db_path}.")
+        return 0
+
+    # Apply a plan. Everything needed is in the plan. Do it and leave.
+    if options.apply:
+        try:
+            applied = apply_plan(options.apply, config.copy_threads, verbose, quiet)
+        except (PlanError, OSError) as err:
+            if not quiet:
+                print(f"ERROR: Could not apply the plan {options.apply}.")
+                print(err)
+                sys_exit("Exiting.")
+            else:
+                sys_exit(1)
+        if not quiet and not options.show_ew:
+            if applied is None:
+                print(
+                    f"The plan {options.apply} was already applied. Remove \
+{options.apply}{JOURNAL_SUFFIX} to apply it again."
+                )
+            for writer in applied or ():
+                print(
+                    f"Applied the plan to {writer.dest_root}: {writer.linked} made, \
+{writer.existing} already existed, {writer.removed} removed, \
+{writer.dirs_created} directories created, {writer.errors} errors."
+                )
+        errors = sum(writer.errors for writer in applied or ())
+        return 1 if errors else 0
+
+    # Open the metadata cache, if one is used
+    cache = None
+    if options.cache:
+        try:
+            cache = MetadataCache(options.cache)
+        except sqlite3.Error as err:
+            if not quiet:
+                print(f"ERROR: Could not open the metadata cache {options.cache}.")
+                print(err)
+                sys_exit("Exiting.")
+            else:
+                sys_exit(1)
+
+    if verbose:
+        for rule in options.rules:
+            print(f"\nImages matching {rule.expression} will be linked in {rule.dest_dir}")
+        if config.shard is not None:
+            print(
+                f"\nOnly shard {config.shard.label} of the source will be processed \
+(by {config.shard.by})."
+            )
+
+    # Open the catalog(s) to link from, if any. Its source directory is the
+    # source. The catalogs of all the shards of a run are merged.
+    catalog_rows = None
+    if options.from_catalog:
+        try:
+            source_dir, catalog_rows = merge_catalogs(list(options.from_catalog))
+        except (CatalogError, OSError) as err:
+            if not quiet:
+                print(f"ERROR: Could not read the catalog {' '.join(options.from_catalog)}.")
+                print(err)
+                sys_exit("Exiting.")
+            else:
+                sys_exit(1)
+        config = config._replace(source_dir=source_dir)
+
+    # Load the ratings from a library database, if one is given. Not needed
+    # when linking from a catalog.
+    library = None
+    if options.library and catalog_rows is None:
+        try:
+            library = RatingsLibrary(options.library, config.source_dir)
+        except LibraryError as err:
+            if not quiet:
+                print(f"ERROR: Could not read the library {options.library}.")
+                print(err)
+                sys_exit("Exiting.")
+            else:
+                sys_exit(1)
+        if verbose:
+            print(
+                f"\nThe {library.kind} library {options.library} has ratings for \
+{len(library)} images in the source directory."
+            )
+
+    # Establish source and destination paths
+    path_src = Path(config.source_dir)
+    dest_roots = [os.path.realpath(rule.dest_dir) for rule in options.rules]
+    if verbose:
+        print("The source path is:")
+        print(path_src.resolve())
+        print("The destination path(s):")
+        for dest_root in dest_roots:
+            print(dest_root)
+
+    # Without a cache or catalog, which keep whole records, sidecars are only
+    # read until they have the fields the filters use
+    if cache is None and not options.catalog:
+        config = config._replace(
+            fields=filter_fields(rule.expression for rule in options.rules)
+        )
+
+    # Walk the source directory one directory at a time, rather than listing
+    # the whole tree up front, so work starts right away and memory use is
+    # bounded by the largest directory. Never walk into a destination, which
+    # may be inside the source, or (sharding by directory) the top level
+    # directories of other shards. Then pair each image with its sidecar (if
+    # any), a directory at a time. If xmp is ignored (-x/--ignore_xmp), the
+    # sidecars are left unpaired. Images with more than one candidate sidecar
+    # are collected in ambiguous for reporting.
+    ambiguous = {}
+    tasks = pair(scan(config, set(dest_roots), stats=stats), config, ambiguous, stats)
+
+    # Read the metadata for each image and link the favorites. A cache hit
+    # skips Exempi altogether. With -j/--jobs the reading is spread over
+    # worker processes, but the links are always made here, one at a time,
+    # so making the destination directories can't race. Each file is read
+    # once, however many rules (destinations) there are, and is linked by
+    # the writer of every rule it matches.
+    # In sync mode the favorites are only collected, in a compact FileTable
+    # with the rows each writer wants, and are reconciled with the
+    # destinations afterward.
+    writers = make_writers(config, [rule.dest_dir for rule in options.rules])
+    # When planning, the writers only read the destination, and the
+    # changes go in the plan.
+    plan = None
+    if options.plan:
+        try:
+            plan = PlanFile(
+                options.plan,
+                config.source_dir,
+                config.mode,
+                options.sync,
+                [writer.dest_root for writer in writers],
+                config.shard,
+            )
+        except OSError as err:
+            if not quiet:
+                print(f"ERROR: Could not write the plan {options.plan}.")
+                print(err)
+                sys_exit("Exiting.")
+            else:
+                sys_exit(1)
+        writers = [LinkPlanner(writer, plan, index) for index, writer in enumerate(writers)]
+    # In watch mode, start watching before the initial pass, so changes made
+    # while it runs are picked up afterward.
+    watcher = None
+    if options.watch:
+        watcher = start_watch(
+            config,
+            writers,
+            favorite_filters,
+            cache,
+            set(dest_roots),
+            options.poll,
+            options.poll_interval,
+            options.debounce,
+        )
+    if catalog_rows is not None:
+        # Nothing is scanned or read. The catalog has it all.
+        results = catalog_results(catalog_rows, config.source_dir, stats)
+    else:
+        results = read_ratings(tasks, config, cache, stats, library, bool(options.catalog))
+    catalogs = []
+    try:
+        catalogs = [
+            CatalogWriter(path, config.source_dir, config.shard) for path in options.catalog
+        ]
+    except (OSError, sqlite3.Error) as err:
+        if not quiet:
+            print("ERROR: Could not write the catalog.")
+            print(err)
+            sys_exit("Exiting.")
+        else:
+            sys_exit(1)
+    if catalogs:
+        results = write_catalogs(results, catalogs, stats)
+    current = apply_links(
+        select_favorites(results, favorite_filters, stats),
+        writers,
+        options.sync,
+        config.shard,
+        stats,
+        verbose,
+    )
+
+    for catalog in catalogs:
+        catalog.close()
+        if verbose:
+            print(f"\nWrote {catalog.rows} files to the catalog {catalog.path}.")
+    if stats and catalogs:
+        stats.count("files_cataloged", catalogs[0].rows)
+
+    for writer in writers:
+        writer.close()
+        if verbose:
+            print(
+                f"\nLinks in {writer.dest_root}: {writer.linked} made, \
+{writer.existing} already existed, {writer.removed} removed, \
+{writer.dirs_created} directories created, {writer.errors} errors."
+            )
+    if plan is not None:
+        plan.close()
+        if not quiet and not options.show_ew and options.plan != "-":
+            print(
+                f"Wrote the plan {options.plan}: {plan.counts['mkdir']} directories to make, \
+{plan.counts['link']} links to make, {plan.counts['remove']} links to remove."
+            )
 
-# pretty print
-import pprint
+    if cache is not None:
+        # Keep the cache open for watching
+        if watcher is None:
+            cache.close()
+        else:
+            cache.commit()
+        if verbose:
+            print(
+                f"\nMetadata cache {cache.db_path}: {cache.hits} hits, \
+{cache.misses} misses ({cache.stale} stale)."
+            )
 
-# Third party and library imports
-# xmp processing
-from libxmp.utils import file_to_dict
-from libxmp import consts as xmp_consts  # constants
+    if stats:
+        count_run_stats(stats, writers, ambiguous, cache, library)
+        report_stats(stats, options.stats and not quiet, options.stats_json)
 
-# Local application and user library imports
-from bpsPrettyPrint import listPrettyPrint1Col
+    # Report any images that had more than one candidate sidecar
+    if not quiet:
+        report_ambiguous(ambiguous)
 
-# Note: May need PYTHONPATH (set in ~/.profile?) to be set depending
-# on the location of the imported files
+    # Keep the destination up to date until told to stop
+    if watcher is not None:
+        signal.signal(signal.SIGINT, lambda signum, frame: watcher.stop())
+        signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+        if not quiet and not options.show_ew:
+            print(f"\nWatching {path_src.resolve()} for changes. Press Ctrl-C to stop.")
+        run_watch(watcher, current)
+        if cache is not None:
+            cache.close()
+        for writer in writers:
+            writer.close()
+            if verbose:
+                print(
+                    f"\nLinks in {writer.dest_root}: {writer.linked} made, \
+{writer.removed} removed, {writer.errors} errors in total."
+                )
+    return 0
 
 
 # Main function to execute when script is run
@@ -78,9 +5134,9 @@ def main():
     based on 'star' and/or color ratings.
 
     A source directory will be searched for image files. For each image file
-    found, inspect the xmp metadata. If the star rating is above
+    found, inspect the xmp metadata. If the star rating is at or above
     a value (default: 1) create a link to the file in the destination
-    directory. If the color rating is above a value (TODO: What Value), then
+    directory. If the color label is one of the labels given, then
     create a link to the file in the destination directory.
 
     The star rating threshold can be specified with the -S/--star_rating <rating>
@@ -90,14 +5146,34 @@ def main():
     The star rating will be ignored if the -s/--ignore_star option is given.
     Mutually exclusive with the -S/--star_rating option.
 
-    The color label threshold can be specified with the -C/--color_label <rating>
-    option where label is 1-10 ???. Values at or above the indicated value will be
-    included. Mutually exclusive with the -c/--ignore_color option.
-    **Default value??** NOTE: Not yet supported.
+    The color labels that make an image a favorite can be specified with the
+    -C/--color_label <label> option, e.g. Red. The option may be given more
+    than once, or with a comma separated list of labels. Labels are not case
+    sensitive. Mutually exclusive with the -c/--ignore_color option.
 
     The color label will be ignored if the -c/--ignore_color option is given.
-    Default: true (ignore color rating by default). Mutually exclusive with the
-    -C/--color_label option.
+    This is the default, unless -C/--color_label is given. Mutually exclusive
+    with the -C/--color_label option.
+
+    The --filter <expression> option selects favorites with an expression
+    such as 'Rating >= 4 or Label in {Red, Green}'. Rating, Label, and Pick
+    (1 picked, -1 rejected, 0 neither) can be compared with ==, !=, <, <=, >,
+    >=, and in {...} (Label only with ==, !=, and in). 'pick' and 'reject' are
+    true for picked and rejected images. Terms can be combined with and, or,
+    not, and parentheses. If -S/--star_rating or -C/--color_label are given
+    too, an image has to pass both those and the expression. The pick status
+    comes from xmpDM:pick or digiKam:PickLabel, or a rating of -1 (rejected).
+    The expression is checked before any files are read.
+
+    Several destination trees can be filled from one scan of the source with
+    the --rule <dest=expression> option, e.g. --rule '5-star=Rating == 5'
+    --rule 'red-label=Label == Red'. The option may be given more than once.
+    The --rules <file> option reads rules from a file, one dest=expression
+    per line (blank lines and lines starting with # are ignored). Each file's
+    metadata is read once, and the image is linked into every destination
+    whose expression it matches. With rules, the -d/--destination_dir
+    destination is not used, and an explicit -S/-C/--filter narrows every
+    rule. --sync and --watch apply to every destination.
 
     A source directory can be provided with the -I/--source_dir <path> option
     to specify the directory to use for the source images. If this option is
@@ -111,13 +5187,67 @@ def main():
 
     The -r/-R/--recursive option searches the source directory recursively. If
     images are found in sub folders, the same directory structure will be used
-    for the destination directory structure.
+    for the destination directory structure. The destination directory is
+    never searched, even if it is inside the source directory.
+
+    The --exclude_dir <pattern> option skips source sub-directories whose
+    name, or path relative to the source directory, matches the glob pattern.
+    It may be given more than once.
+
+    The --relative_links option makes symbolic links holding a path relative
+    to the link's directory, instead of the absolute path of the image, so the
+    destination tree still works if it is moved (or mounted elsewhere) along
+    with the source. It is the same as --mode relsymlink.
+
+    The --mode <mode> option selects what is put in the destination:
+    'symlink' (the default) and 'relsymlink' make symbolic links (absolute,
+    or relative as with --relative_links). 'hardlink' makes hard links, which
+    need the destination on the same file system as the source (images are
+    copied otherwise). 'reflink' makes copies that share the data blocks of
+    the image on file systems that can clone files (btrfs, xfs, etc.), and
+    plain copies otherwise. 'copy' copies the images, in the kernel where
+    possible (copy_file_range or sendfile). Hard links and copies still work
+    without the source, e.g. on another host or a USB drive. Copies get the
+    image's permissions, modification time, and (if allowed) owner and
+    group. A file with the same size and modification time as the image is
+    left alone, and an out of date one is replaced. The --copy_threads N
+    option makes up to N copies at once (default 4, 0 for one at a time).
+
+    The --sync option makes the destination match the current favorites
+    instead of only adding links. Links are added for new favorites, removed
+    for images that are no longer favorites (e.g. the rating was lowered),
+    and retargeted if they point elsewhere. Only the changes are made. The
+    links made are recorded in a manifest file (.photoPhav_manifest.json) in the
+    destination directory, which the next sync uses instead of reading every
+    link. If there is no manifest, the existing links are read once. Links
+    are only removed for images not selected by this run, so use the same
+    source, pattern, and recursion options from run to run. Only symbolic
+    links are removed or replaced.
+
+    The --watch option keeps running after the initial sync (--watch implies
+    --sync), and keeps the destination up to date as images and sidecars are
+    added, changed, moved, or deleted. Only the directories with changes are
+    re-evaluated. Changes are applied once there have been none for
+    --debounce <seconds> (default 2), so an editor saving a sidecar several
+    times only causes one update. On Linux, inotify is used to learn about
+    changes. Otherwise, or with the --poll option (e.g. for network file
+    systems), the source is walked every --poll_interval <seconds> (default
+    10). Stop watching with Ctrl-C (or SIGTERM).
 
     The -F/--file_priority option will give priority to information embedded
     in the image file. Without this option, priority is given to a xmp
     'sidecar' file if one exists, and the embedded xmp data would only be used
     if the xmp sidecar file does not exist or can't be read or for some reason
-    isn't usable. Mutually exclusive with -f/--ignore_file option.
+    isn't usable. Mutually exclusive with -f/--ignore_file option. It is the
+    same as --prefer embedded.
+
+    The --prefer sidecar|embedded|newest option selects which metadata
+    source of an image with a sidecar is read first: the sidecar (the
+    default), the data embedded in the image file, or whichever of the two
+    was modified last. 'newest' decides from the files' stat data alone, and
+    skips an empty sidecar. Either way, one file is parsed per image, and the
+    other source is only read if the first has no xmp data. With --stats,
+    the number of such second reads is shown as fallback_reads.
 
     The -f/--ignore_file option will ignore xmp data embedded in the image
     file, even if it exists. Mutually exclulsive with -F/--file_priority option.
@@ -125,16 +5255,132 @@ def main():
     The -x/--ignore_xmp option will ignore xmp sidecar file(s), even if they
     are present.
 
+    The --sidecar_naming stem|full|both option selects which sidecar naming
+    convention(s) are honored. 'stem' pairs foo.jpg with foo.xmp, 'full' pairs
+    foo.jpg with foo.jpg.xmp, and 'both' (the default) honors either. If more
+    than one sidecar matches an image, a warning listing the candidates is
+    shown, and the first one listed is used.
+
+    The --cache [path] option keeps a persistent cache of the metadata read
+    from each file, so files that have not changed (same size, modification
+    time, and inode) since the last run are not parsed again. Files with no
+    xmp data are cached too. If path is omitted, a default location in the
+    user cache directory is used. The --cache_prune option removes entries for
+    files that no longer exist or have changed, and the --cache_clear option
+    removes all entries. Both exit after the cache maintenance. With -v, the
+    cache hit and miss counts are shown at the end of the run.
+
+    The --plan <file> option writes a plan of what the run would do in the
+    destination, without changing it: the directories to make, the links (or
+    files) to make, and with --sync, the links to remove. Links already in
+    place are left out. It is JSON lines, one operation per line ('-' writes
+    it to standard output), so it doubles as a dry run to review the changes.
+    A summary of the operations is shown. Mutually exclusive with --watch.
+
+    The --apply <file> option does the operations in a plan written by
+    --plan, and exits. No source files are read. Progress is recorded in a
+    journal next to the plan (<file>.journal), fsync'd every 256 operations,
+    so if the apply is interrupted, running it again continues where it
+    stopped (redoing at most 256 operations, which is safe). For a --sync
+    plan, the destination manifest is written at the end. A plan is applied
+    only once. To apply it again, remove the journal. The source, destination,
+    and mode recorded in the plan are used. The --copy_threads and output
+    options apply.
+
+    The --catalog <file> option writes a ratings catalog of every file read:
+    its path relative to the source directory, rating, label, pick status,
+    metadata source (sidecar or embedded), and modification time, so other
+    tools can use the ratings without reading any xmp. The catalog is SQLite
+    if the file name ends in .db, .sqlite, or .sqlite3, and JSON lines
+    otherwise (a header line, then one line per file). It may be given more
+    than once, e.g. to write both. Rows are written as the files are read, and
+    the catalog replaces the previous one at the end of the run.
+
+    The --from_catalog <file> option links (or with --sync, syncs) the
+    favorites from a catalog written by --catalog, without reading any
+    images or sidecars, e.g. to try a different star rating or filter. The
+    source directory recorded in the catalog is used as the source, and the
+    source options (-I, -r, -g, -e, --types, etc.) are not used. It may be
+    given once for each shard of a sharded run, to merge them (see --shard).
+    Mutually exclusive with --catalog, --shard, and --watch.
+
+    The --shard <i/N> option processes only shard i (1 to N) of N slices of
+    the source, so a large source can be spread over N hosts, each running
+    photoPhav with the same options and its own shard. Files are assigned to
+    shards by a stable hash of their top level directory (--shard_by dir, the
+    default), so a host only walks its own directory trees, or of their path
+    relative to the source (--shard_by path), which balances better when there
+    are only a few top level directories. Files directly in the source are
+    always assigned by path. The assignment doesn't depend on the host, the
+    number of files, or the run, so adding files or directories never moves
+    others to another shard. With --sync, a shard only adds and removes its
+    own links, and keeps its own manifest
+    (.photoPhav_manifest.shard-<i>-of-<N>.json), so the shards can share a
+    destination. The catalog (--catalog) and statistics (--stats_json) of a
+    shard record which shard it is.
+
+    The shards are merged into a single favorites tree by running with a
+    --from_catalog option for the catalog of each shard (all N are needed),
+    and a run report by adding --merge_stats <file> for the --stats_json file
+    of each shard, which adds each shard's times and counts, the totals, and
+    the balance between shards to the statistics (--merge_stats implies
+    --stats unless --stats_json is given). A sync of the whole source into a
+    destination the shards synced to starts from the shard manifests (if all
+    N are there), and replaces them with a single manifest.
+
+    The --library <file> option takes the ratings, color labels, and pick
+    status from a darktable (library.db) or digiKam (digikam4.db) library
+    database, read with a single query at the start, for every image under
+    the source directory that the library knows. Only the images the library
+    doesn't know are read as usual (sidecar or embedded xmp). Library paths
+    are matched to the resolved source directory. In watch mode, changes are
+    read from the files.
+
+    The -j/--jobs N option reads metadata using N worker processes. 0 uses
+    one worker per CPU. The default is 1, which reads everything in this
+    process. Links are always made by the main process, and the results
+    (and messages) are the same regardless of the number of workers.
+
+    The --io_threads N option reads metadata using N threads, so up to N
+    file system calls (stat, open, read) are waiting at once. This is for
+    sources on network file systems (NFS, SMB, etc.), where each call takes
+    milliseconds and a run spends most of its time waiting. The links are
+    still made in the same order as without it. Mutually exclusive with
+    -j/--jobs.
+
+    The --types <extensions> option lists the file types read for metadata,
+    as a comma separated list of extensions, e.g. jpg,nef,dng. It may be given
+    more than once. 'default' stands for the default list of common image and
+    camera raw formats (jpg, tif, png, heic, dng, nef, cr2, cr3, arw, orf, rw2,
+    raf, etc.), and 'all' for every file. Default: default. Other files (text,
+    pdf, video, catalogs, etc.) are skipped by their extension alone, so they
+    are never opened. Extensions are not case sensitive. Sidecars (.xmp) are
+    always used.
+
     The -g/--globp <pattern> option allows files to be searched using a glob
     pattern. Mutually exclusive with the -e/--regexp option.
 
     The -e/--regexp <pattern> option allows files to be searched using a
     regular expression. Mutually exclusive with the -g/--globp option.
 
+    Glob and regex patterns are matched against the path of the image
+    relative to the source directory, e.g. 'sub1/foo.jpg', not the full path.
+    Sidecars are paired with the images that match, whether or not the
+    sidecar itself matches.
+
     The -i/--ignore_case option ignores file name case when matching using a glob
     pattern or regex pattern. This option is ignored if neither the -g or -e,
     patterns are specified.
 
+    The --stats option shows run statistics at the end of the run: the wall
+    and cpu time spent in each phase (discovery, filter, pairing, extraction,
+    catalog, linking, sync), counts of the files scanned, matched, paired, parsed,
+    linked, skipped, and in error, the bytes read, a latency histogram of the
+    metadata reads for each source (sidecar or embedded), and the slowest
+    reads (--stats_top N, default 10). The --stats_json <file> option writes
+    the same statistics as JSON ('-' for standard output). Statistics are
+    only collected when one of these options is given.
+
     The -v/--verbose option increases output messaging. Mutually exclusive
     with -q and -w.
 
@@ -144,157 +5390,8 @@ def main():
     The -w/--show_ew show errors and warning option.
     Mutually exclusive with -v and -q.
     """
-    # Description string will show up in help.
-    DESC_STR = main.__doc__
-    # Create an epilogue string to further describe the input file
-    # The epilogue will show up at the bottom of the help
-    EPL_STR = ""
-
-    # **** argument parsing
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        description=DESC_STR,
-        epilog=EPL_STR,
-    )
-    # define the arguments
-    # star rating
-    sr_group = parser.add_mutually_exclusive_group(required=False)
-    sr_group.add_argument(
-        "-S",
-        "--star_rating",
-        default=1,
-        type=int,
-        choices=range(1, 6),  # 1-5
-        metavar="rating",
-        help="Star rating. Values equal or greater are considered Favorites \
-and a link will be created. Default value is 1, so any stared image is a favorite. \
-Mutually exclusive with the -s/--ignore_star rating.",
-    )
-    sr_group.add_argument(
-        "-s",
-        "--ignore_star",
-        action="store_true",
-        help="Ignore star ratings \
-if set. Mutually exclusive with the -S/--star_rating option.",
-    )
-    # color label
-    cl_group = parser.add_mutually_exclusive_group(required=False)
-    cl_group.add_argument(
-        "-C",
-        "--color_label",
-        default=1,
-        type=int,
-        choices=range(1, 11),  # 1-10
-        metavar="label",
-        help="Color label. Values equal are considered Favorites \
-and a link will be created. Mutually exclusive with the -c/--ignore_color option.",
-    )
-    cl_group.add_argument(
-        "-c",
-        "--ignore_color",
-        action="store_true",
-        help="Color label will be ignored if this option is given. Mutually \
-exclusive with the -C/-color_label option. NOTE: Not yet supported -- color \
-lables are always ignored.",
-    )
-    # source dir
-    parser.add_argument(
-        "-I",
-        "--source_dir",
-        default=".",
-        metavar="path",
-        help="Source directory. Look in this directory for image files. Omit \
-the option or specify '.' to use the working directory.",
-    )
-    # destination dir
-    parser.add_argument(
-        "-d",
-        "-D",
-        "--destination_dir",
-        default="favorites",
-        metavar="path",
-        help="Destination directory.  Create the links in this directory. \
-If this option is not provided, a 'favorites' sub directory in the working \
-directory will first be created if it does not exist, and will used for the \
-destination path.",
-    )
-    # recourse thru the source directory
-    parser.add_argument(
-        "-r",
-        "-R",
-        "--recursive",
-        action="store_true",
-        help="Search for image files recursively, starting at the source directory.",
-    )
-    # xmp options
-    fx_pattern = parser.add_mutually_exclusive_group(required=False)
-    fx_pattern.add_argument(
-        "-F",
-        "--file_priority",
-        action="store_true",
-        help="Give priority to information embedded in the image file. Without \
-this option, priority is given to a xmp 'sidecar' file if one exists, and the \
-embedded xmp data would only be used if the xmp sidecar file does not exist or \
-can't be read or for some reason isn't usable. Mutually exclusive with \
--f/--ignore_file option.",
-    )
-    fx_pattern.add_argument(
-        "-f",
-        "--ignore_file",
-        action="store_true",
-        help="Ignore xmp data embedded in the image file, even if it exists. \
-Mutually exclulsive with -F/--file_priority option.",
-    )
-    parser.add_argument(
-        "-x",
-        "--ignore_xmp",
-        action="store_true",
-        help="Ignore xmp files even if they are present.",
-    )
-    # Mutually exclusive pattern group
-    og_pattern = parser.add_mutually_exclusive_group(required=False)
-    og_pattern.add_argument(
-        "-g",
-        "--globp",
-        metavar="pattern",
-        help="Glob style pattern. Mutually exclusive with -e/--regexp option.",
-    )
-    og_pattern.add_argument(
-        "-e",
-        "--regexp",
-        metavar="pattern",
-        help="Regular expression style pattern. Mutually exclusive with -g/--globp option.",
-    )
-    # ignore case if file name otherwise matches the glob or regex pattern
-    parser.add_argument(
-        "-i",
-        "--ignore_case",
-        action="store_true",
-        help="Ignore case if file name otherwise matches the glob or regex pattern. \
-Ignored if neither -g/--globp or -e/--regexp options are specified.",
-    )
-    # Mutually exclusive output messaging group
-    og_output = parser.add_mutually_exclusive_group(required=False)
-    # verbose output
-    og_output.add_argument(
-        "-v", "--verbose", action="store_true", help="Verbose output"
-    )
-    # quiet output
-    og_output.add_argument(
-        "-q",
-        "--quiet",
-        action="store_true",
-        help="Suppress all output, including errors and warnings.",
-    )
-    # show only errors and warnings
-    og_output.add_argument(
-        "-w",
-        "--show_ew",
-        action="store_true",
-        help="Show only errors and warnings.",
-    )
     # parse the arguments
-    args = parser.parse_args()
+    args = build_parser().parse_args()
 
     # At this point, the arguments will be:
     # Argument              Type        Default
@@ -302,370 +5399,63 @@ Ignored if neither -g/--globp or -e/--regexp options are specified.",
     # args.source_dir       string      .
     # args.destination_dir  string      favorites
     # args.recursive        bool        False
+    # args.exclude_dir      list        None    glob patterns, may be repeated
+    # args.sync             bool        False
+    # args.watch            bool        False   implies sync
+    # args.poll             bool        False
+    # args.poll_interval    float       10.0    seconds
+    # args.debounce         float       2.0     seconds
+    # args.relative_links   bool        False   same as mode relsymlink
+    # args.mode             string      None    symlink unless relative_links
+    # args.copy_threads     int         4
+    # args.types            list        None    extension lists, may be repeated
     # args.ignore_case      bool        False   case sensitive by default
     # args.globp            string      None    (globp | regexp)
     # args.regexp           string      None
     # Rating related:
-    # args.star_rating      int         1
+    # args.star_rating      int         None    1 unless --filter is given
     # args.ignore_star      bool        False   use star ratings >= 1 by default
-    # args.color_rating     int         1
-    # args.ignore_color     bool        False   Forced True for now to ignore color rating
-    # args.file_priority    bool        False
+    # args.color_label      list        None    label names, may be repeated
+    # args.ignore_color     bool        False
+    # args.filter           string      None    filter expression
+    # args.rule             list        None    dest=expression, may be repeated
+    # args.rules            string      None    rules file
+    # args.file_priority    bool        False   same as prefer embedded
+    # args.prefer           string      None    sidecar unless file_priority
     # args.ignore_file      bool        False
     # args.ignore_xmp       bool        False
+    # args.sidecar_naming   string      both    (stem | full | both)
+    # args.library          string      None    library database
+    # args.jobs             int         1       0 for one per CPU
+    # args.io_threads       int         0       (jobs | io_threads)
+    # Cache related:
+    # args.cache            string      None    cache path, if caching
+    # args.cache_prune      bool        False   (cache_prune | cache_clear)
+    # args.cache_clear      bool        False
+    # Plan related:
+    # args.plan             string      None    (plan | apply) plan file or '-'
+    # args.apply            string      None    plan file
+    # Catalog related:
+    # args.catalog          list        None    catalog files, may be repeated
+    # args.from_catalog     list        None    (catalog | from_catalog) one per shard
+    # Shard related:
+    # args.shard            string      None    i/N
+    # args.shard_by         string      dir     (dir | path)
+    # args.merge_stats      list        None    shard stats JSON files, may be repeated
     # Output related:
+    # args.stats            bool        False
+    # args.stats_json       string      None    file name or '-'
+    # args.stats_top        int         10
     # args.verbose          bool        False   Increase messaging (v | q | w)
     # args.quiet            bool        False   No messaging, not even for errors
     # args.show_ew          bool        False   Show errors and warnings only
 
-    # Force ignore_color to be true for now
-    args.ignore_color = True
-
-    # check for --ignore_file and --ignore_xmp. If both options are present
-    # there is no action. Warn (if not quiet) and quit. These are not treated
-    # as mutually exclusive, becuase --file_priority and --ignore_file are already
-    # in a mutually exclusive group, so I don't think --ignore_file and
-    # --ignore_xmp can be in a different mutually exclusive group. Furthermore
-    # note that --file_priority and --ignore_xmp is valid, so --ignore_xmp can't
-    # be added to the exiting file mutually exclusive group.
-    # Check for the case manually.
-    if args.ignore_file and args.ignore_xmp:
-        if not args.quiet:
-            print(
-                "\nWARNING: -f/--ignore_file and -x/--ignore_xmp options are both \
-selected. This will result in no action as there is no data to act on, and is \
-probably not what was intended."
-            )
-        sys_exit(2)
-
-    # make a pretty printer
-    pp = pprint.PrettyPrinter(width=41, compact=True)
-
     if args.verbose:
         print("\nThe following arguments were parsed:")
         print(args)
-        print(
-            "\nNote: ignore_color is forced True at this time. Color ratings \
-are not yet supported."
-        )
-
-    # Establish source and destination paths
-    path_src = Path(args.source_dir)
-    path_dest = Path(args.destination_dir)
-    if args.verbose:
-        print("The source path is:")
-        print(path_src.resolve())
-        print("The destination path is:")
-        print(path_dest.resolve())
-
-    # Search the source directory for files based on recursive, glob, and regex
-    # options. Since the case-insensitive globp or regexp options will use regex,
-    # simplify the pattern matching by using glob(*)/rgblob(*) and the using
-    # regex to match patterns, converting glopb option to a regex if necessary.
-
-    # Start out with a pattern for all files. Then limit based on options.
-    # Convert globp option to a regex
-    re_pattern = r".*"
-    if args.globp:
-        re_pattern = fnmatch.translate(args.globp)
-    if args.regexp:
-        re_pattern = args.regexp
-    if args.ignore_case:
-        # prepend (?i) to regex pattern to ignore case
-        re_pattern = r"(?i)" + re_pattern
-
-    # At this point, any file name filtering will be done with regex. Glob
-    # patterns were converted to regex above.
-
-    # get all files (including directories), considering recursive search option
-    if args.recursive:
-        contents = path_src.rglob("*")
-    else:
-        contents = path_src.glob("*")
-
-    # Get the files only -- exclude the directories. Use a set since values are
-    # unique and should not change
-    path_all_files = {file for file in contents if file.is_file()}
-    # if verbose and filtering options are opted, then display the files found
-    # before filtering
-    if args.verbose and args.globp:
-        # extract the path name as a string for display
-        print(
-            "\nThe following files were found in the source path before applying the glob pattern:"
-        )
-        listPrettyPrint1Col([file.as_posix() for file in path_all_files])
-    elif args.verbose and args.regexp:
-        # extract the path name as a string for display
-        print(
-            "\nThe following files were found in the source path before applying the regex pattern:"
-        )
-        listPrettyPrint1Col([file.as_posix() for file in path_all_files])
-
-    path_src_files = set()  # This will hold the filtered (final) list of path objects
-    # filter out files based on regex filter
-    for path in path_all_files:
-        fp = path.as_posix()  # get full path name
-        try:
-            if re.match(re_pattern, fp):
-                path_src_files.add(path)
-        except re.error as err:
-            if not args.quiet:
-                print("ERROR: Regular Expression Error. Bad escape?")
-                print(err)
-                sys_exit("Exiting.")
-            else:
-                sys_exit(1)
-
-    if args.verbose and args.globp:
-        # extract the path name as a string for display
-        print("\nThe following is a list of source files that have been filtered")
-        print("with the '" + args.globp + "' glob pattern:")
-        if args.ignore_case:
-            print("\nNote the i-/--ignore_case option is in effect, so file name")
-            print("case will ignored when considering a match.\n")
-        listPrettyPrint1Col([path_src_files])
-    elif args.verbose and args.regexp:
-        # extract the path name as a string for display
-        print("\nThe following is a list of source files that have been filtered")
-        print("with the '" + args.regexp + "' regex pattern:")
-        if args.ignore_case:
-            print("Note the i-/--ignore_case option is in effect, so file name")
-            print("case will ignored when considerig a match.")
-        listPrettyPrint1Col([file.as_posix() for file in path_src_files])
-    elif args.verbose:  # no glob or regex filtering
-        # extract the path name as a string for display
-        print("\nThe following files were found in the source path:")
-        listPrettyPrint1Col([path_src_files])
-
-    # At this point, path_src_files is a list of path objects for the files
-    # we want to process.... Let's go!
-
-    # Get a list of xmp and non-xmp files. Store path objects so full compliment
-    # of info is avail later. If xmp is ignored (-ix/--ignore_xmp),
-    # the xmp list object will get created, but will remain empty. This was done
-    # so later checks for an empty list cover the no file case and the ignore
-    # case, and are less error prone that if the list didn't exist.
-    image_paths = set()  # list of full path non-xmp file names
-    image_paths_xmp = set()  # list of full path file names with xmp suffix
-    for file in path_src_files:
-        if not args.ignore_xmp and file.suffix.lower() == ".xmp":
-            image_paths_xmp.add(file)
-        elif file.suffix.lower() != ".xmp":
-            image_paths.add(file)
-
-    # At this point, image_paths[] will have all the non-xmp files, and
-    # image_paths_xmp[] will have the *.xmp file name,
-    # or will be empty if there are no xmp files or will also be empty if xmp
-    # is ignored (-x/--ignore_xmp)
-
-    # Create a helper function to retreive the rating from an xmp property and
-    # return it as a function.
-    def get_embedded_rating(props: list[tuple]):
-        """Given properties (props) as a list of tuples, extract the Rating
-        as an integer. Return 0 if not found or if can't be converted to an int."""
-        r_tuple = tuple(filter(lambda iterable: "xmp:Rating" in iterable, props))
-        # If no rating is found, return 0
-        # If a rating entry is found, then it is in a tuple with the format:
-        # ("xmp:Rating", <rating value as a string>, {dict_of_entry properties})
-        # We want the rating as an integer
-        if r_tuple:
-            # return 0 if extracted rating cannot be an integer
-            try:
-                return int(r_tuple[0][1])
-            except ValueError:
-                return 0
-        # if we get here, the tuple was empty, and there is no rating
-        return 0
-
-    # Create helper function to test if a file has an associated xmp file
-    def has_xmp(fname: str, xmp_files: set[Path]):
-        """Given a file name and a set of xmp files, see if the file name matches
-        an xmp filename, less the suffixes. e.g. foo.jpg and foo.xmp would be
-        a match."""
-        # strip off the extensions and if there is a match, the set will have a member
-        return (
-            len(
-                {
-                    fn
-                    for fn in xmp_files
-                    if fn.as_posix().rsplit(".", 1)[0] == fname.rsplit(".", 1)[0]
-                }
-            )
-            > 0
-        )
-
-    # Create helper function to return the file name of the associated xmp file
-    def get_xmp_filename(fname: str, xmp_files: set[Path]):
-        """Given a file name and a set of xmp files, return the name of the
-        corresponding xmp file name. Nominally this is the same name as the
-        file name, except the suffix would be '.xmp' or '.XMP'"""
-        # strip off the extensions and if there is a match, return the full xmp
-        # file name. If there is not match, xname will be the empty set, and
-        # return an empty stiring.
-        xname = {
-            fn.as_posix()
-            for fn in xmp_files
-            if fn.as_posix().rsplit(".", 1)[0] == fname.rsplit(".", 1)[0]
-        }
-        if not xname:
-            return ""
-
-        # if we get here, there is something to return
-        return list(xname).pop()  # return the only memeber of the set
-
-    # Create helper function to copy group, owner, and permissions of a dir
-    def cp_ogp(src_path: Path, dest_path: Path):
-        """Copy the owner, group, and permissions from a source path."""
-        dest_str = dest_path.resolve().as_posix()
-        src_stat = os.stat(src_path.resolve().as_posix())
-        os.chown(dest_str, src_stat.st_uid, src_stat.st_gid)
-        os.chmod(dest_str, src_stat.st_mode)
-
-    # Create helper function to create a link.
-    def create_link(target_path: Path, dest_path: Path, src_path: Path):
-        """Given a target path, create a symbolic link in the destination
-        directory. The source directory structure that comes after the source
-        path will be retained, so the source path is needed for reference.
-        For example, if:
-        target_path: /a/b/c/fav1.jpg
-        source_path: /a/b
-        dest_path:   /e/f/g
-        The above would mean the target was in the 'c' sub-directory of the
-        source, and this would be retained on the destination side, so the
-        link created would be /e/f/g/c/fav1.jpg."""
-        try:
-            # Get the part of the target path that is relative to the source
-            # path. Append this to the destination to make the link path, and
-            # create the link
-            rel_path = target_path.resolve().relative_to(src_path.resolve())
-            link_path = dest_path.joinpath(rel_path).resolve()
-            # print("\ncreate_link() called")
-            # print(f"Target Path: {target_path.resolve()}")
-            # print(f"Src Path: {src_path.resolve()}")
-            # print(f"Src Path Short: {src_path}")
-            # print(f"Dest Path: {dest_path.resolve()}")
-            # print(f"Dest Path Short: {dest_path}")
-            # print(f"Rel Path: {rel_path}")
-            # print(f"Link Path: {link_path.resolve()}")
-            # print(f"Link Path Short: {link_path}")
-            # print(f"Parent Path: {rel_path.parent}")
-
-            # See if the parent of the target link exists. If it does not exist,
-            # make it, along with any necessary parent directories. For any
-            # dirctories made, copy the owner, group, and permissions from the
-            # target directories.
-            if not link_path.parent.is_dir():
-                # The link target dir (parent of the symbolic link we want to
-                # make) does not exist. rel_path gives us the difference between
-                # to 'root' of the destination and the link path. Walk the
-                # rel_path and create any needed subdirectories. These are made
-                # individually so the owner, group, and permissions of each can
-                # be made to match the corresponding sub-directory in the source
-                # directory structure. The path.parents property includes the
-                # '.' case so this loop will also make the root destination
-                # directory if it does not exist.
-                if args.verbose:
-                    print("Link destination directory does not exist.")
-                    print("Creating the necessary link destination directories.")
-                # Go thru the directories in order of shallowest to deepest.
-                # If a directory does not exist, create it. Some sub-directories
-                # may already exist.
-                for p in reversed(rel_path.parents):
-                    dpath = dest_path.joinpath(p).resolve()
-                    if not dpath.is_dir():
-                        if args.verbose:
-                            print(f"Directory {dpath} does not exit. Creating it.")
-                        dpath.mkdir()
-                        cp_ogp(path_src, dpath)
-
-            # Make the link
-            os.symlink(target_path.resolve(), link_path.resolve())
-
-        except Exception:
-            print("***ERROR: Exeption in create_link()")
-            traceback.print_exc()
-
-    for path in image_paths:
-        # Default behavior is xmp priority, so get the rating from xmp if there is one
-        # and if not, check for data embedded in the file. Otherwise check the other
-        # combinations
-        ifn = path.as_posix()  # use the full path file name in this case
-        if not args.file_priority and not args.ignore_file and not args.ignore_xmp:
-            if has_xmp(ifn, image_paths_xmp):
-                # There is an xmp file for this image file. Use it.
-                ifx = get_xmp_filename(ifn, image_paths_xmp)
-                try:
-                    dict_xmp = file_to_dict(ifx)
-                    if dict_xmp:
-                        props = dict_xmp[xmp_consts.XMP_NS_XMP]
-                        rating = get_embedded_rating(props)
-                        if rating > 0:
-                            create_link(path, path_dest, path_src)
-                except Exception:
-                    pass
-            else:
-                # There is no xmp file for this image file. Use the embedded
-                # data if it exists.
-                dict_xmp = file_to_dict(ifn)
-                if dict_xmp:
-                    # There is embedded xmp data found. Try to get a rating.
-                    try:
-                        props = dict_xmp[xmp_consts.XMP_NS_XMP]
-                        rating = get_embedded_rating(props)
-                        if rating > 0:
-                            create_link(path, path_dest, path_src)
-                    except Exception:
-                        pass
-        elif (not args.file_priority and args.ignore_xmp) or args.file_priority:
-            # If file priority or ignore_xmp, then initially check the data
-            # embedded in the file for a rating. If there is no data, then try
-            # the xmp file if it exists and should not be ignored.
-            dict_xmp = file_to_dict(ifn)
-            if dict_xmp:
-                # There is embedded xmp data found. Try to get a rating.
-                try:
-                    props = dict_xmp[xmp_consts.XMP_NS_XMP]
-                    rating = get_embedded_rating(props)
-                    if rating > 0:
-                        create_link(path, path_dest, path_src)
-                except Exception:
-                    pass
-            elif not args.ignore_xmp and has_xmp(ifn, image_paths_xmp):
-                # There was no embedded xmp data found, but we are not ignoring
-                # xmp, and there is an xmp file for this image file. Use it.
-                ifx = get_xmp_filename(ifn, image_paths_xmp)
-                try:
-                    dict_xmp = file_to_dict(ifx)
-                    if dict_xmp:
-                        props = dict_xmp[xmp_consts.XMP_NS_XMP]
-                        rating = get_embedded_rating(props)
-                        if rating > 0:
-                            create_link(path, path_dest, path_src)
-                except Exception:
-                    pass
-        elif args.ignore_file:
-            # Ignore the embedded data in the image file, and use the xmp
-            # file if it exists
-            if has_xmp(ifn, image_paths_xmp):
-                # There is an xmp file for this image file. Use it.
-                ifx = get_xmp_filename(ifn, image_paths_xmp)
-                try:
-                    dict_xmp = file_to_dict(ifx)
-                    if dict_xmp:
-                        props = dict_xmp[xmp_consts.XMP_NS_XMP]
-                        rating = get_embedded_rating(props)
-                        if rating > 0:
-                            create_link(path, path_dest, path_src)
-                except Exception:
-                    pass
-        else:
-            # Should not get here. Here for completeness and documentation.
-            # Print a message and leave.
-            print(
-                "ERROR: Argument or logic error. Not sure which xmp data \
-to process. Exiting"
-            )
-            sys_exit(3)
+    config = config_from_args(args)
+    options = options_from_args(args)
+    sys_exit(run(config, options))
 
 
 # Tell python to run main if this program is executed directly (i.e. not imported)
@@ -0,0 +1,1033 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# turn off import sorting for this file
+# isort: skip_file
+
+"""
+photoPhavBench.py
+
+Benchmark photoPhav against a synthetic photo library. A library of small
+JPEG files (with and without embedded xmp) and xmp sidecars is generated in a
+local work directory, and each phase of a photoPhav run is timed:
+discovery, pattern filtering, sidecar pairing, xmp extraction, favorite
+selection, and link creation. Runs are made with a cold page cache (the library's pages are
+evicted first) and a warm one, and the results are written as JSON so they
+can be compared between versions. No network access is needed.
+
+See main.docstring for the options.
+"""
+
+# imports
+
+# Standard library and system imports
+import os
+import ast
+import builtins
+import sys
+import json
+import time
+import random
+import shutil
+import struct
+import platform
+import tempfile
+import subprocess
+from statistics import median
+
+# arg parser
+import argparse
+
+# path, file processing, and regular expressions
+import re
+import fnmatch
+
+# Local application and user library imports
+import photoPhav
+
+# Default rating distribution, as rating=weight. Most images are not rated.
+DEFAULT_RATINGS = "0=60,1=15,2=10,3=8,4=5,5=2"
+# Color labels used for a share of the rated images
+LABELS = ("", "", "", "Red", "Yellow", "Green", "Blue", "Purple")
+# Phases of a run, in order
+PHASES = ("discovery", "filter", "pairing", "extraction", "select", "linking")
+# Modules photoPhav only imports when they are needed. None of them should be
+# loaded by importing photoPhav.
+LAZY_MODULES = ("libxmp", "bpsPrettyPrint", "pprint", "ctypes", "concurrent.futures", "hashlib")
+
+
+def parse_ratings(spec: str):
+    """Parse a rating distribution such as '0=60,1=15,5=2' into (ratings,
+    weights) lists."""
+    ratings = []
+    weights = []
+    for item in spec.split(","):
+        rating, _, weight = item.partition("=")
+        ratings.append(int(rating))
+        weights.append(float(weight))
+    return ratings, weights
+
+
+def make_xmp_packet(rating: int, label: str, packet_size: int):
+    """Return a serialized xmp packet (bytes) with the rating and label in
+    attribute form, padded with whitespace to about packet_size bytes, the
+    way editors leave room for in-place updates."""
+    attrs = f' xmp:Rating="{rating}"'
+    if label:
+        attrs += f' xmp:Label="{label}"'
+    body = (
+        '<?xpacket begin="﻿" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+        ' <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+        '  <rdf:Description rdf:about=""\n'
+        '    xmlns:xmp="http://ns.adobe.com/xap/1.0/"\n'
+        f"   {attrs}/>\n"
+        " </rdf:RDF>\n"
+        "</x:xmpmeta>\n"
+    )
+    trailer = '<?xpacket end="w"?>'
+    padding = max(0, packet_size - len(body.encode()) - len(trailer))
+    # Padding is in lines of 100 spaces, as Adobe writes it
+    pad = (" " * 99 + "\n") * (padding // 100) + " " * (padding % 100)
+    return (body + pad + trailer).encode()
+
+
+def make_jpeg(path: str, packet, image_bytes: int):
+    """Write a minimal JPEG file: SOI, APP0 (JFIF), an optional xmp APP1
+    segment holding packet, SOS, image_bytes of filler 'image data', and EOI.
+    Good enough for marker walking and for Exempi's JPEG handler."""
+    parts = [b"\xff\xd8"]
+    app0 = b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    parts.append(b"\xff\xe0" + (len(app0) + 2).to_bytes(2, "big") + app0)
+    if packet is not None:
+        app1 = photoPhav.XMP_APP1_HEADER + packet
+        parts.append(b"\xff\xe1" + (len(app1) + 2).to_bytes(2, "big") + app1)
+    sos = b"\x01\x01\x00\x00\x3f\x00"
+    parts.append(b"\xff\xda" + (len(sos) + 2).to_bytes(2, "big") + sos)
+    # Filler that never contains a marker (0xFF)
+    parts.append(b"\x55" * image_bytes)
+    parts.append(b"\xff\xd9")
+    with open(path, "wb") as jpeg:
+        jpeg.write(b"".join(parts))
+
+
+def make_tiff(
+    path: str, packet, image_bytes: int, order: str = "<", magic: int = 42, xmp_ifd: int = 0
+):
+    """Write a minimal TIFF based file, the way raw formats are laid out: a
+    header, two IFDs (image width, length, and strip offsets), image_bytes of
+    filler 'image data', and then the xmp packet, if any, with tag 700 in IFD
+    number xmp_ifd. order is the struct byte order ('<' or '>'), and magic
+    the header's magic number (42, or 0x4F52 for ORF, 0x55 for RW2)."""
+    ifd_size = 2 + 3 * 12 + 4
+    data_offset = 8 + 2 * ifd_size
+    packet_offset = data_offset + image_bytes
+    parts = [(b"II" if order == "<" else b"MM") + struct.pack(order + "HI", magic, 8)]
+    for ifd in range(2):
+        next_offset = 8 + ifd_size if ifd == 0 else 0
+        entries = [
+            struct.pack(order + "HHIHH", 256, 3, 1, 400, 0),  # ImageWidth
+            struct.pack(order + "HHIHH", 257, 3, 1, 300, 0),  # ImageLength
+        ]
+        if packet is not None and ifd == xmp_ifd:
+            entries.append(struct.pack(order + "HHII", 700, 7, len(packet), packet_offset))
+        else:
+            entries.append(struct.pack(order + "HHII", 273, 4, 1, data_offset))  # StripOffsets
+        parts.append(struct.pack(order + "H", 3) + b"".join(entries))
+        parts.append(struct.pack(order + "I", next_offset))
+    parts.append(b"\x55" * image_bytes)
+    if packet is not None:
+        parts.append(packet)
+    with open(path, "wb") as tiff:
+        tiff.write(b"".join(parts))
+
+
+def generate_library(
+    root: str,
+    files: int,
+    dirs: int,
+    depth: int,
+    sidecar_ratio: float,
+    naming: str,
+    ratings: str,
+    packet_size: int,
+    image_kb: int,
+    seed: int,
+):
+    """Generate a synthetic photo library under root. Return a summary dict
+    of what was generated.
+
+    files images are spread evenly over dirs directories, arranged in a tree
+    at most depth levels deep. sidecar_ratio of the images have their rating
+    in an xmp sidecar (and no embedded xmp); the rest have it embedded.
+    Sidecars are named foo.xmp ('stem'), foo.jpg.xmp ('full'), or either at
+    random ('mixed'). Ratings are drawn from the ratings distribution."""
+    rng = random.Random(seed)
+    rating_values, rating_weights = parse_ratings(ratings)
+    os.makedirs(root, exist_ok=True)
+    # Build the directory tree. Each new directory gets a random parent that
+    # is not yet at the maximum depth.
+    dir_paths = [("", 0)]
+    while len(dir_paths) < dirs:
+        parent, level = rng.choice([d for d in dir_paths if d[1] < depth] or [dir_paths[0]])
+        name = f"d{len(dir_paths):05d}"
+        rel = f"{parent}/{name}" if parent else name
+        os.makedirs(os.path.join(root, rel), exist_ok=True)
+        dir_paths.append((rel, level + 1))
+
+    summary = {"images": 0, "sidecars": 0, "rated": 0, "bytes": 0}
+    summary["by_rating"] = {str(r): 0 for r in rating_values}
+    for index in range(files):
+        rel_dir = dir_paths[index % len(dir_paths)][0]
+        dir_path = os.path.join(root, rel_dir)
+        stem = f"IMG_{index:07d}"
+        rating = rng.choices(rating_values, rating_weights)[0]
+        label = rng.choice(LABELS) if rating > 0 else ""
+        packet = make_xmp_packet(rating, label, packet_size)
+        image_path = os.path.join(dir_path, stem + ".jpg")
+        if rng.random() < sidecar_ratio:
+            make_jpeg(image_path, None, image_kb * 1024)
+            style = naming if naming != "mixed" else rng.choice(("stem", "full"))
+            xmp_name = stem + (".xmp" if style == "stem" else ".jpg.xmp")
+            with open(os.path.join(dir_path, xmp_name), "wb") as xfile:
+                xfile.write(packet)
+            summary["sidecars"] += 1
+            summary["bytes"] += len(packet)
+        else:
+            make_jpeg(image_path, packet, image_kb * 1024)
+        summary["images"] += 1
+        summary["bytes"] += os.path.getsize(image_path)
+        summary["by_rating"][str(rating)] += 1
+        if rating > 0:
+            summary["rated"] += 1
+    summary["dirs"] = len(dir_paths)
+    return summary
+
+
+def evict_page_cache(root: str):
+    """Evict the library's files from the page cache, so the next run reads
+    them from disk. Uses posix_fadvise(DONTNEED), which does not need root.
+    Return False if it is not supported here."""
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for dir_path, _, file_names in os.walk(root):
+        for name in file_names:
+            try:
+                fd = os.open(os.path.join(dir_path, name), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+    return True
+
+
+def run_phases(src: str, dest: str, jobs: int, naming: str, globp: str, expression="Rating >= 1"):
+    """Run photoPhav's stages over src one phase at a time, as photoPhav
+    would with the glob pattern and a filter expression: scan_dir(),
+    filter_batches(), pair(), read_ratings(), select_favorites(), and
+    apply_links() into dest. Return {phase: {"wall": s, "cpu": s}} plus
+    counts. Each phase's output is collected before the next starts so the
+    phases are timed separately."""
+    times = {}
+    counts = {}
+
+    def timed(phase, func):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = func()
+        times[phase] = {
+            "wall": time.perf_counter() - wall,
+            "cpu": time.process_time() - cpu,
+        }
+        return result
+
+    config = photoPhav.PhavConfig(
+        source_dir=src,
+        recursive=True,
+        pattern=re.compile(fnmatch.translate(globp)),
+        sidecar_naming=naming,
+        fields=photoPhav.filter_fields([expression]),
+        jobs=jobs,
+        quiet=True,
+    )
+    filters = [photoPhav.compile_filter(expression)]
+    batches = timed(
+        "discovery",
+        lambda: list(
+            photoPhav.scan_dir(
+                src,
+                config.recursive,
+                prune_dirs={os.path.realpath(dest)},
+                entries=config.scan_entries,
+            )
+        ),
+    )
+    counts["files"] = sum(len(names) for _, names in batches)
+    filtered = timed("filter", lambda: list(photoPhav.filter_batches(batches, config)))
+    counts["filtered"] = sum(len(names) for _, names in filtered)
+    tasks = timed("pairing", lambda: list(photoPhav.pair(filtered, config)))
+    counts["images"] = len(tasks)
+    counts["paired"] = sum(1 for _, ifx, _ in tasks if ifx)
+    results = timed("extraction", lambda: list(photoPhav.read_ratings(tasks, config)))
+    counts["with_xmp"] = sum(1 for _, record, _ in results if record)
+    favorites = timed("select", lambda: list(photoPhav.select_favorites(results, filters)))
+    counts["favorites"] = len(favorites)
+
+    def link_all():
+        writers = photoPhav.make_writers(config, [dest])
+        photoPhav.apply_links(favorites, writers)
+        for writer in writers:
+            writer.close()
+        return writers[0].linked
+
+    counts["linked"] = timed("linking", link_all)
+    times["total"] = {
+        "wall": sum(times[phase]["wall"] for phase in PHASES),
+        "cpu": sum(times[phase]["cpu"] for phase in PHASES),
+    }
+    return times, counts
+
+
+class LatencyShim:
+    """Context manager that adds a fixed delay to each file system call
+    photoPhav makes to read metadata (os.stat, open, and Exempi's
+    file_to_dict), to imitate a high-latency network file system on a local
+    disk. The delay is a sleep, which releases the GIL like a real network
+    wait would."""
+
+    def __init__(self, latency_ms: float):
+        self.delay = latency_ms / 1000
+        self._saved = None
+
+    def _slow(self, func):
+        def slow_call(*args, **kwargs):
+            time.sleep(self.delay)
+            return func(*args, **kwargs)
+
+        return slow_call
+
+    def __enter__(self):
+        real_open = builtins.open
+        self._saved = (os.stat, real_open, photoPhav._file_to_dict)
+        os.stat = self._slow(os.stat)
+        builtins.open = self._slow(real_open)
+        try:
+            photoPhav._file_to_dict = self._slow(photoPhav.load_file_to_dict())
+        except ImportError:
+            pass  # Only JPEG fast-path reads, then
+        return self
+
+    def __exit__(self, *exc_info):
+        os.stat, builtins.open, photoPhav._file_to_dict = self._saved
+
+
+def run_latency_sweep(src: str, naming: str, latency_ms: float, thread_counts: list):
+    """Time the extraction phase over src with each file system call delayed
+    by latency_ms, sequentially and then with each number of I/O threads in
+    thread_counts. Return {threads: wall seconds}, with 0 for sequential."""
+    batches = list(photoPhav.scan_dir(src, True))
+    tasks = list(photoPhav.pair_sidecars(batches, naming))
+    options = photoPhav.SelectOptions()
+    times = {}
+    with LatencyShim(latency_ms):
+        for threads in [0] + thread_counts:
+            start = time.perf_counter()
+            for _ in photoPhav.extract_records(tasks, options, io_threads=threads):
+                pass
+            times[threads] = time.perf_counter() - start
+    return times
+
+
+# In-memory representations of a run's files compared by the memory
+# benchmark. 'baseline' holds nothing (to subtract the interpreter),
+# 'path_sets' is how main() used to hold the files (overlapping sets of Path
+# objects, plus the desired links as strings), and 'file_table' is a
+# photoPhav.FileTable.
+MEMORY_KINDS = ("baseline", "path_sets", "file_table")
+
+
+def synthetic_files(count: int, per_dir: int = 500):
+    """Generate (file name, is sidecar) for a synthetic library of count
+    images, each second one with a sidecar, without touching the disk."""
+    for num in range(count):
+        dir_prefix = f"/archive/photos/{num // per_dir // 100:04d}/{num // per_dir:06d}/"
+        image = f"{dir_prefix}IMG_{num:08d}.jpg"
+        yield image, False
+        if num % 2:
+            yield image + ".xmp", True
+
+
+def memory_child(kind: str, count: int):
+    """Build one of the MEMORY_KINDS representations for count synthetic
+    images, and print the peak RSS in KB. Run in a fresh process."""
+    import resource  # pylint: disable=import-outside-toplevel
+    from pathlib import Path  # pylint: disable=import-outside-toplevel
+
+    keep = None
+    if kind == "path_sets":
+        all_files = {Path(fname) for fname, _ in synthetic_files(count)}
+        src_files = set(all_files)
+        images = {path for path in src_files if path.suffix.lower() != ".xmp"}
+        sidecars = src_files - images
+        desired = {path.as_posix()[1:]: path.as_posix() for path in images}
+        keep = (all_files, src_files, images, sidecars, desired)
+    elif kind == "file_table":
+        keep = photoPhav.FileTable()
+        for fname, is_sidecar in synthetic_files(count):
+            if not is_sidecar:
+                keep.add_file(fname)
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(keep or ()))
+
+
+def measure_memory(count: int):
+    """Return the peak RSS of each of the MEMORY_KINDS for count images, in
+    MB, and per million images over the baseline."""
+    rss_kb = {}
+    for kind in MEMORY_KINDS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--memory_child", kind, str(count)],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        rss_kb[kind] = int(output.split()[0])
+    results = {"images": count}
+    for kind in MEMORY_KINDS:
+        results[kind] = {
+            "peak_rss_mb": rss_kb[kind] / 1024,
+            "mb_per_million": (rss_kb[kind] - rss_kb["baseline"]) / 1024 * 1e6 / count,
+        }
+    return results
+
+
+def time_command(command: list, runs: int, env: dict = None):
+    """Run a command runs times, in env if given, and return the median wall
+    time in ms."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env, check=False
+        )
+        times.append((time.perf_counter() - start) * 1000)
+    return median(times)
+
+
+def measure_startup(src: str, work_dir: str, runs: int):
+    """Time photoPhav's startup in fresh interpreters: importing the module,
+    --help, and a run over src where every file is a metadata cache hit. Also
+    list any LAZY_MODULES loaded by the import, which should be none. Return
+    the results as a dict."""
+    script = os.path.abspath(photoPhav.__file__)
+    script_dir = os.path.dirname(script)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (script_dir, env.get("PYTHONPATH"))))
+    loaded = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, photoPhav; "
+            f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    ).stdout.split()
+    cache = os.path.join(work_dir, "startup_cache.sqlite3")
+    dest = os.path.join(work_dir, "startup_favorites")
+    cache_run = [sys.executable, script, "-I", src, "-d", dest, "-r", "-q", "--cache", cache]
+    # Fill the cache, so the timed runs are all hits
+    subprocess.run(cache_run, env=env, check=False)
+    return {
+        "interpreter_ms": time_command([sys.executable, "-c", "pass"], runs, env),
+        "import_ms": time_command([sys.executable, "-c", "import photoPhav"], runs, env),
+        "help_ms": time_command([sys.executable, script, "--help"], runs, env),
+        "cache_hit_run_ms": time_command(cache_run, runs, env),
+        "lazy_modules_loaded": loaded,
+    }
+
+
+# Fast path conformance. The sample sidecars, against the Exempi records
+# stored in SAMPLE_RECORDS, the xmp packet of the image whose file_to_dict()
+# output is recorded in xmpSample.xmp, and synthetic sidecars and raw files
+# for the layouts editors and cameras write. Cases expected to be handed to
+# Exempi are marked FALLBACK, and cases with nothing to compare with (no
+# libxmp and no stored record) SKIPPED.
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_DIR = os.path.join(REPO_DIR, "sample")
+SAMPLE_RECORDS = os.path.join(REPO_DIR, "xmpSampleRecords.json")
+XMP_DUMP = os.path.join(REPO_DIR, "xmpSample.xmp")
+XMP_DUMP_IMAGE = os.path.join(SAMPLE_DIR, "090621_0756_JCSheeron.jpg")
+FALLBACK = "fallback"
+SKIPPED = "skipped"
+SIDECAR_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+    f' <rdf:RDF xmlns:rdf="{photoPhav.NS_RDF}">\n'
+)
+SIDECAR_TAIL = " </rdf:RDF>\n</x:xmpmeta>\n"
+SIDECAR_NAMESPACES = (
+    f' xmlns:xmp="{photoPhav.NS_XMP}"'
+    f' xmlns:xmpDM="{photoPhav.NS_XMP_DM}"'
+    f' xmlns:digiKam="{photoPhav.NS_DIGIKAM}"'
+    ' xmlns:crs="http://ns.adobe.com/camera-raw-settings/1.0/"'
+)
+
+
+def sidecar_description(attrs: str = "", elements: str = ""):
+    """Return a top level rdf:Description with the given properties in
+    attribute form and element form."""
+    return (
+        f'  <rdf:Description rdf:about=""{SIDECAR_NAMESPACES}{attrs}>\n'
+        f"{elements}  </rdf:Description>\n"
+    )
+
+
+def develop_history(size: int):
+    """Return about size bytes of crs:History, the way raw editors fill a
+    sidecar with develop steps."""
+    step = (
+        '     <rdf:li crs:Exposure2012="+0.35" crs:Contrast2012="+12" '
+        'crs:Highlights2012="-40" crs:Shadows2012="+25" crs:Clarity2012="+8"/>\n'
+    )
+    return "   <crs:History>\n    <rdf:Seq>\n" + step * (size // len(step) + 1) + (
+        "    </rdf:Seq>\n   </crs:History>\n"
+    )
+
+
+def recorded_exempi_record(dump_path: str):
+    """Return the XmpRecord for the file_to_dict() output recorded in
+    xmpSample.xmp (a verbose run log, ending with the dict printed)."""
+    with open(dump_path, encoding="utf-8") as dump:
+        text = dump.read()
+    return photoPhav.xmp_dict_record(ast.literal_eval(text[text.index("\n{") + 1 :]))
+
+
+def sample_sidecars():
+    """Generate (name, path) for the sidecars in sample/, where name is the
+    path relative to the repository."""
+    for dir_path, names in photoPhav.scan_dir(SAMPLE_DIR, True):
+        for name in sorted(names):
+            if name.lower().endswith(".xmp"):
+                path = os.path.join(dir_path, name)
+                yield os.path.relpath(path, REPO_DIR), path
+
+
+def load_sample_records(path: str = SAMPLE_RECORDS):
+    """Return the Exempi records of the sample sidecars stored by
+    record_sample_records(), as {name: XmpRecord or None}, or an empty dict
+    if none are stored."""
+    try:
+        with open(path, encoding="utf-8") as rfile:
+            stored = json.load(rfile)
+    except FileNotFoundError:
+        return {}
+    return {
+        name: None if fields is None else photoPhav.XmpRecord(*fields)
+        for name, fields in stored.items()
+    }
+
+
+def record_sample_records(path: str = SAMPLE_RECORDS):
+    """Read the sample sidecars with Exempi, and store their records in path
+    as JSON, for check_conformance() to use where libxmp isn't installed.
+    Return the number of records."""
+    records = {
+        name: photoPhav.read_xmp_exempi(sidecar_path) for name, sidecar_path in sample_sidecars()
+    }
+    with open(path, "w", encoding="utf-8") as rfile:
+        json.dump(
+            {name: None if record is None else list(record) for name, record in records.items()},
+            rfile,
+            indent=2,
+        )
+        rfile.write("\n")
+    return len(records)
+
+
+def conformance_cases(work_dir: str):
+    """Write the synthetic sidecars and raw files to work_dir, and return the corpus as a
+    list of (name, path, expected) tuples. expected is an XmpRecord, None for
+    a sidecar with no properties, FALLBACK, or SKIPPED for a sample sidecar
+    with no stored Exempi record."""
+    record = photoPhav.XmpRecord
+    picked, rejected, unset = photoPhav.PICK_PICKED, photoPhav.PICK_REJECTED, photoPhav.PICK_NONE
+    history = develop_history(512 * 1024)
+    synthetic = {
+        "attributes": (
+            sidecar_description(' xmp:Rating="4" xmp:Label="Green" xmpDM:pick="1"'),
+            record(4, "Green", picked),
+        ),
+        "elements": (
+            sidecar_description(
+                elements="   <xmp:Rating>2</xmp:Rating>\n   <xmp:Label>Red</xmp:Label>\n"
+            ),
+            record(2, "Red", unset),
+        ),
+        "history_after": (
+            sidecar_description(' xmp:Rating="5" xmp:Label="Blue" xmpDM:pick="-1"', history),
+            record(5, "Blue", rejected),
+        ),
+        "history_before": (
+            sidecar_description(elements=history)
+            + sidecar_description(
+                elements="   <xmp:Rating>3</xmp:Rating>\n"
+                "   <digiKam:PickLabel>3</digiKam:PickLabel>\n"
+            ),
+            record(3, "", picked),
+        ),
+        "split_descriptions": (
+            sidecar_description(' xmp:Rating="1"') + sidecar_description(' xmp:Label="Purple"'),
+            record(1, "Purple", unset),
+        ),
+        "first_value_wins": (
+            sidecar_description(' xmp:Rating="2"') + sidecar_description(' xmp:Rating="5"'),
+            record(2, "", unset),
+        ),
+        "nested_struct": (
+            sidecar_description(
+                ' xmp:Rating="1"',
+                '   <crs:Look>\n    <rdf:Description xmp:Rating="5" xmp:Label="Red"/>\n'
+                "   </crs:Look>\n",
+            ),
+            record(1, "", unset),
+        ),
+        "rejected_rating": (sidecar_description(' xmp:Rating="-1"'), record(-1, "", rejected)),
+        "no_properties": (sidecar_description(), None),
+        "rating_not_simple": (
+            sidecar_description(
+                elements='   <xmp:Rating>\n    <rdf:Alt><rdf:li xml:lang="x-default">3</rdf:li>'
+                "</rdf:Alt>\n   </xmp:Rating>\n"
+            ),
+            FALLBACK,
+        ),
+        "extended": (
+            sidecar_description(
+                f' xmlns:xmpNote="{photoPhav.NS_XMP_NOTE}" xmpNote:HasExtendedXMP="0123"'
+            ),
+            FALLBACK,
+        ),
+        "truncated": (sidecar_description(' xmp:Rating="3"')[:-20], FALLBACK),
+    }
+    cases = []
+    # TIFF based raw files, with the packet after several MB of image data
+    filler = 4 * 1024 * 1024
+    raw_files = {
+        "raw_little_endian.nef": ({}, record(3, "Red", unset)),
+        "raw_big_endian.dng": ({"order": ">"}, record(2, "", unset)),
+        "raw_xmp_in_ifd1.arw": ({"xmp_ifd": 1}, record(4, "Yellow", unset)),
+        "raw_olympus.orf": ({"magic": 0x4F52}, record(5, "", unset)),
+        "raw_panasonic.rw2": ({"magic": 0x55}, record(1, "Blue", unset)),
+        "raw_big_endian_olympus.orf": ({"order": ">", "magic": 0x4F52}, record(2, "Red", unset)),
+        "raw_no_xmp.cr2": ({}, FALLBACK),
+        "raw_bigtiff.dng": ({"magic": 43}, FALLBACK),
+    }
+    for name, (options, expected) in raw_files.items():
+        path = os.path.join(work_dir, name)
+        packet = None
+        if expected != FALLBACK:
+            packet = make_xmp_packet(expected.rating, expected.label, 2048)
+        elif name == "raw_bigtiff.dng":
+            packet = make_xmp_packet(1, "", 2048)
+        make_tiff(path, packet, filler, **options)
+        cases.append((name, path, expected))
+    path = os.path.join(work_dir, "raw_not_tiff.cr2")
+    with open(path, "wb") as ofile:
+        ofile.write(b"\x00" * 64)
+    cases.append(("raw_not_tiff.cr2", path, FALLBACK))
+
+    for name, (body, expected) in synthetic.items():
+        path = os.path.join(work_dir, f"{name}.xmp")
+        if name == "truncated":
+            text = SIDECAR_HEAD + body
+        else:
+            text = SIDECAR_HEAD + body + SIDECAR_TAIL
+        with open(path, "w", encoding="utf-8") as ofile:
+            ofile.write(text)
+        cases.append((name, path, expected))
+
+    # The embedded packet of the image xmpSample.xmp was made from, as a
+    # sidecar, against the recorded Exempi output
+    path = os.path.join(work_dir, "xmpSample.xmp")
+    with open(path, "wb") as ofile:
+        ofile.write(photoPhav.read_jpeg_xmp_packet(XMP_DUMP_IMAGE))
+    cases.append(("xmpSample", path, recorded_exempi_record(XMP_DUMP)))
+
+    stored = load_sample_records()
+    for name, path in sample_sidecars():
+        cases.append((name, path, stored.get(name, SKIPPED)))
+    return cases
+
+
+def fast_path_record(path: str):
+    """Read a file in the conformance corpus with its fast path:
+    read_xmp_sidecar() for a sidecar, and read_tiff_xmp_packet() for a raw
+    file."""
+    if path.lower().endswith(".xmp"):
+        return photoPhav.read_xmp_sidecar(path)
+    return photoPhav.parse_xmp_packet(photoPhav.read_tiff_xmp_packet(path))
+
+
+def check_conformance(work_dir: str):
+    """Read each file in the conformance corpus with its fast path, and
+    compare the result with Exempi's if libxmp is installed, otherwise with
+    the expected result. Print the results, and return the number of
+    mismatches. Cases with nothing to compare with are skipped."""
+    try:
+        photoPhav.load_file_to_dict()
+        exempi = True
+    except ImportError:
+        exempi = False
+    print(f"Fast path conformance against {'Exempi' if exempi else 'the recorded results'}:")
+    failures = 0
+    for name, path, expected in conformance_cases(work_dir):
+        try:
+            result = fast_path_record(path)
+        except photoPhav.XmpFastPathError:
+            result = FALLBACK
+        if exempi and result != FALLBACK:
+            expected = photoPhav.read_xmp_exempi(path)
+        if expected == SKIPPED:
+            print(f"  {SKIPPED:<8} {name:<55} {result}")
+            continue
+        status = "ok" if result == expected else "MISMATCH"
+        if result != expected:
+            failures += 1
+        print(f"  {status:<8} {name:<55} {result}")
+        if result != expected:
+            print(f"  {'':<8} {'expected':<55} {expected}")
+    return failures
+
+
+def summarize(runs: list):
+    """Reduce a list of run timings to the min and median wall and cpu time
+    per phase."""
+    summary = {}
+    for phase in PHASES + ("total",):
+        walls = [run[phase]["wall"] for run in runs]
+        cpus = [run[phase]["cpu"] for run in runs]
+        summary[phase] = {
+            "wall_min": min(walls),
+            "wall_median": median(walls),
+            "cpu_median": median(cpus),
+        }
+    return summary
+
+
+def git_revision():
+    """Return the git revision of photoPhav, or None if it can't be found."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(photoPhav.__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results: dict):
+    """Print the phase timings as a table."""
+    files = results["library"]["images"]
+    for cache_state in ("cold", "warm"):
+        if cache_state not in results:
+            continue
+        print(f"\n{cache_state} page cache ({results['runs'][cache_state]} run(s)):")
+        print(
+            f"  {'phase':<12}{'wall min s':>12}{'wall med s':>12}{'cpu med s':>12}"
+            f"{'files/s':>12}"
+        )
+        for phase, row in results[cache_state].items():
+            rate = files / row["wall_median"] if row["wall_median"] else 0.0
+            print(
+                f"  {phase:<12}{row['wall_min']:>12.4f}{row['wall_median']:>12.4f}"
+                f"{row['cpu_median']:>12.4f}{rate:>12.0f}"
+            )
+    memory = results.get("memory")
+    if memory:
+        print(f"\nmemory for {memory['images']} images:")
+        print(f"  {'representation':<16}{'peak RSS MB':>14}{'MB/million':>14}")
+        for kind in MEMORY_KINDS:
+            row = memory[kind]
+            print(f"  {kind:<16}{row['peak_rss_mb']:>14.1f}{row['mb_per_million']:>14.1f}")
+    latency = results.get("latency")
+    if latency:
+        print(f"\nextraction with {latency['latency_ms']} ms per file system call:")
+        print(f"  {'io_threads':<12}{'wall s':>12}{'speedup':>12}")
+        base = latency["wall"]["0"]
+        for threads, wall in latency["wall"].items():
+            print(f"  {threads:<12}{wall:>12.3f}{base / wall if wall else 0.0:>12.1f}")
+    startup = results.get("startup")
+    if startup:
+        print(f"\nstartup (median of {results['runs']['startup']} run(s)):")
+        for name in ("interpreter_ms", "import_ms", "help_ms", "cache_hit_run_ms"):
+            print(f"  {name:<24}{startup[name]:>10.1f}")
+        loaded = " ".join(startup["lazy_modules_loaded"]) or "none"
+        print(f"  {'lazy modules loaded':<24}{loaded:>10}")
+
+
+def main():
+    """
+    Benchmark photoPhav against a synthetic photo library.
+
+    A library is generated in a work directory (a temporary directory unless
+    --work_dir <path> is given), and the photoPhav phases are timed:
+    discovery (directory walk), filter (glob pattern and file types), pairing
+    (sidecars), extraction (xmp metadata), select (the default Rating >= 1
+    filter), and linking (into a destination inside the work directory).
+
+    The library shape is set with --files, --dirs, --depth, --sidecar_ratio
+    (share of images rated in a sidecar rather than embedded), --naming
+    stem|full|mixed (sidecar naming), --ratings (distribution as
+    rating=weight,...), --packet_size (bytes per xmp packet, including
+    padding), --image_kb (filler image data per JPEG), and --seed.
+
+    --cold_runs N and --warm_runs N set the number of runs with the library
+    evicted from the page cache, and with it already cached. --jobs N is
+    passed on to the extraction phase.
+
+    With --memory_files N, the peak RSS of holding N images in memory is
+    measured in fresh processes, for the FileTable photoPhav uses and for the
+    sets of Path objects it used to keep, and shown per million images. No
+    files are made for this.
+
+    With --latency_ms MS, the extraction phase is also timed with a delay of
+    MS ms added to every file system call it makes (see LatencyShim), to
+    imitate a network file system: first sequentially, then with each number
+    of I/O threads in --io_threads (default 1,2,4,8,16). The speedup should
+    be close to the number of threads.
+
+    Startup is timed with --startup_runs N (default 10, 0 to skip) fresh
+    interpreters each: importing photoPhav (less the bare interpreter
+    startup), photoPhav --help, and a run over the library where every file
+    is a metadata cache hit. The modules photoPhav should only import when
+    needed (libxmp, bpsPrettyPrint, etc.) must not be loaded by the import.
+    With --startup_budget MS, the benchmark exits with status 1 if the import
+    takes longer than MS ms, or loads any of those modules, so it can be used
+    as a regression check.
+
+    With --conformance, nothing is timed. Instead, the xmp fast paths for
+    sidecars (read_xmp_sidecar()) and TIFF based raw files
+    (read_tiff_xmp_packet()) are run over a corpus: the sidecars in sample/,
+    the packet of the image xmpSample.xmp was made from, synthetic sidecars
+    with the properties in attribute and element form, before and after a
+    large develop history, and split over several rdf:Description elements,
+    synthetic raw files in both byte orders and the NEF, DNG, ARW, ORF, and
+    RW2 layouts, and files in forms that must be left to Exempi. The results
+    are compared with Exempi's when libxmp is installed, and otherwise with
+    the recorded results, and the benchmark exits with status 1 on any
+    mismatch. The Exempi records of the sample sidecars are stored in
+    xmpSampleRecords.json by --record_conformance (which needs libxmp), and
+    sidecars with no stored record are skipped without libxmp.
+
+    Results are printed as a table, and written as JSON to --output <file>
+    if given, along with the library summary, options, photoPhav git
+    revision, and platform, so runs can be compared over time. With
+    --reuse, an existing library in --work_dir is used as is. The work
+    directory is removed afterward unless --keep is given or --work_dir was.
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=main.__doc__,
+    )
+    parser.add_argument(
+        "--files", type=int, default=10000, help="Number of images. Default: 10000."
+    )
+    parser.add_argument(
+        "--dirs", type=int, default=100, help="Number of directories. Default: 100."
+    )
+    parser.add_argument("--depth", type=int, default=3, help="Maximum directory depth. Default: 3.")
+    parser.add_argument(
+        "--sidecar_ratio",
+        type=float,
+        default=0.5,
+        help="Share of images rated in a sidecar (0-1). Default: 0.5.",
+    )
+    parser.add_argument(
+        "--naming",
+        choices=("stem", "full", "mixed"),
+        default="mixed",
+        help="Sidecar naming: foo.xmp, foo.jpg.xmp, or either. Default: mixed.",
+    )
+    parser.add_argument(
+        "--ratings",
+        default=DEFAULT_RATINGS,
+        help=f"Rating distribution as rating=weight,... Default: {DEFAULT_RATINGS}.",
+    )
+    parser.add_argument(
+        "--packet_size", type=int, default=4096, help="Bytes per xmp packet. Default: 4096."
+    )
+    parser.add_argument(
+        "--image_kb", type=int, default=64, help="Filler image data per JPEG, KB. Default: 64."
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed. Default: 1.")
+    parser.add_argument("--cold_runs", type=int, default=1, help="Cold cache runs. Default: 1.")
+    parser.add_argument("--warm_runs", type=int, default=3, help="Warm cache runs. Default: 3.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Extraction jobs. Default: 1.")
+    parser.add_argument("--work_dir", metavar="path", help="Work directory for the library.")
+    parser.add_argument("--reuse", action="store_true", help="Reuse the library in --work_dir.")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory.")
+    parser.add_argument("--output", metavar="file", help="Write the results as JSON.")
+    parser.add_argument(
+        "--memory_files",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Also measure peak memory for N images in memory. Default: 0 (skip).",
+    )
+    parser.add_argument("--memory_child", nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--conformance",
+        action="store_true",
+        help="Check the xmp fast paths against Exempi (or recorded results) and exit.",
+    )
+    parser.add_argument(
+        "--record_conformance",
+        action="store_true",
+        help="Store Exempi's records of the sample sidecars for --conformance and exit.",
+    )
+    parser.add_argument(
+        "--latency_ms",
+        type=float,
+        metavar="MS",
+        help="Also time extraction with MS ms added to each file system call.",
+    )
+    parser.add_argument(
+        "--io_threads",
+        default="1,2,4,8,16",
+        metavar="N,...",
+        help="I/O thread counts for --latency_ms. Default: 1,2,4,8,16.",
+    )
+    parser.add_argument(
+        "--startup_runs", type=int, default=10, help="Startup timing runs. Default: 10."
+    )
+    parser.add_argument(
+        "--startup_budget",
+        type=float,
+        metavar="MS",
+        help="Fail if importing photoPhav takes longer than MS ms (over the bare \
+interpreter) or loads modules that should be lazy.",
+    )
+    args = parser.parse_args()
+
+    if args.memory_child:
+        memory_child(args.memory_child[0], int(args.memory_child[1]))
+        return
+
+    if args.record_conformance:
+        try:
+            count = record_sample_records()
+        except ImportError as err:
+            print("ERROR: Recording needs libxmp and Exempi.")
+            print(err)
+            sys.exit(1)
+        print(f"Stored the Exempi records of {count} sample sidecars in {SAMPLE_RECORDS}.")
+        return
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="photoPhavBench_")
+    if args.conformance:
+        try:
+            failures = check_conformance(work_dir)
+        finally:
+            if not args.keep and not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        if failures:
+            print(f"\nERROR: {failures} file(s) don't match.")
+            sys.exit(1)
+        return
+    src = os.path.join(work_dir, "library")
+    dest = os.path.join(work_dir, "favorites")
+    try:
+        if args.reuse and os.path.isdir(src):
+            images = sum(
+                1
+                for _, names in photoPhav.scan_dir(src, True)
+                for name in names
+                if not name.lower().endswith(".xmp")
+            )
+            library = {"images": images, "reused": True}
+        else:
+            shutil.rmtree(src, ignore_errors=True)
+            start = time.perf_counter()
+            library = generate_library(
+                src,
+                args.files,
+                args.dirs,
+                args.depth,
+                args.sidecar_ratio,
+                args.naming,
+                args.ratings,
+                args.packet_size,
+                args.image_kb,
+                args.seed,
+            )
+            print(
+                f"Generated {library['images']} images and {library['sidecars']} \
+sidecars in {library['dirs']} directories in {time.perf_counter() - start:.1f} s."
+            )
+
+        naming = "both" if args.naming == "mixed" else args.naming
+        results = {
+            "library": library,
+            "options": vars(args),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "runs": {},
+        }
+        for cache_state, count in (("cold", args.cold_runs), ("warm", args.warm_runs)):
+            if count <= 0:
+                continue
+            runs = []
+            for _ in range(count):
+                shutil.rmtree(dest, ignore_errors=True)
+                if cache_state == "cold" and not evict_page_cache(src):
+                    print("WARNING: Can't evict the page cache here. Cold runs are warm.")
+                times, counts = run_phases(src, dest, args.jobs, naming, "*")
+                runs.append(times)
+            results[cache_state] = summarize(runs)
+            results["runs"][cache_state] = count
+            results["counts"] = counts
+        if args.memory_files > 0:
+            results["memory"] = measure_memory(args.memory_files)
+        if args.latency_ms:
+            thread_counts = [int(count) for count in args.io_threads.split(",")]
+            wall = run_latency_sweep(src, naming, args.latency_ms, thread_counts)
+            results["latency"] = {
+                "latency_ms": args.latency_ms,
+                "wall": {str(threads): seconds for threads, seconds in wall.items()},
+            }
+        if args.startup_runs > 0:
+            results["startup"] = measure_startup(src, work_dir, args.startup_runs)
+            results["runs"]["startup"] = args.startup_runs
+        print_table(results)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as ofile:
+                json.dump(results, ofile, indent=2)
+            print(f"\nResults written to {args.output}")
+        startup = results.get("startup")
+        if args.startup_budget is not None and startup:
+            import_ms = startup["import_ms"] - startup["interpreter_ms"]
+            if import_ms > args.startup_budget or startup["lazy_modules_loaded"]:
+                print(
+                    f"\nERROR: Startup budget exceeded: import took {import_ms:.1f} ms \
+(budget {args.startup_budget:.1f} ms), lazy modules loaded: \
+{' '.join(startup['lazy_modules_loaded']) or 'none'}."
+                )
+                sys.exit(1)
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Tell python to run main if this program is executed directly (i.e. not imported)
+if __name__ == "__main__":
+    main()